@@ -0,0 +1,277 @@
+#!/usr/bin/python
+#
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+r"""Benchmarks the training of the new final layer from retrain.py.
+
+The layer is trained on random bottlenecks, so no model or images are needed
+and only the cost of training itself is measured.
+
+  python -m scripts.benchmark_retrain --benchmark=summaries
+
+times a training step under different --summary_mode and --summary_interval
+settings, and
+
+  python -m scripts.benchmark_retrain --benchmark=trainers
+
+compares the TensorFlow training loop with the NumPy trainers.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import argparse
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+import tensorflow as tf
+
+import scripts.retrain as retrain
+
+FLAGS = None
+
+# (summary_mode, summary_interval) pairs timed by benchmark_summaries.
+SUMMARY_SETTINGS = [
+    ('all', 1),
+    ('all', 10),
+    ('all', 100),
+    ('scalars', 1),
+    ('scalars', 10),
+    ('none', 1),
+]
+
+
+def make_bottlenecks():
+  """Returns random bottlenecks and one-hot ground truths to train on.
+
+  The labels come from a random linear classifier with some noise, so the
+  layer has something to learn and the trainers' accuracies can be compared.
+  """
+  rng = np.random.RandomState(0)
+  bottlenecks = rng.rand(FLAGS.image_count,
+                         FLAGS.bottleneck_size).astype(np.float32)
+  teacher = rng.randn(FLAGS.bottleneck_size, FLAGS.class_count)
+  logits = np.dot(bottlenecks - 0.5, teacher)
+  logits += rng.randn(*logits.shape) * logits.std()
+  labels = np.argmax(logits, axis=1)
+  ground_truth = np.eye(FLAGS.class_count, dtype=np.float32)[labels]
+  return bottlenecks, ground_truth
+
+
+def add_training_graph():
+  """Adds the new layer from retrain.py on top of a bottleneck placeholder.
+
+  Returns:
+    The training op, the bottleneck and ground truth inputs, and the final
+    result and evaluation tensors.
+  """
+  bottleneck_tensor = tf.placeholder(tf.float32, [None, FLAGS.bottleneck_size])
+  (train_step, _, bottleneck_input, ground_truth_input,
+   final_tensor) = retrain.add_final_training_ops(
+       FLAGS.class_count, 'final_result', bottleneck_tensor,
+       FLAGS.bottleneck_size)
+  evaluation_step, _ = retrain.add_evaluation_step(final_tensor,
+                                                   ground_truth_input)
+  return (train_step, bottleneck_input, ground_truth_input, final_tensor,
+          evaluation_step)
+
+
+def benchmark_summaries(bottlenecks, ground_truth):
+  """Times a training step under each of SUMMARY_SETTINGS.
+
+  Args:
+    bottlenecks: Array of bottlenecks to draw batches from.
+    ground_truth: Array of matching one-hot ground truths.
+
+  Returns:
+    List of (setting name, mean step time, median step time) table rows.
+  """
+  results = []
+  for summary_mode, summary_interval in SUMMARY_SETTINGS:
+    summaries_dir = tempfile.mkdtemp()
+    try:
+      with tf.Graph().as_default() as graph:
+        (train_step, bottleneck_input, ground_truth_input, _,
+         _) = add_training_graph()
+        summary_op = retrain.add_summary_op(summary_mode)
+        with tf.Session(graph=graph) as sess:
+          sess.run(tf.global_variables_initializer())
+          train_writer = None
+          if summary_op is not None:
+            train_writer = tf.summary.FileWriter(summaries_dir, sess.graph)
+          rng = np.random.RandomState(0)
+          step_secs = []
+          for step in range(FLAGS.warmup_steps + FLAGS.steps):
+            rows = rng.randint(len(bottlenecks), size=FLAGS.train_batch_size)
+            start_time = time.time()
+            retrain.run_train_step(
+                sess, step, train_step, summary_op, summary_interval,
+                train_writer, {bottleneck_input: bottlenecks[rows],
+                               ground_truth_input: ground_truth[rows]})
+            if step >= FLAGS.warmup_steps:
+              step_secs.append(time.time() - start_time)
+          if train_writer is not None:
+            train_writer.close()
+    finally:
+      shutil.rmtree(summaries_dir)
+    results.append(('%s every %d' % (summary_mode, summary_interval),
+                    '%.3fms' % (np.mean(step_secs) * 1000),
+                    '%.3fms' % (np.median(step_secs) * 1000)))
+  return results
+
+
+def benchmark_trainers(bottlenecks, ground_truth):
+  """Times the TensorFlow training loop against the NumPy trainers.
+
+  The TensorFlow loop and the sgd trainer run --steps steps on the same
+  batches, and the lbfgs trainer runs up to --lbfgs_iterations full-batch
+  iterations. Each result is the accuracy of the trained weights on all the
+  bottlenecks, read back through the graph's final_result tensor.
+
+  Args:
+    bottlenecks: Array of bottlenecks to train on.
+    ground_truth: Array of matching one-hot ground truths.
+
+  Returns:
+    List of (trainer, steps, training time, time per step, accuracy) table
+    rows.
+  """
+  rng = np.random.RandomState(0)
+  batches = [rng.randint(len(bottlenecks), size=FLAGS.train_batch_size)
+             for _ in range(FLAGS.steps)]
+  results = []
+  for trainer in retrain.TRAINERS:
+    with tf.Graph().as_default() as graph:
+      (train_step, bottleneck_input, ground_truth_input, _,
+       evaluation_step) = add_training_graph()
+      with tf.Session(graph=graph) as sess:
+        sess.run(tf.global_variables_initializer())
+        if trainer == 'tensorflow':
+          start_time = time.time()
+          for rows in batches:
+            sess.run(train_step,
+                     feed_dict={bottleneck_input: bottlenecks[rows],
+                                ground_truth_input: ground_truth[rows]})
+          training_secs = time.time() - start_time
+          how_many_steps = len(batches)
+        else:
+          batch_rows = iter(batches)
+
+          def get_train_batch(unused_step):
+            rows = next(batch_rows)
+            return bottlenecks[rows], ground_truth[rows]
+
+          train_data = retrain.ResidentBottlenecks(
+              bottlenecks, None, np.argmax(ground_truth, axis=1), None)
+          how_many_steps, training_secs = (
+              retrain.train_final_layer_with_numpy(
+                  sess, trainer, get_train_batch, train_data,
+                  tf.trainable_variables()))
+        accuracy = sess.run(evaluation_step,
+                            feed_dict={bottleneck_input: bottlenecks,
+                                       ground_truth_input: ground_truth})
+    results.append((trainer, str(how_many_steps), '%.2fs' % training_secs,
+                    '%.3fms' % (training_secs * 1000 / max(how_many_steps, 1)),
+                    '%.1f%%' % (accuracy * 100)))
+  return results
+
+
+def main(_):
+  # The retrain.py functions read the learning rate and trainer settings from
+  # its flags.
+  retrain.FLAGS = FLAGS
+  FLAGS.how_many_training_steps = FLAGS.steps
+  FLAGS.eval_step_interval = FLAGS.steps
+  tf.logging.set_verbosity(tf.logging.WARN)
+  bottlenecks, ground_truth = make_bottlenecks()
+  if FLAGS.benchmark == 'summaries':
+    header = ('setting', 'mean step', 'median step')
+    results = benchmark_summaries(bottlenecks, ground_truth)
+  else:
+    header = ('trainer', 'steps', 'total', 'per step', 'accuracy')
+    results = benchmark_trainers(bottlenecks, ground_truth)
+  row_format = '%-20s' + ' %12s' * (len(header) - 1)
+  print(row_format % header)
+  for row in results:
+    print(row_format % row)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser()
+  parser.add_argument(
+      '--benchmark',
+      type=str,
+      default='summaries',
+      choices=['summaries', 'trainers'],
+      help='Which benchmark to run.'
+  )
+  parser.add_argument(
+      '--bottleneck_size',
+      type=int,
+      default=2048,
+      help='How many entries in each random bottleneck vector.'
+  )
+  parser.add_argument(
+      '--class_count',
+      type=int,
+      default=5,
+      help='How many classes the new layer recognizes.'
+  )
+  parser.add_argument(
+      '--image_count',
+      type=int,
+      default=2000,
+      help='How many random bottlenecks to draw batches from.'
+  )
+  parser.add_argument(
+      '--train_batch_size',
+      type=int,
+      default=100,
+      help='How many bottlenecks to train on at a time.'
+  )
+  parser.add_argument(
+      '--learning_rate',
+      type=float,
+      default=0.01,
+      help='How large a learning rate to use when training.'
+  )
+  parser.add_argument(
+      '--momentum',
+      type=float,
+      default=0.9,
+      help='Momentum of the sgd trainer.'
+  )
+  parser.add_argument(
+      '--lbfgs_iterations',
+      type=int,
+      default=100,
+      help='Maximum number of iterations of the lbfgs trainer.'
+  )
+  parser.add_argument(
+      '--steps',
+      type=int,
+      default=500,
+      help='How many timed training steps to run per setting.'
+  )
+  parser.add_argument(
+      '--warmup_steps',
+      type=int,
+      default=20,
+      help='How many untimed training steps to run first per setting.'
+  )
+  FLAGS, unparsed = parser.parse_known_args()
+  tf.app.run(main=main, argv=[sys.argv[0]] + unparsed)
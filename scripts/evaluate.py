@@ -20,6 +20,7 @@ from __future__ import print_function
 import os
 
 import sys
+import time
 import argparse
 
 import numpy as np
@@ -66,24 +67,34 @@ def evaluate_graph(graph_file_name):
         ground_truths.append(ground_truth)
         filenames.append(image_name)
     
+    def load_image(entry):
+        filename, _ = entry
+        image = Image.open(filename).resize((224,224),Image.ANTIALIAS)
+        image = np.array(image, dtype=np.float32)[None,...]
+        return (image-128)/128.0
+
     accuracies = []
     xents = []
+    compute_secs = 0.0
     with tf.Session(graph=graph) as sess:
-        for filename, ground_truth in zip(filenames, ground_truths):    
-            image = Image.open(filename).resize((224,224),Image.ANTIALIAS)
-            image = np.array(image, dtype=np.float32)[None,...]
-            image = (image-128)/128.0
-
+        # Read and resize the images on background threads so the session
+        # is not left idle waiting on disk and decoding.
+        pipeline = retrain.ImagePipeline(
+            list(zip(filenames, ground_truths)), load_image)
+        for (filename, ground_truth), image in pipeline:
             feed_dict={
                 image_buffer_input: image,
                 ground_truth_input: ground_truth}
 
+            start_time = time.time()
             eval_accuracy, eval_xent = sess.run([accuracy, xent], feed_dict)
-            
+            compute_secs += time.time() - start_time
+
             accuracies.append(eval_accuracy)
             xents.append(eval_xent)
-        
-        
+
+    print('Stalled on input: %.1fs, compute: %.1fs' %
+          (pipeline.input_wait_secs, compute_secs))
     return np.mean(accuracies), np.mean(xents)
 
 if __name__ == "__main__":
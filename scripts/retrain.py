@@ -96,15 +96,24 @@ from __future__ import print_function
 
 import argparse
 import collections
+import contextlib
+import csv
 from datetime import datetime
 import hashlib
+import itertools
+import json
+import multiprocessing
 import os.path
-import random
 import re
+import shutil
 import sys
 import tarfile
+import tempfile
+import threading
+import time
 
 import numpy as np
+from six.moves import queue
 from six.moves import urllib
 import tensorflow as tf
 
@@ -121,88 +130,470 @@ FLAGS = None
 # need to update these to reflect the values in the network you're using.
 MAX_NUM_IMAGES_PER_CLASS = 2 ** 27 - 1  # ~134M
 
+# Name scope of the decoding operations create_model_graph wires into the
+# model's input.
+FUSED_INPUT_SCOPE = 'fused_input'
 
-def create_image_lists(image_dir, testing_percentage, validation_percentage):
+# File names of the checkpoints save_head_checkpoint writes, by step.
+HEAD_CHECKPOINT_RE = re.compile(r'^head_checkpoint_(\d+)\.npz$')
+
+
+# File extensions, in lower case, of the images create_image_lists picks up.
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+
+def list_image_dir(dir_path):
+  """Lists the subfolders and image files of a folder in one pass.
+
+  Local folders are read with a single os.scandir call, which returns each
+  entry's type along with its name. Other file systems fall back to gfile.
+  Image files are matched on IMAGE_EXTENSIONS regardless of case.
+
+  Args:
+    dir_path: Path string of the folder.
+
+  Returns:
+    Tuple of sorted lists of the subfolder names and the image file names.
+  """
+  sub_dir_names = []
+  file_names = []
+  if hasattr(os, 'scandir') and '://' not in dir_path:
+    for entry in os.scandir(dir_path):
+      if entry.is_dir():
+        sub_dir_names.append(entry.name)
+      else:
+        file_names.append(entry.name)
+  else:
+    for name in gfile.ListDirectory(dir_path):
+      name = name.rstrip('/')
+      if gfile.IsDirectory(os.path.join(dir_path, name)):
+        sub_dir_names.append(name)
+      else:
+        file_names.append(name)
+  image_names = [name for name in file_names
+                 if os.path.splitext(name)[1].lower() in IMAGE_EXTENSIONS]
+  return sorted(sub_dir_names), sorted(image_names)
+
+
+def get_image_category(file_name, testing_percentage, validation_percentage):
+  """Decides which set an image belongs in from its path.
+
+  Args:
+    file_name: Path string of the image, including the image directory.
+    testing_percentage: Integer percentage of the images to reserve for tests.
+    validation_percentage: Integer percentage of images reserved for validation.
+
+  Returns:
+    Name string of the set - training, testing, or validation.
+  """
+  # We want to ignore anything after '_nohash_' in the file name when
+  # deciding which set to put an image in, the data set creator has a way of
+  # grouping photos that are close variations of each other. For example
+  # this is used in the plant disease data set to group multiple pictures of
+  # the same leaf.
+  hash_name = re.sub(r'_nohash_.*$', '', file_name)
+  # This looks a bit magical, but we need to decide whether this file should
+  # go into the training, testing, or validation sets, and we want to keep
+  # existing files in the same set even if more files are subsequently
+  # added.
+  # To do that, we need a stable way of deciding based on just the file name
+  # itself, so we do a hash of that and then use that to generate a
+  # probability value that we use to assign it.
+  hash_name_hashed = hashlib.sha1(compat.as_bytes(hash_name)).hexdigest()
+  percentage_hash = ((int(hash_name_hashed, 16) %
+                      (MAX_NUM_IMAGES_PER_CLASS + 1)) *
+                     (100.0 / MAX_NUM_IMAGES_PER_CLASS))
+  if percentage_hash < validation_percentage:
+    return 'validation'
+  elif percentage_hash < (testing_percentage + validation_percentage):
+    return 'testing'
+  return 'training'
+
+
+def load_image_manifest(manifest_file, image_dir, testing_percentage,
+                        validation_percentage):
+  """Reads the folders recorded by an earlier create_image_lists call.
+
+  Args:
+    manifest_file: Path string of the JSON manifest.
+    image_dir: String path to the folder containing subfolders of images.
+    testing_percentage: Integer percentage of the images to reserve for tests.
+    validation_percentage: Integer percentage of images reserved for validation.
+
+  Returns:
+    Dictionary of the manifest, with the recorded modification time and image
+    sets of each subfolder under 'dirs' and the recorded image fingerprints
+    under 'fingerprints'. Empty if there's no manifest, it can't be parsed, or
+    it was written for another image directory or split.
+  """
+  if not os.path.exists(manifest_file):
+    return {}
+  try:
+    with open(manifest_file) as f:
+      manifest = json.load(f)
+  except ValueError:
+    manifest = None
+  if not isinstance(manifest, dict) or 'dirs' not in manifest:
+    tf.logging.warning('Image manifest %s is corrupt, scanning every folder',
+                       manifest_file)
+    return {}
+  if (manifest.get('image_dir') != os.path.abspath(image_dir) or
+      manifest.get('testing_percentage') != testing_percentage or
+      manifest.get('validation_percentage') != validation_percentage):
+    return {}
+  return manifest
+
+
+def write_image_manifest(manifest_file, manifest):
+  """Replaces an image manifest with a new dictionary in one rename."""
+  ensure_dir_exists(os.path.dirname(manifest_file) or '.')
+  with open(manifest_file + '.tmp', 'w') as f:
+    json.dump(manifest, f)
+  os.rename(manifest_file + '.tmp', manifest_file)
+
+
+def create_image_lists(image_dir, testing_percentage, validation_percentage,
+                       manifest_file=None):
   """Builds a list of training images from the file system.
 
   Analyzes the sub folders in the image directory, splits them into stable
   training, testing, and validation sets, and returns a data structure
   describing the lists of images for each label and their paths.
 
+  With a manifest file, the image sets of each local subfolder are recorded
+  along with its modification time, which changes whenever a file is added,
+  removed, or renamed in it. Subfolders that haven't changed since are read
+  from the manifest without listing them, and only the new files of those
+  that have are hashed. The content hashes recorded by
+  save_image_fingerprints are loaded back as well, for get_image_fingerprint.
+
   Args:
     image_dir: String path to a folder containing subfolders of images.
     testing_percentage: Integer percentage of the images to reserve for tests.
     validation_percentage: Integer percentage of images reserved for validation.
+    manifest_file: Optional path string of a JSON manifest to read and update.
 
   Returns:
-    A dictionary containing an entry for each label subfolder, with images split
-    into training, testing, and validation sets within each label.
+    An ImageLists table containing an entry for each label subfolder, with
+    images split into training, testing, and validation sets within each label.
   """
   if not gfile.Exists(image_dir):
     tf.logging.error("Image directory '" + image_dir + "' not found.")
     return None
+  if '://' in image_dir:
+    manifest_file = None
+  manifest = {}
+  if manifest_file:
+    manifest = load_image_manifest(manifest_file, image_dir,
+                                   testing_percentage, validation_percentage)
+  known_dirs = manifest.get('dirs', {})
+  for relative_path, record in manifest.get('fingerprints', {}).items():
+    image_path_2_stat_fingerprint.setdefault(
+        os.path.join(image_dir, relative_path), record)
   result = collections.OrderedDict()
-  sub_dirs = [
-    os.path.join(image_dir,item)
-    for item in gfile.ListDirectory(image_dir)]
-  sub_dirs = sorted(item for item in sub_dirs
-                    if gfile.IsDirectory(item))
-  for sub_dir in sub_dirs:
-    extensions = ['jpg', 'jpeg', 'JPG', 'JPEG']
-    file_list = []
-    dir_name = os.path.basename(sub_dir)
-    if dir_name == image_dir:
-      continue
+  manifest_dirs = {}
+  hashed_count = 0
+  sub_dir_names, _ = list_image_dir(image_dir)
+  for dir_name in sub_dir_names:
+    sub_dir = os.path.join(image_dir, dir_name)
     tf.logging.info("Looking for images in '" + dir_name + "'")
-    for extension in extensions:
-      file_glob = os.path.join(image_dir, dir_name, '*.' + extension)
-      file_list.extend(gfile.Glob(file_glob))
-    if not file_list:
+    mtime = os.stat(sub_dir).st_mtime if manifest_file else None
+    known_dir = known_dirs.get(dir_name, {'mtime': None, 'images': {}})
+    if mtime is not None and known_dir['mtime'] == mtime:
+      image_categories = known_dir['images']
+    else:
+      image_categories = {}
+      for base_name in list_image_dir(sub_dir)[1]:
+        category = known_dir['images'].get(base_name)
+        if category is None:
+          category = get_image_category(os.path.join(sub_dir, base_name),
+                                        testing_percentage,
+                                        validation_percentage)
+          hashed_count += 1
+        image_categories[base_name] = category
+    manifest_dirs[dir_name] = {'mtime': mtime, 'images': image_categories}
+    if not image_categories:
       tf.logging.warning('No files found')
       continue
-    if len(file_list) < 20:
+    if len(image_categories) < 20:
       tf.logging.warning(
           'WARNING: Folder has less than 20 images, which may cause issues.')
-    elif len(file_list) > MAX_NUM_IMAGES_PER_CLASS:
+    elif len(image_categories) > MAX_NUM_IMAGES_PER_CLASS:
       tf.logging.warning(
           'WARNING: Folder {} has more than {} images. Some images will '
           'never be selected.'.format(dir_name, MAX_NUM_IMAGES_PER_CLASS))
     label_name = re.sub(r'[^a-z0-9]+', ' ', dir_name.lower())
-    training_images = []
-    testing_images = []
-    validation_images = []
-    for file_name in file_list:
-      base_name = os.path.basename(file_name)
-      # We want to ignore anything after '_nohash_' in the file name when
-      # deciding which set to put an image in, the data set creator has a way of
-      # grouping photos that are close variations of each other. For example
-      # this is used in the plant disease data set to group multiple pictures of
-      # the same leaf.
-      hash_name = re.sub(r'_nohash_.*$', '', file_name)
-      # This looks a bit magical, but we need to decide whether this file should
-      # go into the training, testing, or validation sets, and we want to keep
-      # existing files in the same set even if more files are subsequently
-      # added.
-      # To do that, we need a stable way of deciding based on just the file name
-      # itself, so we do a hash of that and then use that to generate a
-      # probability value that we use to assign it.
-      hash_name_hashed = hashlib.sha1(compat.as_bytes(hash_name)).hexdigest()
-      percentage_hash = ((int(hash_name_hashed, 16) %
-                          (MAX_NUM_IMAGES_PER_CLASS + 1)) *
-                         (100.0 / MAX_NUM_IMAGES_PER_CLASS))
-      if percentage_hash < validation_percentage:
-        validation_images.append(base_name)
-      elif percentage_hash < (testing_percentage + validation_percentage):
-        testing_images.append(base_name)
-      else:
-        training_images.append(base_name)
     result[label_name] = {
         'dir': dir_name,
-        'training': training_images,
-        'testing': testing_images,
-        'validation': validation_images,
+        'training': [],
+        'testing': [],
+        'validation': [],
     }
-  return result
+    for base_name in sorted(image_categories):
+      result[label_name][image_categories[base_name]].append(base_name)
+  tf.logging.info('Found %d images in %d folders, %d of them new' %
+                  (sum(len(known_dir['images'])
+                       for known_dir in manifest_dirs.values()),
+                   len(manifest_dirs), hashed_count))
+
+  if manifest_file and manifest_dirs != known_dirs:
+    write_image_manifest(manifest_file, {
+        'image_dir': os.path.abspath(image_dir),
+        'testing_percentage': testing_percentage,
+        'validation_percentage': validation_percentage,
+        'dirs': manifest_dirs,
+        'fingerprints': manifest.get('fingerprints', {}),
+    })
+  return ImageLists.from_dict(result)
+
+
+def save_image_fingerprints(manifest_file, image_lists, image_dir):
+  """Records the content hashes of the listed images in the image manifest.
+
+  Each hash is stored with the size and modification time of the file it was
+  computed from, so the next run only hashes the images that were added or
+  changed since. Images that are no longer listed are dropped.
+
+  Args:
+    manifest_file: Path string of the JSON manifest create_image_lists wrote.
+    image_lists: Dictionary of training images for each label.
+    image_dir: Root folder string of the subfolders containing the images.
+  """
+  if not manifest_file or not os.path.exists(manifest_file):
+    return
+  try:
+    with open(manifest_file) as f:
+      manifest = json.load(f)
+  except ValueError:
+    return
+  if (not isinstance(manifest, dict) or
+      manifest.get('image_dir') != os.path.abspath(image_dir)):
+    return
+  fingerprints = {}
+  for label_name in image_lists.keys():
+    for category in ImageLists.CATEGORIES:
+      for index in range(image_lists.count(label_name, category)):
+        image_path = get_image_path(image_lists, label_name, index, image_dir,
+                                    category)
+        if image_path in image_path_2_stat_fingerprint:
+          fingerprints[os.path.relpath(image_path, image_dir)] = (
+              image_path_2_stat_fingerprint[image_path])
+  if manifest.get('fingerprints') != fingerprints:
+    manifest['fingerprints'] = fingerprints
+    write_image_manifest(manifest_file, manifest)
+
+
+class ImageLists(object):
+  """Columnar table of the images found by create_image_lists.
+
+  Every image is a row of the table. Its base name is a slice of one bytes
+  buffer addressed by an offsets array, and its label id, category id, and
+  index within its label and category are entries of int32 arrays. Rows are
+  sorted by label, category, and index, so the images of a label in a
+  category are a contiguous run found through the `starts` and `counts`
+  tables. Compared with a dictionary of lists of strings, that takes 20 bytes
+  per image beyond the name itself and no Python objects.
+
+  The table also reads like the dictionary create_image_lists used to return:
+  image_lists[label_name]['dir'] is the label's subfolder, and
+  image_lists[label_name][category] a read-only sequence of base names.
+  """
+
+  CATEGORIES = ('training', 'testing', 'validation')
+
+  def __init__(self, label_names, label_dirs, label_ids, category_ids,
+               image_indices, name_data, name_offsets):
+    """Wraps the columns of the table.
+
+    Args:
+      label_names: List of label name strings, by label id.
+      label_dirs: List of subfolder name strings, by label id.
+      label_ids: Int32 array of the label id of each row.
+      category_ids: Int32 array of the index in CATEGORIES of each row.
+      image_indices: Int32 array of the index of each row within its label and
+      category.
+      name_data: Bytes of the UTF-8 base names of all rows, concatenated.
+      name_offsets: Int64 array of where each row's base name starts in
+      name_data, with the end of the last one appended.
+    """
+    self.label_names = list(label_names)
+    self.label_dirs = list(label_dirs)
+    self.label_ids = label_ids
+    self.category_ids = category_ids
+    self.image_indices = image_indices
+    self.name_data = name_data
+    self.name_offsets = name_offsets
+    self.label_name_2_id = dict(
+        (label_name, label_id)
+        for label_id, label_name in enumerate(self.label_names))
+    self.counts = np.zeros([len(self.label_names), len(self.CATEGORIES)],
+                           dtype=np.int64)
+    np.add.at(self.counts, (label_ids, category_ids), 1)
+    self.starts = (np.cumsum(self.counts.ravel()) -
+                   self.counts.ravel()).reshape(self.counts.shape)
+    # Plain lists of the small tables, which index faster than NumPy arrays
+    # in the per-image lookups of get_image_path.
+    self.count_table = self.counts.tolist()
+    self.start_table = self.starts.tolist()
+    self.category_2_id = dict(
+        (category, category_id)
+        for category_id, category in enumerate(self.CATEGORIES))
+    # Folder prefixes of the image paths, by root folder and label id, so each
+    # lookup only has to append the base name.
+    self.path_prefixes = {}
+
+  @staticmethod
+  def from_dict(image_lists):
+    """Builds the table from a dictionary of lists of base names.
+
+    Args:
+      image_lists: Dictionary of labels to their 'dir' and a list of base
+      names for each of CATEGORIES.
+
+    Returns:
+      ImageLists holding the same images in the same order.
+    """
+    label_ids = []
+    category_ids = []
+    image_indices = []
+    names = []
+    for label_id, label_lists in enumerate(image_lists.values()):
+      for category_id, category in enumerate(ImageLists.CATEGORIES):
+        category_list = label_lists[category]
+        label_ids.append(np.full(len(category_list), label_id, np.int32))
+        category_ids.append(np.full(len(category_list), category_id, np.int32))
+        image_indices.append(np.arange(len(category_list), dtype=np.int32))
+        names.extend(compat.as_bytes(base_name) for base_name in category_list)
+    name_offsets = np.zeros(len(names) + 1, dtype=np.int64)
+    name_offsets[1:] = np.cumsum([len(name) for name in names])
+    return ImageLists(
+        image_lists.keys(),
+        [label_lists['dir'] for label_lists in image_lists.values()],
+        np.concatenate(label_ids or [np.zeros([0], np.int32)]),
+        np.concatenate(category_ids or [np.zeros([0], np.int32)]),
+        np.concatenate(image_indices or [np.zeros([0], np.int32)]),
+        b''.join(names), name_offsets)
+
+  def to_dict(self):
+    """Returns the images as a dictionary of lists of base names."""
+    return collections.OrderedDict(
+        (label_name, dict([('dir', self[label_name]['dir'])] +
+                          [(category, list(self[label_name][category]))
+                           for category in self.CATEGORIES]))
+        for label_name in self.label_names)
+
+  def count(self, label_name, category):
+    """Returns how many images a label has in a category."""
+    return int(self.counts[self.label_name_2_id[label_name],
+                           self.CATEGORIES.index(category)])
+
+  def base_name(self, row):
+    """Returns the base name string of a row."""
+    return self.name_data[self.name_offsets[row]:
+                          self.name_offsets[row + 1]].decode('utf-8')
+
+  def get_image_path(self, label_name, index, image_dir, category):
+    """Returns the path of an image, as get_image_path does.
+
+    Args:
+      label_name: Label string we want to get an image for.
+      index: Int offset of the image we want, moduloed by the number of
+      images the label has in the category.
+      image_dir: Root folder string of the subfolders containing the images.
+      category: Name string of set to pull images from - training, testing, or
+      validation.
+
+    Returns:
+      File system path string to the image.
+    """
+    if label_name not in self.label_name_2_id:
+      tf.logging.fatal('Label does not exist %s.', label_name)
+    if category not in self.category_2_id:
+      tf.logging.fatal('Category does not exist %s.', category)
+    label_id = self.label_name_2_id[label_name]
+    category_id = self.category_2_id[category]
+    count = self.count_table[label_id][category_id]
+    if not count:
+      tf.logging.fatal('Label %s has no images in the category %s.',
+                       label_name, category)
+    row = self.start_table[label_id][category_id] + index % count
+    prefix = self.path_prefixes.get((image_dir, label_id))
+    if prefix is None:
+      prefix = os.path.join(image_dir, self.label_dirs[label_id], '')
+      self.path_prefixes[(image_dir, label_id)] = prefix
+    return prefix + self.base_name(row)
+
+  @property
+  def nbytes(self):
+    """Bytes held by the columns of the table."""
+    return (self.label_ids.nbytes + self.category_ids.nbytes +
+            self.image_indices.nbytes + len(self.name_data) +
+            self.name_offsets.nbytes + self.counts.nbytes +
+            self.starts.nbytes)
+
+  def __getitem__(self, label_name):
+    return LabelImages(self, self.label_name_2_id[label_name])
+
+  def __contains__(self, label_name):
+    return label_name in self.label_name_2_id
+
+  def __iter__(self):
+    return iter(self.label_names)
+
+  def __len__(self):
+    return len(self.label_names)
+
+  def keys(self):
+    return list(self.label_names)
+
+  def values(self):
+    return [self[label_name] for label_name in self.label_names]
+
+  def items(self):
+    return [(label_name, self[label_name]) for label_name in self.label_names]
+
+
+class LabelImages(object):
+  """Dictionary-like view of one label of an ImageLists table."""
+
+  def __init__(self, image_lists, label_id):
+    self.image_lists = image_lists
+    self.label_id = label_id
+
+  def __getitem__(self, key):
+    if key == 'dir':
+      return self.image_lists.label_dirs[self.label_id]
+    if key not in ImageLists.CATEGORIES:
+      raise KeyError(key)
+    return CategoryImages(self.image_lists, self.label_id,
+                          ImageLists.CATEGORIES.index(key))
+
+  def __contains__(self, key):
+    return key == 'dir' or key in ImageLists.CATEGORIES
+
+  def keys(self):
+    return ['dir'] + list(ImageLists.CATEGORIES)
+
+
+class CategoryImages(object):
+  """Read-only sequence view of the base names of a label in a category."""
+
+  def __init__(self, image_lists, label_id, category_id):
+    self.image_lists = image_lists
+    self.start = image_lists.starts[label_id, category_id]
+    self.count = int(image_lists.counts[label_id, category_id])
+
+  def __len__(self):
+    return self.count
+
+  def __getitem__(self, index):
+    if not -self.count <= index < self.count:
+      raise IndexError(index)
+    return self.image_lists.base_name(self.start + index % self.count)
+
+  def __iter__(self):
+    for index in range(self.count):
+      yield self[index]
 
 
 def get_image_path(image_lists, label_name, index, image_dir, category):
@@ -222,6 +613,8 @@ def get_image_path(image_lists, label_name, index, image_dir, category):
     File system path string to an image that meets the requested parameters.
 
   """
+  if isinstance(image_lists, ImageLists):
+    return image_lists.get_image_path(label_name, index, image_dir, category)
   if label_name not in image_lists:
     tf.logging.fatal('Label does not exist %s.', label_name)
   label_lists = image_lists[label_name]
@@ -238,9 +631,407 @@ def get_image_path(image_lists, label_name, index, image_dir, category):
   return full_path
 
 
+class LocalObjectStorage(object):
+  """Stand-in for the Cloud Object Storage S3 API backed by a local folder.
+
+  Each subfolder of the root is a bucket and each file under it an object,
+  keyed by its path relative to the bucket. Only the parts of the ibm_boto3
+  resource API that the bucket dataset uses are implemented, so it can be
+  exercised without credentials or network access.
+  """
+
+  # The method names follow the ibm_boto3 resource API.
+  # pylint: disable=invalid-name
+
+  def __init__(self, root):
+    self.root = root
+
+  def Bucket(self, name):
+    return LocalBucket(os.path.join(self.root, name))
+
+  def Object(self, bucket_name, key):
+    return LocalObject(os.path.join(self.root, bucket_name), key)
+
+
+class LocalBucket(object):
+  """Bucket of a LocalObjectStorage, listing its objects like ibm_boto3."""
+
+  def __init__(self, bucket_dir):
+    self.bucket_dir = bucket_dir
+    self.objects = self
+
+  def all(self):
+    for dir_path, _, file_names in os.walk(self.bucket_dir):
+      for file_name in sorted(file_names):
+        key = os.path.relpath(os.path.join(dir_path, file_name),
+                              self.bucket_dir).replace(os.sep, '/')
+        yield LocalObject(self.bucket_dir, key)
+
+
+class LocalObject(object):
+  """Object of a LocalObjectStorage, with its key, ETag, and contents."""
+
+  def __init__(self, bucket_dir, key):
+    self.key = key
+    self.path = os.path.join(bucket_dir, *key.split('/'))
+
+  @property
+  def e_tag(self):
+    with open(self.path, 'rb') as f:
+      return '"%s"' % hashlib.md5(f.read()).hexdigest()
+
+  @property
+  def size(self):
+    return os.path.getsize(self.path)
+
+  def get(self):
+    return {'Body': open(self.path, 'rb')}
+
+  def download_file(self, file_name):
+    shutil.copyfile(self.path, file_name)
+
+
+def open_object_storage(endpoint):
+  """Connects to Cloud Object Storage, or a local stand-in for it.
+
+  Credentials are read from the .Credentials file the bucket scripts use.
+
+  Args:
+    endpoint: URL string of the S3 API endpoint, or file:// and the path of
+    a folder to use a LocalObjectStorage.
+
+  Returns:
+    Object storage resource with the ibm_boto3 Bucket and Object methods.
+  """
+  if endpoint.startswith('file://'):
+    return LocalObjectStorage(endpoint[len('file://'):])
+  # These are only needed to reach the real service.
+  import ibm_boto3  # pylint: disable=g-import-not-at-top
+  from botocore.client import Config  # pylint: disable=g-import-not-at-top
+  from dotenv import load_dotenv  # pylint: disable=g-import-not-at-top
+  load_dotenv('.Credentials')
+  return ibm_boto3.resource(
+      's3',
+      ibm_api_key_id=os.getenv('API_KEY'),
+      ibm_service_instance_id=os.getenv('RESOURCE_INSTANCE_ID'),
+      ibm_auth_endpoint='https://iam.ng.bluemix.net/oidc/token',
+      config=Config(signature_version='oauth'),
+      endpoint_url=endpoint)
+
+
+class BucketImageCache(object):
+  """Size-bounded local cache of the images of a bucket, filled on demand.
+
+  Images are downloaded to their path under the cache folder the first time
+  they're read, and the least recently read ones are deleted once the cache
+  holds more than max_bytes. Files already in the folder are picked up again
+  on the next run.
+
+  prefetch() downloads a list of images ahead of the code reading them on a
+  pool of threads, at most `window` images ahead. Prefetched images aren't
+  evicted until they've been read, so the cache can go over max_bytes by up
+  to the window.
+  """
+
+  def __init__(self, storage, bucket, cache_dir, max_bytes, num_workers=8,
+               window=256):
+    """Indexes the images already in the cache folder.
+
+    Args:
+      storage: Object storage resource from open_object_storage.
+      bucket: Name string of the bucket holding the images.
+      cache_dir: Folder string to download the images into.
+      max_bytes: Integer size the cache is trimmed to.
+      num_workers: Integer number of prefetching threads.
+      window: Integer number of prefetched images that can wait to be read.
+    """
+    self.storage = storage
+    self.bucket = bucket
+    self.cache_dir = cache_dir
+    self.max_bytes = max_bytes
+    self.num_workers = num_workers
+    self.window = threading.Semaphore(max(1, window))
+    self.path_2_key = {}
+    # Cached file sizes by path, least recently read first.
+    self.entries = collections.OrderedDict()
+    self.total_bytes = 0
+    self.downloads = {}
+    # Prefetched paths that haven't been read yet, and those of them that
+    # have been downloaded.
+    self.pending_reads = set()
+    self.unread = set()
+    self.lock = threading.Lock()
+    self.how_many_downloaded = 0
+    ensure_dir_exists(cache_dir)
+    cached_files = []
+    for dir_path, _, file_names in os.walk(cache_dir):
+      for file_name in file_names:
+        path = os.path.join(dir_path, file_name)
+        if file_name.endswith('.part'):
+          os.remove(path)
+        else:
+          cached_files.append((os.path.getmtime(path), path))
+    for _, path in sorted(cached_files):
+      self.entries[path] = os.path.getsize(path)
+      self.total_bytes += self.entries[path]
+
+  def add(self, path, key):
+    """Records that a path under the cache folder holds an object."""
+    self.path_2_key[path] = key
+
+  def owns(self, path):
+    return path in self.path_2_key
+
+  def _evict(self):
+    # Called with the lock held.
+    for path in list(self.entries):
+      if self.total_bytes <= self.max_bytes:
+        break
+      if path in self.unread:
+        continue
+      self.total_bytes -= self.entries.pop(path)
+      try:
+        os.remove(path)
+      except OSError:
+        pass
+
+  def _fetch(self, path):
+    """Makes sure an image is in the cache, downloading it at most once."""
+    while True:
+      with self.lock:
+        if path in self.entries:
+          self.entries[path] = self.entries.pop(path)
+          return
+        download = self.downloads.get(path)
+        if download is None:
+          download = threading.Event()
+          self.downloads[path] = download
+          break
+      download.wait()
+    try:
+      ensure_dir_exists(os.path.dirname(path))
+      self.storage.Object(self.bucket, self.path_2_key[path]).download_file(
+          path + '.part')
+      os.rename(path + '.part', path)
+      with self.lock:
+        self.entries[path] = os.path.getsize(path)
+        self.total_bytes += self.entries[path]
+        self.how_many_downloaded += 1
+        self._evict()
+    finally:
+      with self.lock:
+        del self.downloads[path]
+      download.set()
+
+  def read(self, path):
+    """Returns the bytes of an image, downloading it first if needed."""
+    with self.lock:
+      self.pending_reads.discard(path)
+      if path in self.unread:
+        self.unread.remove(path)
+        self.window.release()
+    while True:
+      self._fetch(path)
+      try:
+        with open(path, 'rb') as f:
+          return f.read()
+      except (IOError, OSError):
+        # Evicted between the fetch and the read, so fetch it again.
+        continue
+
+  def prefetch(self, paths):
+    """Starts downloading images on background threads, in order.
+
+    Args:
+      paths: List of image path strings that are about to be read.
+    """
+
+    def prefetch_one(path):
+      # Skip images the readers got to first.
+      with self.lock:
+        if path not in self.pending_reads:
+          return
+      self.window.acquire()
+      with self.lock:
+        if path not in self.pending_reads:
+          self.window.release()
+          return
+        self.unread.add(path)
+      self._fetch(path)
+
+    with self.lock:
+      self.pending_reads.update(paths)
+
+    pipeline = ImagePipeline(paths, prefetch_one, self.num_workers,
+                             self.num_workers)
+
+    def drain():
+      for path, _ in pipeline:
+        pass
+
+    drainer = threading.Thread(target=drain)
+    drainer.daemon = True
+    drainer.start()
+
+
+# The cache create_bucket_image_lists sets up, which read_image_file fetches
+# the images of a bucket dataset through.
+bucket_image_cache = None
+
+
+def create_bucket_image_lists(storage, bucket, cache_dir, testing_percentage,
+                              validation_percentage, max_bytes, num_workers,
+                              window):
+  """Builds the image lists of a bucket from its _annotations.csv.
+
+  Each row of the annotations is an object key and its label. Labels that only
+  differ in case or punctuation are merged, under the folder name of the first
+  one seen, and a key annotated more than once with the same label is only
+  listed once. The images are listed under cache_dir/<folder>/<key>, and
+  aren't downloaded until they're read, through a BucketImageCache. Their
+  fingerprints for the bottleneck keys are the ETags from the bucket listing,
+  so finding the missing bottlenecks doesn't need the images either. The ETag
+  of a multipart upload (one with a '-' in it) isn't the MD5 of the contents,
+  so those images are downloaded and hashed instead.
+
+  Args:
+    storage: Object storage resource from open_object_storage.
+    bucket: Name string of the bucket holding the images.
+    cache_dir: Folder string to download the images into.
+    testing_percentage: Integer percentage of the images to reserve for tests.
+    validation_percentage: Integer percentage of images reserved for validation.
+    max_bytes: Integer size of the local image cache.
+    num_workers: Integer number of prefetching threads.
+    window: Integer number of prefetched images that can wait to be read.
+
+  Returns:
+    An ImageLists table with an entry for each label, to be used with
+    cache_dir as the image directory.
+  """
+  global bucket_image_cache
+  bucket_image_cache = BucketImageCache(storage, bucket, cache_dir, max_bytes,
+                                        num_workers, window)
+  with contextlib.closing(
+      storage.Object(bucket, '_annotations.csv').get()['Body']) as annotations:
+    rows = csv.reader(compat.as_str(annotations.read()).splitlines())
+  key_2_etag = dict((summary.key, summary.e_tag.strip('"'))
+                    for summary in storage.Bucket(bucket).objects.all())
+  result = collections.OrderedDict()
+  listed_paths = set()
+  how_many_missing = 0
+  for row in rows:
+    if len(row) < 2:
+      continue
+    key, label = row[0], row[1]
+    if key not in key_2_etag:
+      how_many_missing += 1
+      continue
+    label_name = re.sub(r'[^a-z0-9]+', ' ', label.lower())
+    label_lists = result.setdefault(label_name, {
+        'dir': label,
+        'training': [],
+        'testing': [],
+        'validation': [],
+    })
+    # get_image_path builds the path from the label's folder, so the first
+    # spelling of a merged label is used for all of its images.
+    image_path = os.path.join(cache_dir, label_lists['dir'], key)
+    if image_path in listed_paths:
+      continue
+    listed_paths.add(image_path)
+    category = get_image_category(os.path.join(label_lists['dir'], key),
+                                  testing_percentage, validation_percentage)
+    label_lists[category].append(key)
+    if '-' not in key_2_etag[key]:
+      image_path_2_fingerprint[image_path] = key_2_etag[key]
+    bucket_image_cache.add(image_path, key)
+  if how_many_missing:
+    tf.logging.warning('%d annotated images are missing from bucket %s' %
+                       (how_many_missing, bucket))
+  result = collections.OrderedDict(sorted(result.items()))
+  for label_name, label_lists in result.items():
+    image_count = sum(len(label_lists[category])
+                      for category in ImageLists.CATEGORIES)
+    if image_count < 20:
+      tf.logging.warning(
+          'WARNING: Label %s has less than 20 images, which may cause issues.'
+          % label_name)
+    for category in ImageLists.CATEGORIES:
+      label_lists[category].sort()
+  tf.logging.info('Found %d images of %d labels in bucket %s, %d of them '
+                  'cached locally' %
+                  (len(bucket_image_cache.path_2_key), len(result), bucket,
+                   len(bucket_image_cache.entries)))
+  return ImageLists.from_dict(result)
+
+
+def read_image_file(image_path):
+  """Returns the bytes of an image file, fetching it from a bucket if needed.
+
+  Args:
+    image_path: Path string of the image.
+
+  Returns:
+    Bytes of the encoded image.
+  """
+  if bucket_image_cache is not None and bucket_image_cache.owns(image_path):
+    return bucket_image_cache.read(image_path)
+  if not gfile.Exists(image_path):
+    tf.logging.fatal('File does not exist %s', image_path)
+  return gfile.FastGFile(image_path, 'rb').read()
+
+
+def report_image_lists(image_lists, image_dir, how_many_lookups=100000):
+  """Logs the memory and lookup time of an ImageLists against a dictionary.
+
+  The dictionary holds the same images in the lists of base name strings
+  create_image_lists used to return. Its memory is the size of every
+  container and string in it, and the lookup time is that of get_image_path
+  on random images of each layout.
+
+  Args:
+    image_lists: ImageLists returned by create_image_lists.
+    image_dir: Root folder string of the subfolders containing the images.
+    how_many_lookups: Integer number of random images to look up.
+  """
+  dict_lists = image_lists.to_dict()
+  dict_bytes = sys.getsizeof(dict_lists)
+  for label_name, label_lists in dict_lists.items():
+    dict_bytes += sys.getsizeof(label_name) + sys.getsizeof(label_lists)
+    for key, value in label_lists.items():
+      dict_bytes += sys.getsizeof(key) + sys.getsizeof(value)
+      if key != 'dir':
+        dict_bytes += sum(sys.getsizeof(base_name) for base_name in value)
+
+  rng = np.random.RandomState(0)
+  lookups = []
+  for label_name in image_lists.keys():
+    for category in ImageLists.CATEGORIES:
+      if image_lists.count(label_name, category):
+        lookups.append((label_name, category))
+  lookups = [lookups[i] + (index,) for i, index in zip(
+      rng.randint(len(lookups), size=how_many_lookups),
+      rng.randint(MAX_NUM_IMAGES_PER_CLASS, size=how_many_lookups))]
+  lookup_secs = []
+  for layout in (dict_lists, image_lists):
+    start_time = time.time()
+    for label_name, category, index in lookups:
+      get_image_path(layout, label_name, index, image_dir, category)
+    lookup_secs.append(time.time() - start_time)
+  tf.logging.info('Image lists of %d images: %.1f MB as dictionaries, %.1f MB '
+                  'as columns' % (len(image_lists.label_ids), dict_bytes / 1e6,
+                                  image_lists.nbytes / 1e6))
+  tf.logging.info('Image path lookups: %.2fus from dictionaries, %.2fus from '
+                  'columns' % (lookup_secs[0] * 1e6 / how_many_lookups,
+                               lookup_secs[1] * 1e6 / how_many_lookups))
+
+
 def get_bottleneck_path(image_lists, label_name, index, bottleneck_dir,
                         category, architecture):
-  """"Returns a path to a bottleneck file for a label at the given index.
+  """"Returns a path to a legacy text bottleneck file for a label and index.
+
+  Bottlenecks used to be cached as one comma-separated text file per image.
+  They now live in a BottleneckStore, but these files can still be imported.
 
   Args:
     image_lists: Dictionary of training images for each label.
@@ -259,57 +1050,385 @@ def get_bottleneck_path(image_lists, label_name, index, bottleneck_dir,
                         category) + '_' + architecture + '.txt'
 
 
-def create_model_graph(model_info):
+def get_file_fingerprint(file_path):
+  """"Returns the SHA-1 hex digest of a file's contents.
+
+  Args:
+    file_path: Path string of the file to hash.
+
+  Returns:
+    Hex digest string of the file's bytes.
+  """
+  file_hash = hashlib.sha1()
+  with gfile.FastGFile(file_path, 'rb') as f:
+    while True:
+      chunk = f.read(1 << 20)
+      if not chunk:
+        break
+      file_hash.update(chunk)
+  return file_hash.hexdigest()
+
+
+image_path_2_fingerprint = {}
+# Size, modification time, and content hash of local images, as loaded from
+# the image manifest and computed since.
+image_path_2_stat_fingerprint = {}
+architecture_2_model_fingerprint = {}
+architecture_2_bottleneck_inputs = {}
+
+
+def get_image_fingerprint(image_path):
+  """"Returns the content hash of an image, computing it once per process.
+
+  Local images whose size and modification time still match those recorded
+  in image_path_2_stat_fingerprint aren't read again.
+  """
+  if image_path not in image_path_2_fingerprint:
+    if bucket_image_cache is not None and bucket_image_cache.owns(image_path):
+      fingerprint = hashlib.sha1(
+          bucket_image_cache.read(image_path)).hexdigest()
+    elif '://' in image_path:
+      fingerprint = get_file_fingerprint(image_path)
+    else:
+      stat = os.stat(image_path)
+      record = image_path_2_stat_fingerprint.get(image_path)
+      if record is not None and record[:2] == [stat.st_size, stat.st_mtime]:
+        fingerprint = record[2]
+      else:
+        fingerprint = get_file_fingerprint(image_path)
+        image_path_2_stat_fingerprint[image_path] = [
+            stat.st_size, stat.st_mtime, fingerprint]
+    image_path_2_fingerprint[image_path] = fingerprint
+  return image_path_2_fingerprint[image_path]
+
+
+def get_model_fingerprint(architecture):
+  """"Returns the content hash of the frozen model file for an architecture.
+
+  Args:
+    architecture: The name of the model architecture.
+
+  Returns:
+    Hex digest string of the model file found under --model_dir.
+  """
+  if architecture not in architecture_2_model_fingerprint:
+    model_info = create_model_info(architecture)
+    model_path = os.path.join(FLAGS.model_dir, model_info['model_file_name'])
+    architecture_2_model_fingerprint[architecture] = get_file_fingerprint(
+        model_path)
+  return architecture_2_model_fingerprint[architecture]
+
+
+def get_preprocessing_description(architecture):
+  """"Describes the image preprocessing applied before the recognition graph.
+
+  Args:
+    architecture: The name of the model architecture.
+
+  Returns:
+    String listing the input size, depth, mean and std from create_model_info.
+  """
+  model_info = create_model_info(architecture)
+  return ','.join(
+      '%s=%s' % (name, model_info[name])
+      for name in ['input_width', 'input_height', 'input_depth', 'input_mean',
+                   'input_std'])
+
+
+def get_bottleneck_inputs(architecture):
+  """"Returns the fingerprints of everything besides the image a bottleneck
+  depends on.
+
+  Args:
+    architecture: The name of the model architecture.
+
+  Returns:
+    Tuple of the model file fingerprint, the preprocessing description, and a
+    short combined fingerprint of both.
+  """
+  if architecture not in architecture_2_bottleneck_inputs:
+    model_fingerprint = get_model_fingerprint(architecture)
+    preprocessing = get_preprocessing_description(architecture)
+    inputs_fingerprint = hashlib.sha1(compat.as_bytes(
+        model_fingerprint + '|' + preprocessing)).hexdigest()[:16]
+    architecture_2_bottleneck_inputs[architecture] = (
+        model_fingerprint, preprocessing, inputs_fingerprint)
+  return architecture_2_bottleneck_inputs[architecture]
+
+
+def get_bottleneck_key(image_lists, label_name, index, image_dir, category,
+                       architecture):
+  """"Returns the key identifying an image's row in a bottleneck store.
+
+  Keys are content addressed: they combine the hash of the image bytes with a
+  fingerprint of the frozen model file and the preprocessing parameters.
+  Re-downloaded, renamed, or relabelled copies of an image share a key and so
+  reuse its cached bottleneck, while a changed model file or preprocessing
+  produces new keys instead of silently reusing stale ones.
+
+  Args:
+    image_lists: Dictionary of training images for each label.
+    label_name: Label string we want to get an image for.
+    index: Integer offset of the image we want. This will be moduloed by the
+    available number of images for the label, so it can be arbitrarily large.
+    image_dir: Root folder string of the subfolders containing the training
+    images.
+    category: Name string of set to pull images from - training, testing, or
+    validation.
+    architecture: The name of the model architecture.
+
+  Returns:
+    String key for the image's bottleneck under the current model.
+  """
+  image_path = get_image_path(image_lists, label_name, index, image_dir,
+                              category)
+  return (get_image_fingerprint(image_path) + '_' +
+          get_bottleneck_inputs(architecture)[2])
+
+
+def create_model_graph(model_info, distortions=None):
   """"Creates a graph from saved GraphDef file and returns a Graph object.
 
+  The JPEG decoding operations from add_jpeg_decoding are built into the same
+  graph and wired into the model's input with input_map, so a single run goes
+  from JPEG data to bottleneck values without copying the decoded image out of
+  the runtime and back in. If distortions are given, the operations from
+  add_input_distortions are wired in the same way behind a second input, which
+  takes a whole batch of JPEGs and distorts each of them in a single run. The
+  model's input becomes a placeholder defaulting to the decoded image, so
+  batches of images decoded separately can still be fed to it directly.
+
   Args:
     model_info: Dictionary containing information about the model architecture.
+    distortions: Optional tuple of the flip_left_right, random_crop,
+    random_scale and random_brightness arguments to add_input_distortions.
 
   Returns:
     Graph holding the trained Inception network, and various tensors we'll be
-    manipulating.
+    manipulating: the bottleneck layer, the model input, the JPEG input, the
+    decoded image, and the input for batches of JPEGs to distort, which is
+    None without distortions. Feeding a batch to the distortion input makes
+    the decoded image produce the stack of distorted images instead.
   """
+  input_args = (model_info['input_width'], model_info['input_height'],
+                model_info['input_depth'], model_info['input_mean'],
+                model_info['input_std'])
   with tf.Graph().as_default() as graph:
+    with tf.name_scope(FUSED_INPUT_SCOPE):
+      if distortions:
+        jpeg_data_tensor = tf.placeholder_with_default(
+            '', shape=[], name='DecodeJPGInput')
+        distorted_jpeg_data_tensor = tf.placeholder_with_default(
+            tf.constant([], dtype=tf.string), shape=[None],
+            name='DistortJPGInput')
+
+        def distort_one(jpeg_data):
+          return add_input_distortions(
+              *(tuple(distortions) + input_args), jpeg_data=jpeg_data)[1][0]
+
+        def distort():
+          # Every image in the batch draws its own random distortions.
+          return tf.map_fn(distort_one, distorted_jpeg_data_tensor,
+                           dtype=tf.float32)
+
+        def decode():
+          return add_jpeg_decoding(*input_args, jpeg_data=jpeg_data_tensor)[1]
+
+        # Only the branch for the input that was fed is run.
+        decoded_image_tensor = tf.cond(
+            tf.size(distorted_jpeg_data_tensor) > 0, distort, decode)
+      else:
+        distorted_jpeg_data_tensor = None
+        jpeg_data_tensor, decoded_image_tensor = add_jpeg_decoding(*input_args)
+      resized_input_tensor = tf.placeholder_with_default(
+          decoded_image_tensor,
+          shape=[None, model_info['input_height'], model_info['input_width'],
+                 model_info['input_depth']],
+          name='ResizedInput')
     model_path = os.path.join(FLAGS.model_dir, model_info['model_file_name'])
     with gfile.FastGFile(model_path, 'rb') as f:
       graph_def = tf.GraphDef()
       graph_def.ParseFromString(f.read())
-      bottleneck_tensor, resized_input_tensor = (tf.import_graph_def(
+      bottleneck_tensor, = tf.import_graph_def(
           graph_def,
           name='',
-          return_elements=[
-              model_info['bottleneck_tensor_name'],
-              model_info['resized_input_tensor_name'],
-          ]))
-  return graph, bottleneck_tensor, resized_input_tensor
+          input_map={
+              model_info['resized_input_tensor_name']: resized_input_tensor,
+          },
+          return_elements=[model_info['bottleneck_tensor_name']])
+  return (graph, bottleneck_tensor, resized_input_tensor, jpeg_data_tensor,
+          decoded_image_tensor, distorted_jpeg_data_tensor)
 
 
 def run_bottleneck_on_image(sess, image_data, image_data_tensor,
-                            decoded_image_tensor, resized_input_tensor,
                             bottleneck_tensor):
   """Runs inference on an image to extract the 'bottleneck' summary layer.
 
+  The decoding operations are wired into the model's input by
+  create_model_graph, so this is a single run from JPEG data to bottleneck.
+
   Args:
     sess: Current active TensorFlow Session.
     image_data: String of raw JPEG data.
     image_data_tensor: Input data layer in the graph.
-    decoded_image_tensor: Output of initial image resizing and  preprocessing.
-    resized_input_tensor: The input node of the recognition graph.
     bottleneck_tensor: Layer before the final softmax.
 
   Returns:
     Numpy array of bottleneck values.
   """
-  # First decode the JPEG image, resize it, and rescale the pixel values.
-  resized_input_values = sess.run(decoded_image_tensor,
-                                  {image_data_tensor: image_data})
-  # Then run it through the recognition network.
   bottleneck_values = sess.run(bottleneck_tensor,
-                               {resized_input_tensor: resized_input_values})
+                               {image_data_tensor: image_data})
   bottleneck_values = np.squeeze(bottleneck_values)
   return bottleneck_values
 
 
+def decode_image(sess, image_data, image_data_tensor, decoded_image_tensor):
+  """Decodes, resizes, and rescales a single image for the recognition graph.
+
+  Args:
+    sess: Current active TensorFlow Session.
+    image_data: String of raw JPEG data.
+    image_data_tensor: Input data layer in the graph.
+    decoded_image_tensor: Output of initial image resizing and  preprocessing.
+
+  Returns:
+    Numpy array of shape [1, height, width, depth] ready to feed the network.
+  """
+  return sess.run(decoded_image_tensor, {image_data_tensor: image_data})
+
+
+def run_bottleneck_on_batch(sess, resized_input_values, resized_input_tensor,
+                            bottleneck_tensor):
+  """Runs inference on a stack of preprocessed images in a single run.
+
+  The network treats every row of the batch independently, so the results
+  match running the images one at a time through run_bottleneck_on_image. Some
+  frozen graphs hard-code a batch size of one; for those we fall back to
+  running the rows one at a time.
+
+  Args:
+    sess: Current active TensorFlow Session.
+    resized_input_values: Numpy array of decoded images, stacked on axis 0.
+    resized_input_tensor: The input node of the recognition graph.
+    bottleneck_tensor: Layer before the final softmax.
+
+  Returns:
+    Numpy array of bottleneck values, one row per image.
+  """
+  image_count = resized_input_values.shape[0]
+  try:
+    bottleneck_values = sess.run(bottleneck_tensor,
+                                 {resized_input_tensor: resized_input_values})
+  except tf.errors.InvalidArgumentError:
+    tf.logging.warning('Model graph does not support batched inference, '
+                       'running images one at a time')
+    bottleneck_values = np.concatenate([
+        sess.run(bottleneck_tensor,
+                 {resized_input_tensor: resized_input_values[i:i + 1]})
+        for i in range(image_count)])
+  return np.reshape(bottleneck_values, [image_count, -1])
+
+
+class StageTimer(object):
+  """Accumulates wall-clock time and item counts per named stage.
+
+  Stages can be timed from several threads at once, in which case their
+  totals are thread-seconds rather than elapsed time.
+  """
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.secs = collections.OrderedDict()
+    self.counts = collections.OrderedDict()
+
+  def add(self, stage, secs, count=1):
+    """Adds secs seconds spent on count items to a stage."""
+    with self.lock:
+      self.secs[stage] = self.secs.get(stage, 0.0) + secs
+      self.counts[stage] = self.counts.get(stage, 0) + count
+
+  @contextlib.contextmanager
+  def time(self, stage, count=1):
+    """Context manager timing its body as count items of a stage."""
+    start_time = time.time()
+    yield
+    self.add(stage, time.time() - start_time, count)
+
+  def summary(self):
+    """Returns a dictionary of the seconds and count of every stage."""
+    with self.lock:
+      return collections.OrderedDict(
+          (stage, {'secs': self.secs[stage], 'count': self.counts[stage]})
+          for stage in self.secs)
+
+
+class ImagePipeline(object):
+  """Loads images on background threads, ahead of the code consuming them.
+
+  A pool of worker threads pulls items from a shared iterator, runs load_fn on
+  each one (typically reading the file and decoding it) and puts the result on
+  a bounded queue. Iterating over the pipeline yields (item, result) pairs in
+  the order they finish, so file I/O and decoding overlap with whatever the
+  consumer does with the previous results, such as the forward pass. The time
+  the consumer spends blocked on the queue is recorded in input_wait_secs, so
+  it can be compared with the time spent on compute.
+  """
+
+  def __init__(self, items, load_fn, num_workers=4, queue_size=64):
+    """Starts the worker threads.
+
+    Args:
+      items: Iterable of work items to pass to load_fn.
+      load_fn: Function taking an item and returning its loaded result.
+      num_workers: Integer number of reader/decoder threads.
+      queue_size: Integer maximum number of loaded results waiting to be
+      consumed.
+    """
+    self.load_fn = load_fn
+    self.items = iter(items)
+    self.items_lock = threading.Lock()
+    self.results = queue.Queue(maxsize=max(1, queue_size))
+    self.num_workers = max(1, num_workers)
+    self.input_wait_secs = 0.0
+    self.workers = []
+    for _ in range(self.num_workers):
+      worker = threading.Thread(target=self._work)
+      worker.daemon = True
+      worker.start()
+      self.workers.append(worker)
+
+  def _next_item(self):
+    with self.items_lock:
+      return next(self.items)
+
+  def _work(self):
+    while True:
+      try:
+        item = self._next_item()
+      except StopIteration:
+        break
+      try:
+        self.results.put((item, self.load_fn(item), None))
+      except Exception as e:  # pylint: disable=broad-except
+        self.results.put((item, None, e))
+    self.results.put(None)
+
+  def __iter__(self):
+    finished_workers = 0
+    while finished_workers < self.num_workers:
+      start_time = time.time()
+      entry = self.results.get()
+      self.input_wait_secs += time.time() - start_time
+      if entry is None:
+        finished_workers += 1
+        continue
+      item, result, error = entry
+      if error is not None:
+        raise RuntimeError('Error during loading %s (%s)' % (str(item),
+                                                            str(error)))
+      yield item, result
+
+
 def maybe_download_and_extract(data_url):
   """Download and extract model tar file.
 
@@ -350,40 +1469,452 @@ def ensure_dir_exists(dir_name):
     os.makedirs(dir_name)
 
 
-bottleneck_path_2_bottleneck_values = {}
+BOTTLENECK_PRECISIONS = ('float32', 'float16', 'int8')
+
 
+def quantize_bottlenecks(values, precision):
+  """Converts float32 bottleneck rows to a storage precision.
 
-def create_bottleneck_file(bottleneck_path, image_lists, label_name, index,
-                           image_dir, category, sess, jpeg_data_tensor,
-                           decoded_image_tensor, resized_input_tensor,
-                           bottleneck_tensor):
-  """Create a single bottleneck file."""
-  tf.logging.info('Creating bottleneck at ' + bottleneck_path)
+  int8 rows are scaled per vector so that the largest magnitude in each row
+  maps to 127, and the scale is returned alongside them.
+
+  Args:
+    values: Float array of bottleneck rows, shape [N, bottleneck size].
+    precision: Name string of the precision, one of BOTTLENECK_PRECISIONS.
+
+  Returns:
+    Tuple of the converted rows and a float32 array of per-row scales, or None
+    for the scales when the precision doesn't use them.
+  """
+  values = np.asarray(values, dtype=np.float32)
+  if precision == 'float32':
+    return values, None
+  if precision == 'float16':
+    return values.astype(np.float16), None
+  scales = np.max(np.abs(values), axis=1) / 127.0
+  scales[scales == 0] = 1.0
+  quantized = np.clip(np.round(values / scales[:, None]), -127, 127)
+  return quantized.astype(np.int8), scales.astype(np.float32)
+
+
+def dequantize_bottlenecks(stored, scales):
+  """Converts stored bottleneck rows back to float32.
+
+  Args:
+    stored: Array of bottleneck rows in their storage precision.
+    scales: Float32 array of per-row scales for int8 rows, or None.
+
+  Returns:
+    Float32 array of bottleneck rows. float32 input is returned as is, without
+    a copy.
+  """
+  values = stored.astype(np.float32, copy=False)
+  if scales is not None:
+    values = values * scales[:, None]
+  return values
+
+
+class BottleneckStore(object):
+  """A contiguous, memory-mapped matrix of bottleneck values for one split.
+
+  Rather than one comma-separated text file per image, every bottleneck for an
+  architecture and category is kept as a row of a single matrix in NumPy's .npy
+  format, memory-mapped from disk. A small text index next to it lists the key
+  of each row, one per line. Looking up an image is a dictionary access, and
+  float32 values come back as a view of the mapped matrix with no parsing or
+  copying.
+
+  The matrix can also be kept in float16, or in int8 with a float32 scale per
+  row stored in a second file, which cuts disk and memory use by 2x or nearly
+  4x. Rows are dequantized back to float32 when they are read.
+
+  The index doubles as the cache manifest: after each key, tab separated, it
+  records the image fingerprint, the model fingerprint and the preprocessing
+  parameters the vector was calculated with, so stale and orphaned rows can be
+  told apart and removed by compact().
+
+  Rows past the end of the index are unused capacity; the matrix file grows by
+  doubling so that appending stays cheap. The index is only rewritten on
+  flush(), so rows written after the last flush are simply recomputed if the
+  process dies.
+  """
+
+  def __init__(self, bottleneck_dir, architecture, category,
+               precision='float32'):
+    """Opens the store for a split, loading any existing index and matrix.
+
+    Args:
+      bottleneck_dir: Folder string holding the bottleneck stores.
+      architecture: The name of the model architecture.
+      category: Name string of the set - training, testing, or validation.
+      precision: Name string of the storage precision, one of
+      BOTTLENECK_PRECISIONS.
+
+    Raises:
+      ValueError: If the precision is unknown.
+    """
+    if precision not in BOTTLENECK_PRECISIONS:
+      raise ValueError('Unknown bottleneck precision', precision)
+    base_name = 'bottlenecks_' + architecture + '_' + category
+    if precision != 'float32':
+      base_name += '_' + precision
+    self.architecture = architecture
+    self.precision = precision
+    self.matrix_path = os.path.join(bottleneck_dir, base_name + '.npy')
+    self.scales_path = os.path.join(bottleneck_dir, base_name + '.scales.npy')
+    self.index_path = os.path.join(bottleneck_dir, base_name + '.index')
+    self.keys = []
+    self.manifest = []
+    self.key_2_row = {}
+    self.matrix = None
+    self.scales = None
+    self.dirty = False
+    # Serializes writers, such as the batch producer threads during training.
+    self.lock = threading.Lock()
+    if os.path.exists(self.index_path) and os.path.exists(self.matrix_path):
+      with open(self.index_path, 'r') as index_file:
+        lines = index_file.read().splitlines()
+      matrix = np.load(self.matrix_path, mmap_mode='r+')
+      scales = None
+      if precision == 'int8' and os.path.exists(self.scales_path):
+        scales = np.load(self.scales_path, mmap_mode='r+')
+      if (matrix.ndim != 2 or matrix.shape[0] < len(lines) or
+          matrix.dtype != np.dtype(precision) or
+          (precision == 'int8' and
+           (scales is None or scales.shape[0] < len(lines)))):
+        tf.logging.warning('Bottleneck store %s is inconsistent with its '
+                           'index, recreating it', self.matrix_path)
+      else:
+        self.keys = [line.split('\t', 1)[0] for line in lines]
+        self.manifest = [line.split('\t')[1:] for line in lines]
+        self.key_2_row = dict((key, row) for row, key in enumerate(self.keys))
+        self.matrix = matrix
+        self.scales = scales
+
+  def __len__(self):
+    return len(self.keys)
+
+  def __contains__(self, key):
+    return key in self.key_2_row
+
+  def row(self, key):
+    """Returns the integer row holding the values for a key."""
+    return self.key_2_row[key]
+
+  def get(self, key):
+    """Returns the float32 bottleneck for a key.
+
+    For float32 stores this is a view of the mapped matrix.
+    """
+    row = self.key_2_row[key]
+    return self.rows(slice(row, row + 1))[0]
+
+  def raw_rows(self, rows):
+    """Returns stored rows in their storage precision, with their scales.
+
+    Args:
+      rows: Integer array or slice selecting the rows.
+
+    Returns:
+      Tuple of the stored rows and their float32 scales, or None for the
+      scales when the precision doesn't use them.
+    """
+    if self.scales is None:
+      return self.matrix[rows], None
+    return self.matrix[rows], self.scales[rows]
+
+  def rows(self, rows):
+    """Returns the float32 bottlenecks for an array of row indices."""
+    return dequantize_bottlenecks(*self.raw_rows(rows))
+
+  def put(self, key, values):
+    """Stores the bottleneck for a key, appending a new row if needed.
+
+    Args:
+      key: String key identifying the image.
+      values: Sequence of floats produced by the bottleneck layer.
+
+    Returns:
+      The integer row the values were written to.
+    """
+    stored, scales = quantize_bottlenecks(
+        np.reshape(values, [1, -1]), self.precision)
+    return self.put_stored(key, stored[0],
+                           None if scales is None else scales[0])
+
+  def put_stored(self, key, stored, scale=None):
+    """Stores a bottleneck that is already in the store's precision.
+
+    Args:
+      key: String key identifying the image.
+      stored: Array of bottleneck values, as returned by quantize_bottlenecks.
+      scale: Float scale of the row for int8 stores, otherwise None.
+
+    Returns:
+      The integer row the values were written to.
+    """
+    model_fingerprint, preprocessing, _ = get_bottleneck_inputs(
+        self.architecture)
+    manifest_entry = [key.split('_', 1)[0], model_fingerprint, preprocessing]
+    with self.lock:
+      row = self.key_2_row.get(key)
+      if row is None:
+        row = len(self.keys)
+        self.reserve(row + 1, stored.shape[0])
+        self.keys.append(key)
+        self.manifest.append(manifest_entry)
+        self.key_2_row[key] = row
+      else:
+        self.manifest[row] = manifest_entry
+      self.matrix[row] = stored
+      if scale is not None:
+        self.scales[row] = scale
+      self.dirty = True
+    return row
+
+  def _replace_files(self, row_count, bottleneck_size, keep_rows):
+    """Writes new matrix and scale files holding the given rows."""
+    ensure_dir_exists(os.path.dirname(self.matrix_path))
+    new_matrix = np.lib.format.open_memmap(
+        self.matrix_path + '.tmp', mode='w+', dtype=np.dtype(self.precision),
+        shape=(row_count, bottleneck_size))
+    new_matrix[:len(keep_rows)] = self.matrix[keep_rows]
+    new_matrix.flush()
+    os.rename(self.matrix_path + '.tmp', self.matrix_path)
+    self.matrix = new_matrix
+    if self.precision == 'int8':
+      new_scales = np.lib.format.open_memmap(
+          self.scales_path + '.tmp', mode='w+', dtype=np.float32,
+          shape=(row_count,))
+      if self.scales is not None:
+        new_scales[:len(keep_rows)] = self.scales[keep_rows]
+      new_scales.flush()
+      os.rename(self.scales_path + '.tmp', self.scales_path)
+      self.scales = new_scales
+
+  def reserve(self, row_count, bottleneck_size):
+    """Makes sure the matrix file has room for at least row_count rows.
+
+    Args:
+      row_count: Integer number of rows that must fit in the matrix.
+      bottleneck_size: How many entries in the bottleneck vector.
+
+    Raises:
+      ValueError: If the store already holds vectors of a different size.
+    """
+    if self.matrix is None:
+      self.matrix = np.zeros([0, bottleneck_size], dtype=self.precision)
+      self.scales = None
+    if self.matrix.shape[1] != bottleneck_size:
+      raise ValueError('Bottleneck store %s holds vectors of size %d, not %d'
+                       % (self.matrix_path, self.matrix.shape[1],
+                          bottleneck_size))
+    if self.matrix.shape[0] >= row_count:
+      return
+    row_count = max(row_count, 2 * self.matrix.shape[0])
+    self._replace_files(row_count, bottleneck_size,
+                        np.arange(len(self.keys)))
+    self.dirty = True
+
+  def flush(self):
+    """Writes pending rows and the row index to disk."""
+    if not self.dirty:
+      return
+    self.matrix.flush()
+    if self.scales is not None:
+      self.scales.flush()
+    new_path = self.index_path + '.tmp'
+    with open(new_path, 'w') as index_file:
+      index_file.write(''.join(
+          '\t'.join([key] + manifest_entry) + '\n'
+          for key, manifest_entry in zip(self.keys, self.manifest)))
+    os.rename(new_path, self.index_path)
+    self.dirty = False
+
+  def disk_bytes(self):
+    """Returns the number of bytes the store takes up on disk."""
+    return sum(os.path.getsize(path)
+               for path in [self.matrix_path, self.scales_path,
+                            self.index_path]
+               if os.path.exists(path))
+
+  def compact(self, live_keys):
+    """Drops every row whose key isn't in live_keys and trims spare capacity.
+
+    The surviving rows are copied into a new matrix file of exactly the right
+    size, so after compaction the store takes no more disk than its live
+    vectors.
+
+    Args:
+      live_keys: Set of key strings that are still in use.
+
+    Returns:
+      Integer count of the rows removed.
+    """
+    keep_rows = [row for row, key in enumerate(self.keys) if key in live_keys]
+    removed = len(self.keys) - len(keep_rows)
+    if self.matrix is None or (
+        removed == 0 and self.matrix.shape[0] == len(self.keys)):
+      return removed
+    keys = [self.keys[row] for row in keep_rows]
+    manifest = [self.manifest[row] for row in keep_rows]
+    if not keep_rows:
+      self.matrix = None
+      self.scales = None
+      for path in [self.matrix_path, self.scales_path, self.index_path]:
+        if os.path.exists(path):
+          os.remove(path)
+    else:
+      self._replace_files(len(keep_rows), self.matrix.shape[1],
+                          np.array(keep_rows, dtype=np.int64))
+    self.keys = keys
+    self.manifest = manifest
+    self.key_2_row = dict((key, row) for row, key in enumerate(keys))
+    self.dirty = bool(keys)
+    self.flush()
+    return removed
+
+
+bottleneck_stores = {}
+
+
+def get_bottleneck_store(bottleneck_dir, category, architecture, precision):
+  """Returns the shared BottleneckStore for a split, opening it if needed.
+
+  Args:
+    bottleneck_dir: Folder string holding the bottleneck stores.
+    category: Name string of the set - training, testing, or validation.
+    architecture: The name of the model architecture.
+    precision: Name string of the bottleneck storage precision, one of
+    BOTTLENECK_PRECISIONS.
+
+  Returns:
+    The BottleneckStore for the architecture, category and precision.
+  """
+  store_key = (bottleneck_dir, architecture, category, precision)
+  if store_key not in bottleneck_stores:
+    bottleneck_stores[store_key] = BottleneckStore(
+        bottleneck_dir, architecture, category, precision)
+  return bottleneck_stores[store_key]
+
+
+def flush_bottleneck_stores():
+  """Writes every open bottleneck store to disk."""
+  for store in bottleneck_stores.values():
+    store.flush()
+
+
+def copy_cached_bottleneck(store, key, bottleneck_dir, architecture,
+                           precision):
+  """Copies a bottleneck cached in another split's store into this one.
+
+  Split assignment depends on the file name, so a renamed image can move to a
+  different split while keeping the same content-addressed key.
+
+  Args:
+    store: The BottleneckStore that should hold the key.
+    key: String key of the bottleneck to look for.
+    bottleneck_dir: Folder string holding the bottleneck stores.
+    architecture: The name of the model architecture.
+    precision: Name string of the bottleneck storage precision.
+
+  Returns:
+    True if the key was found in another split and copied, False otherwise.
+  """
+  for category in ['training', 'testing', 'validation']:
+    other_store = get_bottleneck_store(bottleneck_dir, category, architecture,
+                                       precision)
+    if other_store is not store and key in other_store:
+      store.put(key, other_store.get(key))
+      return True
+  return False
+
+
+def import_text_bottleneck(store, key, bottleneck_path):
+  """Copies a legacy comma-separated bottleneck file into a store.
+
+  Args:
+    store: The BottleneckStore to import into.
+    key: String key the values should be stored under.
+    bottleneck_path: Path string of the legacy text file.
+
+  Returns:
+    True if the file existed and was imported, False otherwise.
+  """
+  if not os.path.exists(bottleneck_path):
+    return False
+  with open(bottleneck_path, 'r') as bottleneck_file:
+    bottleneck_string = bottleneck_file.read()
+  try:
+    bottleneck_values = [float(x) for x in bottleneck_string.split(',')]
+  except ValueError:
+    tf.logging.warning('Invalid float found in %s, recreating bottleneck',
+                       bottleneck_path)
+    return False
+  store.put(key, bottleneck_values)
+  return True
+
+
+def import_text_bottlenecks(image_lists, image_dir, bottleneck_dir,
+                            architecture, precision):
+  """Imports every legacy text bottleneck file into the bottleneck stores.
+
+  Args:
+    image_lists: Dictionary of training images for each label.
+    image_dir: Root folder string of the subfolders containing the training
+    images.
+    bottleneck_dir: Folder string holding cached files of bottleneck values.
+    architecture: The name of the model architecture.
+    precision: Name string of the bottleneck storage precision.
+
+  Returns:
+    Integer count of the bottlenecks imported.
+  """
+  how_many_imported = 0
+  for label_name, label_lists in image_lists.items():
+    for category in ['training', 'testing', 'validation']:
+      store = get_bottleneck_store(bottleneck_dir, category, architecture,
+                                   precision)
+      for index, unused_base_name in enumerate(label_lists[category]):
+        key = get_bottleneck_key(image_lists, label_name, index, image_dir,
+                                 category, architecture)
+        if key in store:
+          continue
+        bottleneck_path = get_bottleneck_path(image_lists, label_name, index,
+                                              bottleneck_dir, category,
+                                              architecture)
+        if import_text_bottleneck(store, key, bottleneck_path):
+          how_many_imported += 1
+  flush_bottleneck_stores()
+  return how_many_imported
+
+
+def create_bottleneck(store, key, image_lists, label_name, index, image_dir,
+                      category, sess, jpeg_data_tensor, bottleneck_tensor):
+  """Calculates a single bottleneck and writes it to the store."""
+  tf.logging.info('Creating bottleneck for ' + key)
   image_path = get_image_path(image_lists, label_name, index,
                               image_dir, category)
-  if not gfile.Exists(image_path):
-    tf.logging.fatal('File does not exist %s', image_path)
-  image_data = gfile.FastGFile(image_path, 'rb').read()
+  image_data = read_image_file(image_path)
   try:
     bottleneck_values = run_bottleneck_on_image(
-        sess, image_data, jpeg_data_tensor, decoded_image_tensor,
-        resized_input_tensor, bottleneck_tensor)
+        sess, image_data, jpeg_data_tensor, bottleneck_tensor)
   except Exception as e:
     raise RuntimeError('Error during processing file %s (%s)' % (image_path,
                                                                  str(e)))
-  bottleneck_string = ','.join(str(x) for x in bottleneck_values)
-  with open(bottleneck_path, 'w') as bottleneck_file:
-    bottleneck_file.write(bottleneck_string)
+  store.put(key, bottleneck_values)
 
 
 def get_or_create_bottleneck(sess, image_lists, label_name, index, image_dir,
                              category, bottleneck_dir, jpeg_data_tensor,
                              decoded_image_tensor, resized_input_tensor,
-                             bottleneck_tensor, architecture):
+                             bottleneck_tensor, architecture, precision):
   """Retrieves or calculates bottleneck values for an image.
 
-  If a cached version of the bottleneck data exists on-disk, return that,
-  otherwise calculate the data and save it to disk for future use.
+  If the bottleneck is already in the store for its split, return that. If
+  the same image content was cached under another split, or a legacy text file
+  exists for it, copy that into the store. Otherwise calculate the data and add
+  it to the store for future use.
 
   Args:
     sess: The current active TensorFlow Session.
@@ -395,214 +1926,1355 @@ def get_or_create_bottleneck(sess, image_lists, label_name, index, image_dir,
     images.
     category: Name string of which  set to pull images from - training, testing,
     or validation.
-    bottleneck_dir: Folder string holding cached files of bottleneck values.
+    bottleneck_dir: Folder string holding the bottleneck stores.
     jpeg_data_tensor: The tensor to feed loaded jpeg data into.
     decoded_image_tensor: The output of decoding and resizing the image.
     resized_input_tensor: The input node of the recognition graph.
     bottleneck_tensor: The output tensor for the bottleneck values.
     architecture: The name of the model architecture.
+    precision: Name string of the bottleneck storage precision.
+
+  Returns:
+    Numpy array of values produced by the bottleneck layer for the image, as a
+    view of the store's matrix.
+  """
+  store = get_bottleneck_store(bottleneck_dir, category, architecture,
+                               precision)
+  key = get_bottleneck_key(image_lists, label_name, index, image_dir, category,
+                           architecture)
+  if key not in store and not copy_cached_bottleneck(store, key, bottleneck_dir,
+                                                     architecture, precision):
+    bottleneck_path = get_bottleneck_path(image_lists, label_name, index,
+                                          bottleneck_dir, category,
+                                          architecture)
+    if not import_text_bottleneck(store, key, bottleneck_path):
+      create_bottleneck(store, key, image_lists, label_name, index, image_dir,
+                        category, sess, jpeg_data_tensor, bottleneck_tensor)
+  return store.get(key)
+
+
+def cache_bottlenecks(sess, image_lists, image_dir, bottleneck_dir,
+                      jpeg_data_tensor, decoded_image_tensor,
+                      resized_input_tensor, bottleneck_tensor, architecture,
+                      precision, batch_size=1, num_workers=4, queue_size=64):
+  """Ensures all the training, testing, and validation bottlenecks are cached.
+
+  Because we're likely to read the same image multiple times (if there are no
+  distortions applied during training) it can speed things up a lot if we
+  calculate the bottleneck layer values once for each image during
+  preprocessing, and then just read those cached values repeatedly during
+  training. Here we go through all the images we've found, calculate those
+  values, and save them off into one memory-mapped store per split.
+
+  Bottlenecks are keyed by image content, so an image that appears several
+  times, in any split, is only run through the network once.
+
+  Images that still need a bottleneck are read and decoded by an ImagePipeline
+  on num_workers threads, while this thread gathers the decoded images into
+  batches of batch_size and sends each batch through the network in one run.
+  At the end we log how long the forward pass was stalled waiting for input
+  compared with the time spent computing, and write the timings to
+  --cache_summary_file. If nothing had to be calculated, the file is left
+  alone, so the summary of cache_bottlenecks_in_parallel isn't overwritten.
+
+  Args:
+    sess: The current active TensorFlow Session.
+    image_lists: Dictionary of training images for each label.
+    image_dir: Root folder string of the subfolders containing the training
+    images.
+    bottleneck_dir: Folder string holding the bottleneck stores.
+    jpeg_data_tensor: Input tensor for jpeg data from file.
+    decoded_image_tensor: The output of decoding and resizing the image.
+    resized_input_tensor: The input node of the recognition graph.
+    bottleneck_tensor: The penultimate output layer of the graph.
+    architecture: The name of the model architecture.
+    precision: Name string of the bottleneck storage precision.
+    batch_size: Integer number of images to run through the network at once.
+    num_workers: Integer number of threads reading and decoding images.
+    queue_size: Integer number of decoded images to buffer ahead of the
+    network.
+
+  Returns:
+    Nothing.
+  """
+  pending = find_missing_bottlenecks(image_lists, image_dir, bottleneck_dir,
+                                     architecture, precision)
+  summary = create_missing_bottlenecks(
+      sess, list(pending.items()), jpeg_data_tensor, decoded_image_tensor,
+      resized_input_tensor, bottleneck_tensor, batch_size, num_workers,
+      queue_size)
+  if summary['images']:
+    write_cache_summary(summary, FLAGS.cache_summary_file)
+
+
+def find_missing_bottlenecks(image_lists, image_dir, bottleneck_dir,
+                             architecture, precision):
+  """Finds the images whose bottlenecks are not in their split's store yet.
+
+  Bottlenecks cached under another split, or as legacy text files, are copied
+  into the right store along the way, so only images that really need a
+  forward pass are returned.
+
+  Args:
+    image_lists: Dictionary of training images for each label.
+    image_dir: Root folder string of the subfolders containing the training
+    images.
+    bottleneck_dir: Folder string holding the bottleneck stores.
+    architecture: The name of the model architecture.
+    precision: Name string of the bottleneck storage precision.
+
+  Returns:
+    OrderedDict mapping each missing key to a tuple of the path of an image
+    with that content and the list of stores that need the key.
+  """
+  ensure_dir_exists(bottleneck_dir)
+  pending = collections.OrderedDict()
+  how_many_hits = 0
+  how_many_misses = 0
+  for label_name, label_lists in image_lists.items():
+    for category in ['training', 'testing', 'validation']:
+      store = get_bottleneck_store(bottleneck_dir, category, architecture,
+                                   precision)
+      category_list = label_lists[category]
+      for index, unused_base_name in enumerate(category_list):
+        key = get_bottleneck_key(image_lists, label_name, index, image_dir,
+                                 category, architecture)
+        if key in store or copy_cached_bottleneck(store, key, bottleneck_dir,
+                                                  architecture, precision):
+          how_many_hits += 1
+          continue
+        bottleneck_path = get_bottleneck_path(image_lists, label_name, index,
+                                              bottleneck_dir, category,
+                                              architecture)
+        if import_text_bottleneck(store, key, bottleneck_path):
+          how_many_hits += 1
+        else:
+          how_many_misses += 1
+          image_path = get_image_path(image_lists, label_name, index,
+                                      image_dir, category)
+          pending.setdefault(key, (image_path, []))[1].append(store)
+  flush_bottleneck_stores()
+  tf.logging.info('Bottleneck cache: %d hits, %d misses (%d distinct images '
+                  'to calculate)' % (how_many_hits, how_many_misses,
+                                     len(pending)))
+  return pending
+
+
+def create_missing_bottlenecks(sess, pending_items, jpeg_data_tensor,
+                               decoded_image_tensor, resized_input_tensor,
+                               bottleneck_tensor, batch_size=1, num_workers=4,
+                               queue_size=64):
+  """Calculates bottlenecks for a list of images and writes them to stores.
+
+  The time spent reading files, decoding and resizing images, running the
+  network, converting the results to the storage precision, and writing them
+  to the stores is measured separately. While running we log a rolling
+  images/sec rate and an ETA, and at the end we log the breakdown and return
+  it, so a slow cache build can be traced to disk, decoding or compute.
+
+  With a batch size of one, the worker threads only read the files and each
+  image goes from JPEG data to bottleneck in a single fused run, so its
+  decoding is timed as part of the forward stage.
+
+  Args:
+    sess: The current active TensorFlow Session.
+    pending_items: List of (key, (image_path, stores)) tuples, as produced by
+    find_missing_bottlenecks.
+    jpeg_data_tensor: Input tensor for jpeg data from file.
+    decoded_image_tensor: The output of decoding and resizing the image.
+    resized_input_tensor: The input node of the recognition graph.
+    bottleneck_tensor: The penultimate output layer of the graph.
+    batch_size: Integer number of images to run through the network at once.
+    num_workers: Integer number of threads reading and decoding images.
+    queue_size: Integer number of decoded images to buffer ahead of the
+    network.
+
+  Returns:
+    Dictionary summarizing the run: image count, wall time, images/sec, time
+    stalled on input, and the seconds and item count of each stage. The read
+    and decode stages run on several threads, so their times are summed
+    across threads.
+  """
+  timer = StageTimer()
+  start_time = time.time()
+  how_many_bottlenecks = 0
+  how_many_total = len(pending_items)
+  input_wait_secs = 0.0
+  if pending_items:
+
+    fused = batch_size == 1
+
+    def load_image(entry):
+      _, (image_path, _) = entry
+      with timer.time('read'):
+        image_data = read_image_file(image_path)
+      if fused:
+        return image_data
+      with timer.time('decode'):
+        return decode_image(sess, image_data, jpeg_data_tensor,
+                            decoded_image_tensor)
+
+    batch = []
+    # (time, images created) pairs over the last few batches, for the rate.
+    recent = collections.deque([(start_time, 0)], maxlen=20)
+    if bucket_image_cache is not None:
+      # Download the images of a bucket dataset ahead of the readers.
+      bucket_image_cache.prefetch(
+          [image_path for _, (image_path, _) in pending_items
+           if bucket_image_cache.owns(image_path)])
+    pipeline = ImagePipeline(pending_items, load_image, num_workers,
+                             queue_size)
+
+    def run_batch():
+      with timer.time('forward', len(batch)):
+        if fused:
+          bottleneck_values = [run_bottleneck_on_image(
+              sess, batch[0][1], jpeg_data_tensor, bottleneck_tensor)]
+        else:
+          bottleneck_values = run_bottleneck_on_batch(
+              sess, np.concatenate([values for _, values in batch]),
+              resized_input_tensor, bottleneck_tensor)
+      for ((key, (_, stores)), _), values in zip(batch, bottleneck_values):
+        for store in stores:
+          with timer.time('serialize'):
+            stored, scales = quantize_bottlenecks(values[None, :],
+                                                  store.precision)
+          with timer.time('write'):
+            store.put_stored(key, stored[0],
+                             None if scales is None else scales[0])
+
+    for entry, image_input in pipeline:
+      batch.append((entry, image_input))
+      if len(batch) < batch_size and (how_many_bottlenecks + len(batch) <
+                                      how_many_total):
+        continue
+      run_batch()
+      how_many_bottlenecks += len(batch)
+      batch = []
+      now = time.time()
+      recent.append((now, how_many_bottlenecks))
+      if how_many_bottlenecks % 100 < batch_size:
+        rate = ((recent[-1][1] - recent[0][1]) /
+                max(recent[-1][0] - recent[0][0], 1e-6))
+        tf.logging.info(
+            '%d/%d bottlenecks created, %.1f images/sec, ETA %.0fs' %
+            (how_many_bottlenecks, how_many_total, rate,
+             (how_many_total - how_many_bottlenecks) / max(rate, 1e-6)))
+      if how_many_bottlenecks % 1000 < batch_size:
+        with timer.time('write', 0):
+          flush_bottleneck_stores()
+    input_wait_secs = pipeline.input_wait_secs
+  with timer.time('write', 0):
+    flush_bottleneck_stores()
+  wall_secs = time.time() - start_time
+  summary = collections.OrderedDict([
+      ('images', how_many_bottlenecks),
+      ('wall_secs', wall_secs),
+      ('images_per_sec', how_many_bottlenecks / max(wall_secs, 1e-6)),
+      ('input_wait_secs', input_wait_secs),
+      ('batch_size', batch_size),
+      ('decode_workers', num_workers),
+      ('stages', timer.summary()),
+  ])
+  if how_many_bottlenecks:
+    tf.logging.info(
+        'Created %d bottlenecks in %.1fs (%.1f images/sec), %.1fs stalled on '
+        'input. Stage times: %s' %
+        (how_many_bottlenecks, wall_secs, summary['images_per_sec'],
+         input_wait_secs,
+         ', '.join('%s %.1fs' % (stage, stats['secs'])
+                   for stage, stats in summary['stages'].items())))
+  return summary
+
+
+def write_cache_summary(summary, summary_file):
+  """Writes a bottleneck caching summary to a JSON file.
+
+  Args:
+    summary: Dictionary returned by create_missing_bottlenecks, or a
+    dictionary of them.
+    summary_file: Path string of the JSON file, or empty to skip writing.
+  """
+  if not summary_file:
+    return
+  ensure_dir_exists(os.path.dirname(summary_file) or '.')
+  with gfile.FastGFile(summary_file, 'w') as f:
+    f.write(json.dumps(summary, indent=2))
+
+
+def cache_bottleneck_shard(shard_args):
+  """Calculates one shard of the missing bottlenecks in a worker process.
+
+  The worker loads the model graph in its own session, with its intra-op
+  thread pool pinned to the requested size, and writes its results to a shard
+  store of its own. Keys already present in the shard, from an interrupted
+  earlier run, are skipped.
+
+  Args:
+    shard_args: Tuple of the parsed flags, the integer shard index, the list
+    of (key, image_path) pairs to calculate, the integer thread count, and
+    the name string of the bottleneck storage precision.
+
+  Returns:
+    Tuple of the shard index and the summary from create_missing_bottlenecks.
+  """
+  global FLAGS
+  FLAGS, shard_index, entries, threads, precision = shard_args
+  tf.logging.set_verbosity(tf.logging.INFO)
+  model_info = create_model_info(FLAGS.architecture)
+  (graph, bottleneck_tensor, resized_input_tensor, jpeg_data_tensor,
+   decoded_image_tensor, _) = create_model_graph(model_info)
+  config = tf.ConfigProto(intra_op_parallelism_threads=threads,
+                          inter_op_parallelism_threads=threads)
+  with tf.Session(graph=graph, config=config) as sess:
+    store = get_bottleneck_store(FLAGS.bottleneck_dir,
+                                 'shard' + str(shard_index),
+                                 FLAGS.architecture, precision)
+    pending_items = [(key, (image_path, [store]))
+                     for key, image_path in entries if key not in store]
+    summary = create_missing_bottlenecks(
+        sess, pending_items, jpeg_data_tensor, decoded_image_tensor,
+        resized_input_tensor, bottleneck_tensor, FLAGS.bottleneck_batch_size,
+        FLAGS.decode_workers, FLAGS.prefetch_queue_size)
+    store.flush()
+  return shard_index, summary
+
+
+def cache_bottlenecks_in_parallel(image_lists, image_dir, bottleneck_dir,
+                                  architecture, precision, num_workers,
+                                  threads_per_worker):
+  """Caches the missing bottlenecks using several worker processes.
+
+  The images that still need a bottleneck are partitioned round-robin across
+  num_workers processes, each running cache_bottleneck_shard with its own
+  session and shard store. Once they all finish, the shards are merged into
+  the stores of the splits that need each key and deleted.
+
+  This should be called before the parent process creates its own session;
+  workers are started with the 'spawn' method where it is available so they
+  don't inherit any TensorFlow runtime state.
+
+  Args:
+    image_lists: Dictionary of training images for each label.
+    image_dir: Root folder string of the subfolders containing the training
+    images.
+    bottleneck_dir: Folder string holding the bottleneck stores.
+    architecture: The name of the model architecture.
+    precision: Name string of the bottleneck storage precision.
+    num_workers: Integer number of worker processes.
+    threads_per_worker: Integer size of each worker's intra-op thread pool.
+  """
+  pending = find_missing_bottlenecks(image_lists, image_dir, bottleneck_dir,
+                                     architecture, precision)
+  if not pending:
+    return
+  entries = [(key, image_path) for key, (image_path, _) in pending.items()]
+  num_workers = min(num_workers, len(entries))
+  tf.logging.info('Caching %d bottlenecks across %d processes' %
+                  (len(entries), num_workers))
+  shard_args = [(FLAGS, shard_index, entries[shard_index::num_workers],
+                 threads_per_worker, precision)
+                for shard_index in range(num_workers)]
+  if hasattr(multiprocessing, 'get_context'):
+    context = multiprocessing.get_context('spawn')
+  else:
+    context = multiprocessing
+  start_time = time.time()
+  shard_summaries = collections.OrderedDict()
+  pool = context.Pool(num_workers)
+  try:
+    for shard_index, summary in pool.imap_unordered(cache_bottleneck_shard,
+                                                    shard_args):
+      tf.logging.info('Bottleneck shard %d finished' % shard_index)
+      shard_summaries['shard' + str(shard_index)] = summary
+  finally:
+    pool.close()
+    pool.join()
+  wall_secs = time.time() - start_time
+  write_cache_summary(collections.OrderedDict([
+      ('images', len(entries)),
+      ('wall_secs', wall_secs),
+      ('images_per_sec', len(entries) / max(wall_secs, 1e-6)),
+      ('shards', shard_summaries),
+  ]), FLAGS.cache_summary_file)
+
+  # Merge the shards into the stores of the splits that need them.
+  for shard_index in range(num_workers):
+    shard = BottleneckStore(bottleneck_dir, architecture,
+                            'shard' + str(shard_index), precision)
+    for key, _ in shard_args[shard_index][2]:
+      for store in pending[key][1]:
+        store.put(key, shard.get(key))
+    flush_bottleneck_stores()
+    shard.compact(set())
+
+
+def collect_bottleneck_garbage(image_lists, image_dir, bottleneck_dir,
+                               architecture, precision, distortions=None,
+                               variants=0):
+  """Removes cached bottlenecks that no current image or model can use.
+
+  Rows of the split stores whose keys aren't produced by any image in
+  image_lists under the current model and preprocessing are dropped, and the
+  stores are compacted so their files hold only live rows. Distorted variants
+  in the augmented store are only kept for live training images, and only the
+  first variants of them made with the given distortion settings, so banks
+  built with earlier settings don't pile up. Shards left behind by
+  interrupted parallel runs are deleted, as are legacy text files for images
+  that no longer exist.
+
+  Args:
+    image_lists: Dictionary of training images for each label.
+    image_dir: Root folder string of the subfolders containing the training
+    images.
+    bottleneck_dir: Folder string holding the bottleneck stores.
+    architecture: The name of the model architecture.
+    precision: Name string of the bottleneck storage precision.
+    distortions: Tuple of the current distortion settings, or None if there
+    are none, in which case the whole augmented store is removed.
+    variants: Integer number of distorted variants kept per image.
+  """
+  live_keys = collections.defaultdict(set)
+  live_text_paths = set()
+  for label_name, label_lists in image_lists.items():
+    for category in ['training', 'testing', 'validation']:
+      for index, unused_base_name in enumerate(label_lists[category]):
+        live_keys[category].add(get_bottleneck_key(
+            image_lists, label_name, index, image_dir, category, architecture))
+        live_text_paths.add(get_bottleneck_path(
+            image_lists, label_name, index, bottleneck_dir, category,
+            architecture))
+  if distortions:
+    live_keys['augmented'] = set(
+        get_augmented_bottleneck_key(key, distortions, variant)
+        for key in live_keys['training'] for variant in range(variants))
+
+  how_many_rows = 0
+  bytes_before = 0
+  bytes_after = 0
+  for category in ['training', 'testing', 'validation']:
+    store = get_bottleneck_store(bottleneck_dir, category, architecture,
+                                 precision)
+    bytes_before += store.disk_bytes()
+    how_many_rows += store.compact(live_keys[category])
+    bytes_after += store.disk_bytes()
+  store = get_bottleneck_store(bottleneck_dir, 'augmented', architecture,
+                               precision)
+  bytes_before += store.disk_bytes()
+  how_many_rows += store.compact(live_keys['augmented'])
+  bytes_after += store.disk_bytes()
+
+  how_many_files = 0
+  shard_prefix = 'bottlenecks_' + architecture + '_shard'
+  text_suffix = '_' + architecture + '.txt'
+  for dir_path, _, file_names in os.walk(bottleneck_dir):
+    for file_name in file_names:
+      file_path = os.path.join(dir_path, file_name)
+      if ((dir_path == bottleneck_dir and file_name.startswith(shard_prefix))
+          or (file_name.endswith(text_suffix) and
+              file_path not in live_text_paths)):
+        bytes_before += os.path.getsize(file_path)
+        os.remove(file_path)
+        how_many_files += 1
+  tf.logging.info('Removed %d stale bottlenecks and %d orphaned files, '
+                  'bottleneck cache went from %.1f MB to %.1f MB' %
+                  (how_many_rows, how_many_files, bytes_before / 1e6,
+                   bytes_after / 1e6))
+
+
+def build_alias_table(weights):
+  """Builds Walker's alias table for drawing indices by weight in O(1).
+
+  Each column of the table holds its own index and an alias. Drawing a column
+  uniformly and then keeping its index with the column's acceptance
+  probability, or taking the alias otherwise, draws every index with
+  probability proportional to its weight.
+
+  Args:
+    weights: Array of non-negative weights, at least one of them positive.
+
+  Returns:
+    Float64 array of the acceptance probability and int64 array of the alias
+    of each column.
+  """
+  weights = np.asarray(weights, dtype=np.float64)
+  scaled = weights * len(weights) / weights.sum()
+  accept = np.ones(len(weights))
+  alias = np.arange(len(weights), dtype=np.int64)
+  small = [i for i in range(len(weights)) if scaled[i] < 1.0]
+  large = [i for i in range(len(weights)) if scaled[i] >= 1.0]
+  while small and large:
+    less, more = small.pop(), large.pop()
+    accept[less] = scaled[less]
+    alias[less] = more
+    scaled[more] += scaled[less] - 1.0
+    if scaled[more] < 1.0:
+      small.append(more)
+    else:
+      large.append(more)
+  return accept, alias
+
+
+class BottleneckSampler(object):
+  """Draws batches of images from one split with vectorized NumPy calls.
+
+  The images of the split are flattened once, in the label order of
+  image_lists, into arrays holding the label index and the index within its
+  label of every image. A batch is then a single array of flat rows drawn with
+  one call to the random generator, and its one-hot ground truth is a single
+  fancy-indexing operation on an identity matrix. The flat rows also index the
+  matrices built by load_resident_bottlenecks directly.
+
+  Four sampling modes are supported:
+    balanced: Pick a label uniformly, then an image within it uniformly. This
+      matches the original behaviour of the script.
+    uniform: Pick an image uniformly from the whole split.
+    tempered: Pick a label with probability proportional to its image count
+      raised to `exponent`, then an image within it uniformly. An exponent of
+      0 is the same as balanced and 1 the same as uniform, and the values in
+      between oversample small labels less than balanced does.
+    epoch: Walk through a shuffled permutation of the split, so every image is
+      seen once per epoch, reshuffling when it runs out.
+
+  The first three draw the label from an alias table built once over the
+  labels, so a batch of any size costs one call for its random numbers and a
+  few array operations, whatever the number of labels.
+  """
+
+  MODES = ('balanced', 'uniform', 'tempered', 'epoch')
+
+  def __init__(self, image_lists, category, mode='balanced', seed=None,
+               exponent=0.5):
+    """Precomputes the flat label and image index arrays for a split.
+
+    Args:
+      image_lists: Dictionary of training images for each label.
+      category: Name string of which set to sample - training, testing, or
+      validation.
+      mode: Name string of the sampling mode, one of MODES.
+      seed: Optional integer seed for the random generator.
+      exponent: Float power of the image counts the labels are weighted by in
+      the tempered mode.
+
+    Raises:
+      ValueError: If the mode is unknown or the split has no images.
+    """
+    if mode not in self.MODES:
+      raise ValueError('Unknown sampling mode', mode)
+    self.mode = mode
+    self.label_names = list(image_lists.keys())
+    self.label_counts = np.array(
+        [len(image_lists[label_name][category])
+         for label_name in self.label_names], dtype=np.int64)
+    self.image_count = int(self.label_counts.sum())
+    if self.image_count == 0:
+      raise ValueError('No images found in category', category)
+    self.label_starts = np.cumsum(self.label_counts) - self.label_counts
+    self.label_indices = np.repeat(np.arange(len(self.label_names)),
+                                   self.label_counts)
+    self.image_indices = (np.arange(self.image_count) -
+                          np.repeat(self.label_starts, self.label_counts))
+    label_exponent = {'balanced': 0.0, 'uniform': 1.0}.get(mode, exponent)
+    label_weights = np.where(self.label_counts > 0,
+                             self.label_counts.astype(np.float64) **
+                             label_exponent, 0.0)
+    self.label_accept, self.label_alias = build_alias_table(label_weights)
+    self.ground_truth_table = np.eye(len(self.label_names), dtype=np.float32)
+    self.rng = np.random.RandomState(seed)
+    self.epoch_order = self.rng.permutation(self.image_count)
+    self.epoch_position = 0
+    self.lock = threading.Lock()
+
+  def sample(self, how_many):
+    """Draws a batch of flat rows from the split.
+
+    Args:
+      how_many: If positive, a random sample of this size will be chosen.
+      If negative, every row of the split is returned in order.
+
+    Returns:
+      Integer array of flat rows.
+    """
+    if how_many < 0:
+      return np.arange(self.image_count)
+    # Batches can be drawn from several producer threads at once.
+    with self.lock:
+      return self._sample(how_many)
+
+  def _sample(self, how_many):
+    if self.mode != 'epoch':
+      draws = self.rng.random_sample((3, how_many))
+      columns = np.minimum((draws[0] * len(self.label_accept)).astype(np.int64),
+                           len(self.label_accept) - 1)
+      labels = np.where(draws[1] < self.label_accept[columns], columns,
+                        self.label_alias[columns])
+      counts = self.label_counts[labels]
+      offsets = np.minimum((draws[2] * counts).astype(np.int64), counts - 1)
+      return self.label_starts[labels] + offsets
+    rows = []
+    while how_many > 0:
+      if self.epoch_position == self.image_count:
+        self.epoch_order = self.rng.permutation(self.image_count)
+        self.epoch_position = 0
+      chunk = self.epoch_order[
+          self.epoch_position:self.epoch_position + how_many]
+      self.epoch_position += len(chunk)
+      how_many -= len(chunk)
+      rows.append(chunk)
+    return np.concatenate(rows) if rows else np.zeros([0], dtype=np.int64)
+
+  def ground_truth(self, rows):
+    """Returns the one-hot ground truth matrix for an array of flat rows."""
+    return self.ground_truth_table[self.label_indices[rows]]
+
+  def get_state(self):
+    """Returns the random generator and epoch state as a dict of arrays."""
+    with self.lock:
+      _, keys, position, has_gauss, cached_gaussian = self.rng.get_state()
+      return {'rng_keys': keys,
+              'rng_position': np.array(position),
+              'rng_has_gauss': np.array(has_gauss),
+              'rng_cached_gaussian': np.array(cached_gaussian),
+              'epoch_order': self.epoch_order.copy(),
+              'epoch_position': np.array(self.epoch_position)}
+
+  def set_state(self, state):
+    """Restores the state returned by get_state.
+
+    Args:
+      state: Dictionary of arrays returned by get_state.
+
+    Raises:
+      ValueError: If the state was saved for a split of a different size.
+    """
+    if len(state['epoch_order']) != self.image_count:
+      raise ValueError('Sampler state does not match the split size',
+                       len(state['epoch_order']), self.image_count)
+    with self.lock:
+      self.rng.set_state(('MT19937', state['rng_keys'],
+                          int(state['rng_position']),
+                          int(state['rng_has_gauss']),
+                          float(state['rng_cached_gaussian'])))
+      self.epoch_order = np.array(state['epoch_order'])
+      self.epoch_position = int(state['epoch_position'])
+
+
+def get_random_cached_bottlenecks(sess, image_lists, how_many, category,
+                                  bottleneck_dir, image_dir, jpeg_data_tensor,
+                                  decoded_image_tensor, resized_input_tensor,
+                                  bottleneck_tensor, architecture, precision,
+                                  sampler=None):
+  """Retrieves bottleneck values for cached images.
+
+  If no distortions are being applied, this function can retrieve the cached
+  bottleneck values directly from disk for images. It picks a random set of
+  images from the specified category.
+
+  Args:
+    sess: Current TensorFlow Session.
+    image_lists: Dictionary of training images for each label.
+    how_many: If positive, a random sample of this size will be chosen.
+    If negative, all bottlenecks will be retrieved.
+    category: Name string of which set to pull from - training, testing, or
+    validation.
+    bottleneck_dir: Folder string holding the bottleneck stores.
+    image_dir: Root folder string of the subfolders containing the training
+    images.
+    jpeg_data_tensor: The layer to feed jpeg image data into.
+    decoded_image_tensor: The output of decoding and resizing the image.
+    resized_input_tensor: The input node of the recognition graph.
+    bottleneck_tensor: The bottleneck output layer of the CNN graph.
+    architecture: The name of the model architecture.
+    precision: Name string of the bottleneck storage precision.
+    sampler: BottleneckSampler for the category. A balanced one is created if
+    none is given.
+
+  Returns:
+    List of bottleneck arrays, their corresponding ground truths, and the
+    relevant filenames.
+  """
+  if sampler is None:
+    sampler = BottleneckSampler(image_lists, category)
+  return get_cached_bottleneck_rows(
+      sess, image_lists, sampler.sample(how_many), category, bottleneck_dir,
+      image_dir, jpeg_data_tensor, decoded_image_tensor, resized_input_tensor,
+      bottleneck_tensor, architecture, precision, sampler)
+
+
+def iterate_cached_bottleneck_chunks(sess, image_lists, how_many, category,
+                                     chunk_size, bottleneck_dir, image_dir,
+                                     jpeg_data_tensor, decoded_image_tensor,
+                                     resized_input_tensor, bottleneck_tensor,
+                                     architecture, precision, sampler=None):
+  """Retrieves the same bottlenecks as get_random_cached_bottlenecks in chunks.
+
+  Only one chunk is held in memory at a time, so whole splits can be streamed
+  through an evaluation however large they are.
+
+  Args:
+    sess: Current TensorFlow Session.
+    image_lists: Dictionary of training images for each label.
+    how_many: If positive, a random sample of this size will be chosen.
+    If negative, all bottlenecks will be retrieved.
+    category: Name string of which set to pull from - training, testing, or
+    validation.
+    chunk_size: Integer maximum number of bottlenecks per chunk.
+    bottleneck_dir: Folder string holding the bottleneck stores.
+    image_dir: Root folder string of the subfolders containing the training
+    images.
+    jpeg_data_tensor: The layer to feed jpeg image data into.
+    decoded_image_tensor: The output of decoding and resizing the image.
+    resized_input_tensor: The input node of the recognition graph.
+    bottleneck_tensor: The bottleneck output layer of the CNN graph.
+    architecture: The name of the model architecture.
+    precision: Name string of the bottleneck storage precision.
+    sampler: BottleneckSampler for the category. A balanced one is created if
+    none is given.
+
+  Yields:
+    Lists of bottleneck arrays, their corresponding ground truths, and the
+    relevant filenames.
+  """
+  if sampler is None:
+    sampler = BottleneckSampler(image_lists, category)
+  rows = sampler.sample(how_many)
+  for start in range(0, len(rows), max(1, chunk_size)):
+    yield get_cached_bottleneck_rows(
+        sess, image_lists, rows[start:start + max(1, chunk_size)], category,
+        bottleneck_dir, image_dir, jpeg_data_tensor, decoded_image_tensor,
+        resized_input_tensor, bottleneck_tensor, architecture, precision,
+        sampler)
+
+
+def get_cached_bottleneck_rows(sess, image_lists, rows, category,
+                               bottleneck_dir, image_dir, jpeg_data_tensor,
+                               decoded_image_tensor, resized_input_tensor,
+                               bottleneck_tensor, architecture, precision,
+                               sampler):
+  """Retrieves the cached bottlenecks of flat rows drawn by a sampler.
+
+  The arguments are those of get_random_cached_bottlenecks, with the integer
+  array of flat rows to retrieve in place of how_many.
+
+  Returns:
+    List of bottleneck arrays, their corresponding ground truths, and the
+    relevant filenames.
+  """
+  bottlenecks = []
+  filenames = []
+  for row in rows:
+    label_name = sampler.label_names[sampler.label_indices[row]]
+    image_index = sampler.image_indices[row]
+    image_name = get_image_path(image_lists, label_name, image_index,
+                                image_dir, category)
+    bottleneck = get_or_create_bottleneck(
+        sess, image_lists, label_name, image_index, image_dir, category,
+        bottleneck_dir, jpeg_data_tensor, decoded_image_tensor,
+        resized_input_tensor, bottleneck_tensor, architecture, precision)
+    bottlenecks.append(bottleneck)
+    filenames.append(image_name)
+  return bottlenecks, sampler.ground_truth(rows), filenames
+
+
+ResidentBottlenecks = collections.namedtuple(
+    'ResidentBottlenecks',
+    ['bottlenecks', 'scales', 'label_indices', 'filenames'])
+
+
+def load_resident_bottlenecks(image_lists, category, image_dir, bottleneck_dir,
+                              architecture, precision):
+  """Loads every cached bottleneck of a split into memory.
+
+  The rows are copied out of the split's store into one NumPy array, grouped
+  by label in the order of image_lists, so that training steps can sample from
+  RAM without touching the disk. Rows follow the same flat order as a
+  BottleneckSampler for the split. Rows stay in the store's precision and are
+  only dequantized as batches are drawn, so float16 and int8 stores need half
+  or about a quarter of the memory.
+
+  Args:
+    image_lists: Dictionary of training images for each label.
+    category: Name string of which set to load - training, testing, or
+    validation.
+    image_dir: Root folder string of the subfolders containing the training
+    images.
+    bottleneck_dir: Folder string holding the bottleneck stores.
+    architecture: The name of the model architecture.
+    precision: Name string of the bottleneck storage precision.
+
+  Returns:
+    ResidentBottlenecks with the [N, bottleneck size] matrix, the int8 scale of
+    each row or None, the label index of each row, and the image path of each
+    row.
+  """
+  store = get_bottleneck_store(bottleneck_dir, category, architecture,
+                               precision)
+  rows = []
+  label_indices = []
+  filenames = []
+  for label_index, label_name in enumerate(image_lists.keys()):
+    category_list = image_lists[label_name][category]
+    for image_index in range(len(category_list)):
+      key = get_bottleneck_key(image_lists, label_name, image_index, image_dir,
+                               category, architecture)
+      rows.append(store.row(key))
+      label_indices.append(label_index)
+      filenames.append(get_image_path(image_lists, label_name, image_index,
+                                      image_dir, category))
+  bottlenecks, scales = store.raw_rows(np.array(rows, dtype=np.int64))
+  resident_bytes = bottlenecks.nbytes + (0 if scales is None else scales.nbytes)
+  tf.logging.info('Loaded %d %s bottlenecks into memory as %s (%.1f MB, '
+                  '%.1f MB as float32)' %
+                  (len(rows), category, store.precision, resident_bytes / 1e6,
+                   bottlenecks.size * 4 / 1e6))
+  return ResidentBottlenecks(bottlenecks, scales,
+                             np.array(label_indices, dtype=np.int64),
+                             filenames)
+
+
+def get_random_resident_bottlenecks(resident, how_many, sampler):
+  """Samples a batch of bottlenecks from a split held in memory.
+
+  The whole batch is drawn by the sampler and gathered from the resident
+  matrix in one indexing operation, with no per-step file I/O, then dequantized
+  to float32.
+
+  Args:
+    resident: ResidentBottlenecks for the split.
+    how_many: If positive, a random sample of this size will be chosen.
+    If negative, all bottlenecks will be retrieved.
+    sampler: BottleneckSampler for the same split.
+
+  Returns:
+    Array of bottlenecks, their one-hot ground truths, and the relevant
+    filenames.
+  """
+  if how_many < 0:
+    return (dequantize_bottlenecks(resident.bottlenecks, resident.scales),
+            sampler.ground_truth_table[resident.label_indices],
+            resident.filenames)
+  rows = sampler.sample(how_many)
+  filenames = [resident.filenames[row] for row in rows]
+  scales = None if resident.scales is None else resident.scales[rows]
+  return (dequantize_bottlenecks(resident.bottlenecks[rows], scales),
+          sampler.ground_truth(rows), filenames)
+
+
+def iterate_resident_bottleneck_chunks(resident, how_many, chunk_size,
+                                       sampler):
+  """Samples bottlenecks from a split held in memory, in float32 chunks.
+
+  Only one chunk at a time is dequantized, so streaming the whole split adds
+  a bounded amount of memory to the resident matrix.
+
+  Args:
+    resident: ResidentBottlenecks for the split.
+    how_many: If positive, a random sample of this size will be chosen.
+    If negative, all bottlenecks will be retrieved.
+    chunk_size: Integer maximum number of bottlenecks per chunk.
+    sampler: BottleneckSampler for the same split.
+
+  Yields:
+    Arrays of bottlenecks, their one-hot ground truths, and the relevant
+    filenames.
+  """
+  rows = sampler.sample(how_many)
+  for start in range(0, len(rows), max(1, chunk_size)):
+    chunk_rows = rows[start:start + max(1, chunk_size)]
+    scales = None if resident.scales is None else resident.scales[chunk_rows]
+    yield (dequantize_bottlenecks(resident.bottlenecks[chunk_rows], scales),
+           sampler.ground_truth(chunk_rows),
+           [resident.filenames[row] for row in chunk_rows])
+
+
+def run_bottleneck_on_distorted_batch(sess, jpeg_data,
+                                      distorted_jpeg_data_tensor,
+                                      bottleneck_tensor):
+  """Distorts a batch of JPEGs and runs the network on them in a single run.
+
+  The distortion operations are wired into the model's input by
+  create_model_graph, so the distorted images never leave the runtime. Some
+  frozen graphs hard-code a batch size of one; for those we fall back to
+  distorting the images one at a time.
+
+  Args:
+    sess: Current active TensorFlow Session.
+    jpeg_data: List of strings of raw JPEG data.
+    distorted_jpeg_data_tensor: The distortion input from create_model_graph.
+    bottleneck_tensor: Layer before the final softmax.
+
+  Returns:
+    Numpy array of bottleneck values, one row per image.
+  """
+  try:
+    bottleneck_values = sess.run(bottleneck_tensor,
+                                 {distorted_jpeg_data_tensor: jpeg_data})
+  except tf.errors.InvalidArgumentError:
+    tf.logging.warning('Model graph does not support batched inference, '
+                       'distorting images one at a time')
+    bottleneck_values = np.concatenate([
+        sess.run(bottleneck_tensor, {distorted_jpeg_data_tensor: [data]})
+        for data in jpeg_data])
+  return np.reshape(bottleneck_values, [len(jpeg_data), -1])
+
+
+def distort_bottlenecks(sess, image_lists, rows, sampler, category, image_dir,
+                        distorted_jpeg_data_tensor, bottleneck_tensor):
+  """Reads a batch of images and gets the bottlenecks of distorted copies.
+
+  Args:
+    sess: Current TensorFlow Session.
+    image_lists: Dictionary of training images for each label.
+    rows: Array of sampler rows picking the images.
+    sampler: BottleneckSampler the rows were drawn from.
+    category: Name string of which set of images to fetch - training, testing,
+    or validation.
+    image_dir: Root folder string of the subfolders containing the training
+    images.
+    distorted_jpeg_data_tensor: The distortion input from create_model_graph.
+    bottleneck_tensor: The bottleneck output layer of the CNN graph.
+
+  Returns:
+    Numpy array of bottleneck values, one row per image in the order of rows.
+  """
+  jpeg_data = []
+  for row in rows:
+    label_name = sampler.label_names[sampler.label_indices[row]]
+    image_index = sampler.image_indices[row]
+    image_path = get_image_path(image_lists, label_name, image_index, image_dir,
+                                category)
+    jpeg_data.append(read_image_file(image_path))
+  return run_bottleneck_on_distorted_batch(
+      sess, jpeg_data, distorted_jpeg_data_tensor, bottleneck_tensor)
+
+
+def prefetch_distorted_bottlenecks(sess, image_lists, how_many_batches,
+                                   batch_size, category, image_dir,
+                                   distorted_jpeg_data_tensor,
+                                   bottleneck_tensor, sampler, num_workers=2,
+                                   queue_size=4):
+  """Starts background threads calculating distorted batches ahead of training.
+
+  Each worker draws a batch from the sampler, reads its files and gets the
+  bottlenecks of distorted copies with distort_bottlenecks, so those runs
+  overlap with the training steps that consume the previous batches.
+
+  Args:
+    sess: Current TensorFlow Session.
+    image_lists: Dictionary of training images for each label.
+    how_many_batches: Integer number of batches to produce.
+    batch_size: Integer number of images per batch.
+    category: Name string of which set of images to fetch - training, testing,
+    or validation.
+    image_dir: Root folder string of the subfolders containing the training
+    images.
+    distorted_jpeg_data_tensor: The distortion input from create_model_graph.
+    bottleneck_tensor: The bottleneck output layer of the CNN graph.
+    sampler: BottleneckSampler to draw the batches from.
+    num_workers: Integer number of threads distorting batches.
+    queue_size: Integer number of batches to buffer.
+
+  Returns:
+    Iterator over (rows, bottleneck values) pairs.
+  """
+  # Batches are drawn as the workers ask for them, under the pipeline's lock,
+  # so the sampler is never used from two threads at once.
+  batches = (sampler.sample(batch_size) for _ in range(how_many_batches))
+  pipeline = ImagePipeline(
+      batches,
+      lambda rows: distort_bottlenecks(sess, image_lists, rows, sampler,
+                                       category, image_dir,
+                                       distorted_jpeg_data_tensor,
+                                       bottleneck_tensor),
+      num_workers, queue_size)
+  return iter(pipeline)
+
+
+def get_random_distorted_bottlenecks(
+    sess, image_lists, how_many, category, image_dir,
+    distorted_jpeg_data_tensor, bottleneck_tensor, sampler=None,
+    distorted_bottlenecks=None):
+  """Retrieves bottleneck values for training images, after distortions.
+
+  If we're training with distortions like crops, scales, or flips, we have to
+  recalculate the full model for every image, and so we can't use cached
+  bottleneck values. Instead we find random images for the requested category
+  and run them through the distortion graph and the full graph as one batch
+  to get the bottleneck results for each.
+
+  Args:
+    sess: Current TensorFlow Session.
+    image_lists: Dictionary of training images for each label.
+    how_many: The integer number of bottleneck values to return.
+    category: Name string of which set of images to fetch - training, testing,
+    or validation.
+    image_dir: Root folder string of the subfolders containing the training
+    images.
+    distorted_jpeg_data_tensor: The distortion input from create_model_graph.
+    bottleneck_tensor: The bottleneck output layer of the CNN graph.
+    sampler: BottleneckSampler for the category. A balanced one is created if
+    none is given.
+    distorted_bottlenecks: Optional (rows, bottleneck values) pair already
+    produced by prefetch_distorted_bottlenecks, used instead of drawing a new
+    batch.
+
+  Returns:
+    Array of bottlenecks and their corresponding ground truths.
+  """
+  if sampler is None:
+    sampler = BottleneckSampler(image_lists, category)
+  if distorted_bottlenecks is None:
+    rows = sampler.sample(how_many)
+    bottlenecks = distort_bottlenecks(sess, image_lists, rows, sampler,
+                                      category, image_dir,
+                                      distorted_jpeg_data_tensor,
+                                      bottleneck_tensor)
+  else:
+    rows, bottlenecks = distorted_bottlenecks
+  return bottlenecks, sampler.ground_truth(rows)
+
+
+def get_distortion_description(distortions):
+  """Returns a string naming a set of distortion settings.
+
+  Args:
+    distortions: Tuple of the flip_left_right, random_crop, random_scale and
+    random_brightness arguments to add_input_distortions.
 
   Returns:
-    Numpy array of values produced by the bottleneck layer for the image.
+    String such as 'flip1-crop10-scale0-brightness0'.
   """
-  label_lists = image_lists[label_name]
-  sub_dir = label_lists['dir']
-  sub_dir_path = os.path.join(bottleneck_dir, sub_dir)
-  ensure_dir_exists(sub_dir_path)
-  bottleneck_path = get_bottleneck_path(image_lists, label_name, index,
-                                        bottleneck_dir, category, architecture)
-  if not os.path.exists(bottleneck_path):
-    create_bottleneck_file(bottleneck_path, image_lists, label_name, index,
-                           image_dir, category, sess, jpeg_data_tensor,
-                           decoded_image_tensor, resized_input_tensor,
-                           bottleneck_tensor)
-  with open(bottleneck_path, 'r') as bottleneck_file:
-    bottleneck_string = bottleneck_file.read()
-  did_hit_error = False
-  try:
-    bottleneck_values = [float(x) for x in bottleneck_string.split(',')]
-  except ValueError:
-    tf.logging.warning('Invalid float found, recreating bottleneck')
-    did_hit_error = True
-  if did_hit_error:
-    create_bottleneck_file(bottleneck_path, image_lists, label_name, index,
-                           image_dir, category, sess, jpeg_data_tensor,
-                           decoded_image_tensor, resized_input_tensor,
-                           bottleneck_tensor)
-    with open(bottleneck_path, 'r') as bottleneck_file:
-      bottleneck_string = bottleneck_file.read()
-    # Allow exceptions to propagate here, since they shouldn't happen after a
-    # fresh creation
-    bottleneck_values = [float(x) for x in bottleneck_string.split(',')]
-  return bottleneck_values
+  flip_left_right, random_crop, random_scale, random_brightness = distortions
+  return 'flip%d-crop%d-scale%d-brightness%d' % (
+      int(flip_left_right), random_crop, random_scale, random_brightness)
 
 
-def cache_bottlenecks(sess, image_lists, image_dir, bottleneck_dir,
-                      jpeg_data_tensor, decoded_image_tensor,
-                      resized_input_tensor, bottleneck_tensor, architecture):
-  """Ensures all the training, testing, and validation bottlenecks are cached.
+def get_augmented_bottleneck_key(key, distortions, variant):
+  """Returns the key of one distorted variant of an image's bottleneck.
+
+  Args:
+    key: Bottleneck key of the undistorted image, from get_bottleneck_key.
+    distortions: Tuple of the distortion settings the variant was made with.
+    variant: Integer index of the variant.
+
+  Returns:
+    String key of the variant in the augmented store.
+  """
+  return '%s_aug_%s_%d' % (key, get_distortion_description(distortions),
+                           variant)
 
-  Because we're likely to read the same image multiple times (if there are no
-  distortions applied during training) it can speed things up a lot if we
-  calculate the bottleneck layer values once for each image during
-  preprocessing, and then just read those cached values repeatedly during
-  training. Here we go through all the images we've found, calculate those
-  values, and save them off.
+
+def cache_augmented_bottlenecks(sess, image_lists, image_dir, bottleneck_dir,
+                                architecture, precision, distortions, variants,
+                                distorted_jpeg_data_tensor, bottleneck_tensor,
+                                num_workers=4, queue_size=64):
+  """Ensures every training image has its distorted variants cached.
+
+  Each training image is distorted variants times with the given settings and
+  the bottlenecks of all the variants are stored in the 'augmented' store, so
+  training can sample augmented data at the speed of cached bottlenecks.
+  Worker threads read each image and run all its missing variants through the
+  distortion and the network as one batch.
 
   Args:
     sess: The current active TensorFlow Session.
     image_lists: Dictionary of training images for each label.
     image_dir: Root folder string of the subfolders containing the training
     images.
-    bottleneck_dir: Folder string holding cached files of bottleneck values.
-    jpeg_data_tensor: Input tensor for jpeg data from file.
-    decoded_image_tensor: The output of decoding and resizing the image.
-    resized_input_tensor: The input node of the recognition graph.
-    bottleneck_tensor: The penultimate output layer of the graph.
+    bottleneck_dir: Folder string holding the bottleneck stores.
     architecture: The name of the model architecture.
-
-  Returns:
-    Nothing.
+    precision: Name string of the bottleneck storage precision.
+    distortions: Tuple of the distortion settings passed to create_model_graph.
+    variants: Integer number of distorted variants to keep per image.
+    distorted_jpeg_data_tensor: The distortion input from create_model_graph.
+    bottleneck_tensor: The penultimate output layer of the graph.
+    num_workers: Integer number of threads reading and distorting images.
+    queue_size: Integer number of images' variants to buffer ahead of the
+    store.
   """
-  how_many_bottlenecks = 0
-  ensure_dir_exists(bottleneck_dir)
+  store = get_bottleneck_store(bottleneck_dir, 'augmented', architecture,
+                               precision)
+  pending = collections.OrderedDict()
   for label_name, label_lists in image_lists.items():
-    for category in ['training', 'testing', 'validation']:
-      category_list = label_lists[category]
-      for index, unused_base_name in enumerate(category_list):
-        get_or_create_bottleneck(
-            sess, image_lists, label_name, index, image_dir, category,
-            bottleneck_dir, jpeg_data_tensor, decoded_image_tensor,
-            resized_input_tensor, bottleneck_tensor, architecture)
-
-        how_many_bottlenecks += 1
-        if how_many_bottlenecks % 100 == 0:
-          tf.logging.info(
-              str(how_many_bottlenecks) + ' bottleneck files created.')
-
-
-def get_random_cached_bottlenecks(sess, image_lists, how_many, category,
-                                  bottleneck_dir, image_dir, jpeg_data_tensor,
-                                  decoded_image_tensor, resized_input_tensor,
-                                  bottleneck_tensor, architecture):
-  """Retrieves bottleneck values for cached images.
-
-  If no distortions are being applied, this function can retrieve the cached
-  bottleneck values directly from disk for images. It picks a random set of
-  images from the specified category.
+    for index, unused_base_name in enumerate(label_lists['training']):
+      key = get_bottleneck_key(image_lists, label_name, index, image_dir,
+                               'training', architecture)
+      missing_keys = [
+          get_augmented_bottleneck_key(key, distortions, variant)
+          for variant in range(variants)]
+      missing_keys = [variant_key for variant_key in missing_keys
+                      if variant_key not in store]
+      if missing_keys:
+        image_path = get_image_path(image_lists, label_name, index, image_dir,
+                                    'training')
+        pending.setdefault(key, (image_path, missing_keys))
+
+  def distort_variants(entry):
+    _, (image_path, missing_keys) = entry
+    jpeg_data = read_image_file(image_path)
+    return run_bottleneck_on_distorted_batch(
+        sess, [jpeg_data] * len(missing_keys), distorted_jpeg_data_tensor,
+        bottleneck_tensor)
+
+  how_many_images = 0
+  if bucket_image_cache is not None:
+    bucket_image_cache.prefetch(
+        [image_path for image_path, _ in pending.values()
+         if bucket_image_cache.owns(image_path)])
+  for (_, (_, missing_keys)), bottleneck_values in ImagePipeline(
+      pending.items(), distort_variants, num_workers, queue_size):
+    for variant_key, values in zip(missing_keys, bottleneck_values):
+      store.put(variant_key, values)
+    how_many_images += 1
+    if how_many_images % 100 == 0:
+      tf.logging.info('Distorted variants created for %d/%d images' %
+                      (how_many_images, len(pending)))
+  store.flush()
+  tf.logging.info('Augmented bottleneck bank of %d variants per image (%s): '
+                  'variants created for %d images, %.1f MB on disk' %
+                  (variants, get_distortion_description(distortions),
+                   how_many_images, store.disk_bytes() / 1e6))
+
+
+def load_augmented_bottlenecks(image_lists, image_dir, bottleneck_dir,
+                               architecture, precision, distortions, variants):
+  """Loads the distorted variants of every training image into memory.
 
   Args:
-    sess: Current TensorFlow Session.
     image_lists: Dictionary of training images for each label.
-    how_many: If positive, a random sample of this size will be chosen.
-    If negative, all bottlenecks will be retrieved.
-    category: Name string of which set to pull from - training, testing, or
-    validation.
-    bottleneck_dir: Folder string holding cached files of bottleneck values.
     image_dir: Root folder string of the subfolders containing the training
     images.
-    jpeg_data_tensor: The layer to feed jpeg image data into.
-    decoded_image_tensor: The output of decoding and resizing the image.
-    resized_input_tensor: The input node of the recognition graph.
-    bottleneck_tensor: The bottleneck output layer of the CNN graph.
+    bottleneck_dir: Folder string holding the bottleneck stores.
     architecture: The name of the model architecture.
+    precision: Name string of the bottleneck storage precision.
+    distortions: Tuple of the distortion settings the variants were made with.
+    variants: Integer number of distorted variants per image.
 
   Returns:
-    List of bottleneck arrays, their corresponding ground truths, and the
-    relevant filenames.
+    ResidentBottlenecks holding variants consecutive rows per image, with the
+    images in the flat order of a BottleneckSampler for the training split.
   """
-  class_count = len(image_lists.keys())
-  bottlenecks = []
-  ground_truths = []
+  store = get_bottleneck_store(bottleneck_dir, 'augmented', architecture,
+                               precision)
+  rows = []
+  label_indices = []
   filenames = []
-  if how_many >= 0:
-    # Retrieve a random sample of bottlenecks.
-    for unused_i in range(how_many):
-      label_index = random.randrange(class_count)
-      label_name = list(image_lists.keys())[label_index]
-      image_index = random.randrange(MAX_NUM_IMAGES_PER_CLASS + 1)
-      image_name = get_image_path(image_lists, label_name, image_index,
-                                  image_dir, category)
-      bottleneck = get_or_create_bottleneck(
-          sess, image_lists, label_name, image_index, image_dir, category,
-          bottleneck_dir, jpeg_data_tensor, decoded_image_tensor,
-          resized_input_tensor, bottleneck_tensor, architecture)
-      ground_truth = np.zeros(class_count, dtype=np.float32)
-      ground_truth[label_index] = 1.0
-      bottlenecks.append(bottleneck)
-      ground_truths.append(ground_truth)
-      filenames.append(image_name)
-  else:
-    # Retrieve all bottlenecks.
-    for label_index, label_name in enumerate(image_lists.keys()):
-      for image_index, image_name in enumerate(
-          image_lists[label_name][category]):
-        image_name = get_image_path(image_lists, label_name, image_index,
-                                    image_dir, category)
-        bottleneck = get_or_create_bottleneck(
-            sess, image_lists, label_name, image_index, image_dir, category,
-            bottleneck_dir, jpeg_data_tensor, decoded_image_tensor,
-            resized_input_tensor, bottleneck_tensor, architecture)
-        ground_truth = np.zeros(class_count, dtype=np.float32)
-        ground_truth[label_index] = 1.0
-        bottlenecks.append(bottleneck)
-        ground_truths.append(ground_truth)
-        filenames.append(image_name)
-  return bottlenecks, ground_truths, filenames
+  for label_index, label_name in enumerate(image_lists.keys()):
+    category_list = image_lists[label_name]['training']
+    for image_index in range(len(category_list)):
+      key = get_bottleneck_key(image_lists, label_name, image_index, image_dir,
+                               'training', architecture)
+      filename = get_image_path(image_lists, label_name, image_index,
+                                image_dir, 'training')
+      for variant in range(variants):
+        rows.append(store.row(get_augmented_bottleneck_key(key, distortions,
+                                                           variant)))
+        label_indices.append(label_index)
+        filenames.append(filename)
+  bottlenecks, scales = store.raw_rows(np.array(rows, dtype=np.int64))
+  return ResidentBottlenecks(bottlenecks, scales,
+                             np.array(label_indices, dtype=np.int64),
+                             filenames)
+
+
+def get_random_augmented_bottlenecks(bank, variants, how_many, sampler):
+  """Draws a batch of training images, each as one of its cached variants.
 
+  Args:
+    bank: ResidentBottlenecks returned by load_augmented_bottlenecks.
+    variants: Integer number of distorted variants per image.
+    how_many: Integer number of bottlenecks to return. If negative, every
+    image is returned once.
+    sampler: BottleneckSampler for the training split.
 
-def get_random_distorted_bottlenecks(
-    sess, image_lists, how_many, category, image_dir, input_jpeg_tensor,
-    distorted_image, resized_input_tensor, bottleneck_tensor):
-  """Retrieves bottleneck values for training images, after distortions.
+  Returns:
+    Array of bottlenecks, array of one-hot ground truths, and list of image
+    file names.
+  """
+  rows = sampler.sample(how_many)
+  picks = rows * variants + sampler.rng.randint(variants, size=len(rows))
+  scales = None if bank.scales is None else bank.scales[picks]
+  return (dequantize_bottlenecks(bank.bottlenecks[picks], scales),
+          sampler.ground_truth(rows), [bank.filenames[pick] for pick in picks])
 
-  If we're training with distortions like crops, scales, or flips, we have to
-  recalculate the full model for every image, and so we can't use cached
-  bottleneck values. Instead we find random images for the requested category,
-  run them through the distortion graph, and then the full graph to get the
-  bottleneck results for each.
+
+def report_bottleneck_precision(sess, image_lists, image_dir, bottleneck_dir,
+                                architecture, precision, jpeg_data_tensor,
+                                decoded_image_tensor, resized_input_tensor,
+                                bottleneck_tensor, evaluation_step,
+                                bottleneck_input, ground_truth_input):
+  """Logs what reduced-precision bottleneck storage saves and what it costs.
+
+  Disk use of the stores is compared with what float32 storage would take. To
+  measure the accuracy cost, the test images are run through the network again
+  into a temporary float32 store, and the trained layer is evaluated on both
+  those and the dequantized stored bottlenecks.
 
   Args:
-    sess: Current TensorFlow Session.
+    sess: The current active TensorFlow Session.
     image_lists: Dictionary of training images for each label.
-    how_many: The integer number of bottleneck values to return.
-    category: Name string of which set of images to fetch - training, testing,
-    or validation.
     image_dir: Root folder string of the subfolders containing the training
     images.
-    input_jpeg_tensor: The input layer we feed the image data to.
-    distorted_image: The output node of the distortion graph.
+    bottleneck_dir: Folder string holding the bottleneck stores.
+    architecture: The name of the model architecture.
+    precision: Name string of the bottleneck storage precision.
+    jpeg_data_tensor: Input tensor for jpeg data from file.
+    decoded_image_tensor: The output of decoding and resizing the image.
     resized_input_tensor: The input node of the recognition graph.
-    bottleneck_tensor: The bottleneck output layer of the CNN graph.
+    bottleneck_tensor: The penultimate output layer of the graph.
+    evaluation_step: The accuracy tensor from add_evaluation_step.
+    bottleneck_input: The bottleneck placeholder of the new layer.
+    ground_truth_input: The ground truth placeholder of the new layer.
+  """
+  stored_bytes = 0
+  float32_bytes = 0
+  for category in ['training', 'testing', 'validation']:
+    store = get_bottleneck_store(bottleneck_dir, category, architecture,
+                                 precision)
+    if store.matrix is None:
+      continue
+    stored_bytes += store.disk_bytes()
+    float32_bytes += (store.disk_bytes() - store.matrix.nbytes -
+                      (0 if store.scales is None else store.scales.nbytes) +
+                      store.matrix.size * 4)
+  tf.logging.info('Bottleneck stores take %.1f MB on disk as %s, %.1f MB as '
+                  'float32' % (stored_bytes / 1e6, precision,
+                               float32_bytes / 1e6))
+
+  store = get_bottleneck_store(bottleneck_dir, 'testing', architecture,
+                               precision)
+  reference_dir = tempfile.mkdtemp()
+  try:
+    reference_store = BottleneckStore(reference_dir, architecture, 'testing')
+    keys = []
+    pending = collections.OrderedDict()
+    for label_name, label_lists in image_lists.items():
+      for index, unused_base_name in enumerate(label_lists['testing']):
+        key = get_bottleneck_key(image_lists, label_name, index, image_dir,
+                                 'testing', architecture)
+        image_path = get_image_path(image_lists, label_name, index, image_dir,
+                                    'testing')
+        keys.append(key)
+        pending.setdefault(key, (image_path, [reference_store]))
+    create_missing_bottlenecks(sess, list(pending.items()), jpeg_data_tensor,
+                               decoded_image_tensor, resized_input_tensor,
+                               bottleneck_tensor, FLAGS.bottleneck_batch_size,
+                               FLAGS.decode_workers, FLAGS.prefetch_queue_size)
+    reference_bottlenecks = reference_store.rows(
+        np.array([reference_store.row(key) for key in keys], dtype=np.int64))
+    stored_bottlenecks = store.rows(
+        np.array([store.row(key) for key in keys], dtype=np.int64))
+    reference_store.matrix = None
+  finally:
+    shutil.rmtree(reference_dir)
+  sampler = BottleneckSampler(image_lists, 'testing')
+  ground_truth = sampler.ground_truth(sampler.sample(-1))
+  reference_accuracy = sess.run(
+      evaluation_step, feed_dict={bottleneck_input: reference_bottlenecks,
+                                  ground_truth_input: ground_truth})
+  stored_accuracy = sess.run(
+      evaluation_step, feed_dict={bottleneck_input: stored_bottlenecks,
+                                  ground_truth_input: ground_truth})
+  tf.logging.info('Test accuracy with float32 bottlenecks = %.2f%%, with %s '
+                  'bottlenecks = %.2f%% (delta %+.2f%%, mean absolute error '
+                  '%g, N=%d)' %
+                  (reference_accuracy * 100, precision,
+                   stored_accuracy * 100,
+                   (stored_accuracy - reference_accuracy) * 100,
+                   np.mean(np.abs(stored_bottlenecks - reference_bottlenecks)),
+                   len(keys)))
+
+
+def report_augmentation(sess, image_lists, bank_step_secs, init, train_step,
+                        evaluation_step, cross_entropy, prediction,
+                        bottleneck_input, ground_truth_input, jpeg_data_tensor,
+                        decoded_image_tensor, distorted_jpeg_data_tensor,
+                        resized_input_tensor, bottleneck_tensor):
+  """Compares training on the augmented bank with no and live augmentation.
+
+  The layer trained on the bank is evaluated on the whole test set first,
+  streamed through in chunks like the final test evaluation. The new layer is
+  then reinitialized and retrained for the same number of steps, once on the
+  plain cached bottlenecks and once with live distortions, and evaluated the
+  same way. The log shows the test accuracy, mean step time and cache size of
+  each approach. The trained weights are overwritten, so this has to run after
+  the graph has been exported.
 
-  Returns:
-    List of bottleneck arrays and their corresponding ground truths.
+  Args:
+    sess: The current active TensorFlow Session.
+    image_lists: Dictionary of training images for each label.
+    bank_step_secs: Mean seconds per training step on the bank.
+    init: Operation initializing the weights of the new layer.
+    train_step: The training operation of the new layer.
+    evaluation_step: The accuracy tensor from add_evaluation_step.
+    cross_entropy: The mean cross entropy tensor from add_final_training_ops.
+    prediction: The predicted label index tensor from add_evaluation_step.
+    bottleneck_input: The bottleneck placeholder of the new layer.
+    ground_truth_input: The ground truth placeholder of the new layer.
+    jpeg_data_tensor: Input tensor for jpeg data from file.
+    decoded_image_tensor: The decoded image from create_model_graph.
+    distorted_jpeg_data_tensor: The distortion input from create_model_graph.
+    resized_input_tensor: The input node of the recognition graph.
+    bottleneck_tensor: The penultimate output layer of the graph.
   """
-  class_count = len(image_lists.keys())
-  bottlenecks = []
-  ground_truths = []
-  for unused_i in range(how_many):
-    label_index = random.randrange(class_count)
-    label_name = list(image_lists.keys())[label_index]
-    image_index = random.randrange(MAX_NUM_IMAGES_PER_CLASS + 1)
-    image_path = get_image_path(image_lists, label_name, image_index, image_dir,
-                                category)
-    if not gfile.Exists(image_path):
-      tf.logging.fatal('File does not exist %s', image_path)
-    jpeg_data = gfile.FastGFile(image_path, 'rb').read()
-    # Note that we materialize the distorted_image_data as a numpy array before
-    # sending running inference on the image. This involves 2 memory copies and
-    # might be optimized in other implementations.
-    distorted_image_data = sess.run(distorted_image,
-                                    {input_jpeg_tensor: jpeg_data})
-    bottleneck_values = sess.run(bottleneck_tensor,
-                                 {resized_input_tensor: distorted_image_data})
-    bottleneck_values = np.squeeze(bottleneck_values)
-    ground_truth = np.zeros(class_count, dtype=np.float32)
-    ground_truth[label_index] = 1.0
-    bottlenecks.append(bottleneck_values)
-    ground_truths.append(ground_truth)
-  return bottlenecks, ground_truths
+  def test_accuracy():
+    return evaluate_in_chunks(
+        sess, iterate_cached_bottleneck_chunks(
+            sess, image_lists, -1, 'testing', FLAGS.eval_chunk_size,
+            FLAGS.bottleneck_dir, FLAGS.image_dir, jpeg_data_tensor,
+            decoded_image_tensor, resized_input_tensor, bottleneck_tensor,
+            FLAGS.architecture, FLAGS.bottleneck_precision),
+        evaluation_step, cross_entropy, prediction, bottleneck_input,
+        ground_truth_input)[0]
+
+  def retrain(get_batch):
+    sess.run(init)
+    start_time = time.time()
+    for _ in range(FLAGS.how_many_training_steps):
+      train_bottlenecks, train_ground_truth = get_batch()[:2]
+      sess.run(train_step,
+               feed_dict={bottleneck_input: train_bottlenecks,
+                          ground_truth_input: train_ground_truth})
+    step_secs = ((time.time() - start_time) /
+                 max(FLAGS.how_many_training_steps, 1))
+    return test_accuracy(), step_secs
+
+  augmented_store = get_bottleneck_store(FLAGS.bottleneck_dir, 'augmented',
+                                         FLAGS.architecture,
+                                         FLAGS.bottleneck_precision)
+  training_store = get_bottleneck_store(FLAGS.bottleneck_dir, 'training',
+                                        FLAGS.architecture,
+                                        FLAGS.bottleneck_precision)
+  results = [('augmented bank', test_accuracy(), bank_step_secs,
+              augmented_store.disk_bytes())]
+
+  sampler = BottleneckSampler(image_lists, 'training', FLAGS.sampling_mode,
+                              exponent=FLAGS.sampling_exponent)
+  plain = load_resident_bottlenecks(image_lists, 'training', FLAGS.image_dir,
+                                    FLAGS.bottleneck_dir, FLAGS.architecture,
+                                    FLAGS.bottleneck_precision)
+  accuracy, step_secs = retrain(lambda: get_random_resident_bottlenecks(
+      plain, FLAGS.train_batch_size, sampler))
+  results.append(('no augmentation', accuracy, step_secs,
+                  training_store.disk_bytes()))
+
+  distorted_batches = prefetch_distorted_bottlenecks(
+      sess, image_lists, FLAGS.how_many_training_steps,
+      FLAGS.train_batch_size, 'training', FLAGS.image_dir,
+      distorted_jpeg_data_tensor, bottleneck_tensor, sampler,
+      FLAGS.distortion_workers, FLAGS.distortion_queue_size)
+  accuracy, step_secs = retrain(lambda: get_random_distorted_bottlenecks(
+      sess, image_lists, FLAGS.train_batch_size, 'training', FLAGS.image_dir,
+      distorted_jpeg_data_tensor, bottleneck_tensor, sampler,
+      next(distorted_batches)))
+  results.append(('live distortion', accuracy, step_secs, 0))
+
+  tf.logging.info('%-16s %14s %14s %14s' %
+                  ('training data', 'test accuracy', 'step time', 'cache size'))
+  for name, accuracy, step_secs, cache_bytes in results:
+    tf.logging.info('%-16s %13.1f%% %12.1fms %11.1f MB' %
+                    (name, accuracy * 100, step_secs * 1000,
+                     cache_bytes / 1e6))
 
 
 def should_distort_images(flip_left_right, random_crop, random_scale,
@@ -623,9 +3295,25 @@ def should_distort_images(flip_left_right, random_crop, random_scale,
           (random_brightness != 0))
 
 
+def decode_jpeg_or_png(image_data, input_depth):
+  """Adds an operation decoding a JPEG or PNG image, whichever the data holds.
+
+  Args:
+    image_data: String tensor holding the encoded image.
+    input_depth: Desired channels of the decoded image.
+
+  Returns:
+    Uint8 tensor of the decoded image.
+  """
+  return tf.cond(
+      tf.image.is_jpeg(image_data),
+      lambda: tf.image.decode_jpeg(image_data, channels=input_depth),
+      lambda: tf.image.decode_png(image_data, channels=input_depth))
+
+
 def add_input_distortions(flip_left_right, random_crop, random_scale,
                           random_brightness, input_width, input_height,
-                          input_depth, input_mean, input_std):
+                          input_depth, input_mean, input_std, jpeg_data=None):
   """Creates the operations to apply the specified distortions.
 
   During training it can help to improve the results if we run the images
@@ -678,13 +3366,16 @@ def add_input_distortions(flip_left_right, random_crop, random_scale,
     input_depth: How many channels the expected input image should have.
     input_mean: Pixel value that should be zero in the image for the graph.
     input_std: How much to divide the pixel values by before recognition.
+    jpeg_data: Optional string tensor holding the JPEG data to distort. A new
+    placeholder is created if it's None.
 
   Returns:
     The jpeg input layer and the distorted result tensor.
   """
 
-  jpeg_data = tf.placeholder(tf.string, name='DistortJPGInput')
-  decoded_image = tf.image.decode_jpeg(jpeg_data, channels=input_depth)
+  if jpeg_data is None:
+    jpeg_data = tf.placeholder(tf.string, name='DistortJPGInput')
+  decoded_image = decode_jpeg_or_png(jpeg_data, input_depth)
   decoded_image_as_float = tf.cast(decoded_image, dtype=tf.float32)
   decoded_image_4d = tf.expand_dims(decoded_image_as_float, 0)
   margin_scale = 1.0 + (random_crop / 100.0)
@@ -719,17 +3410,23 @@ def add_input_distortions(flip_left_right, random_crop, random_scale,
   return jpeg_data, distort_result
 
 
+# Collection of the summaries added by variable_summaries, which are only
+# recorded under the 'all' summary mode.
+VARIABLE_SUMMARIES = 'variable_summaries'
+
+
 def variable_summaries(var):
   """Attach a lot of summaries to a Tensor (for TensorBoard visualization)."""
+  collections = [tf.GraphKeys.SUMMARIES, VARIABLE_SUMMARIES]
   with tf.name_scope('summaries'):
     mean = tf.reduce_mean(var)
-    tf.summary.scalar('mean', mean)
+    tf.summary.scalar('mean', mean, collections=collections)
     with tf.name_scope('stddev'):
       stddev = tf.sqrt(tf.reduce_mean(tf.square(var - mean)))
-    tf.summary.scalar('stddev', stddev)
-    tf.summary.scalar('max', tf.reduce_max(var))
-    tf.summary.scalar('min', tf.reduce_min(var))
-    tf.summary.histogram('histogram', var)
+    tf.summary.scalar('stddev', stddev, collections=collections)
+    tf.summary.scalar('max', tf.reduce_max(var), collections=collections)
+    tf.summary.scalar('min', tf.reduce_min(var), collections=collections)
+    tf.summary.histogram('histogram', var, collections=collections)
 
 
 def add_final_training_ops(class_count, final_tensor_name, bottleneck_tensor,
@@ -800,43 +3497,818 @@ def add_final_training_ops(class_count, final_tensor_name, bottleneck_tensor,
           final_tensor)
 
 
-def add_evaluation_step(result_tensor, ground_truth_tensor):
-  """Inserts the operations we need to evaluate the accuracy of our results.
+def add_evaluation_step(result_tensor, ground_truth_tensor):
+  """Inserts the operations we need to evaluate the accuracy of our results.
+
+  Args:
+    result_tensor: The new final node that produces results.
+    ground_truth_tensor: The node we feed ground truth data
+    into.
+
+  Returns:
+    Tuple of (evaluation step, prediction).
+  """
+  with tf.name_scope('accuracy'):
+    with tf.name_scope('correct_prediction'):
+      prediction = tf.argmax(result_tensor, 1)
+      correct_prediction = tf.equal(
+          prediction, tf.argmax(ground_truth_tensor, 1))
+    with tf.name_scope('accuracy'):
+      evaluation_step = tf.reduce_mean(tf.cast(correct_prediction, tf.float32))
+  tf.summary.scalar('accuracy', evaluation_step)
+  return evaluation_step, prediction
+
+
+def evaluate_in_chunks(sess, chunks, evaluation_step, cross_entropy,
+                       prediction, bottleneck_input, ground_truth_input,
+                       keep_misclassified=False):
+  """Evaluates the new layer on a stream of chunks of bottlenecks.
+
+  Each chunk is run on its own and only running totals are kept, weighted by
+  the chunk sizes so the results match a single run over everything, so the
+  memory used doesn't grow with the number of chunks.
+
+  Args:
+    sess: Current active TensorFlow Session.
+    chunks: Iterable of (bottlenecks, ground truths, filenames) chunks, like
+    those of iterate_cached_bottleneck_chunks.
+    evaluation_step: The accuracy tensor from add_evaluation_step.
+    cross_entropy: The mean cross entropy tensor from add_final_training_ops.
+    prediction: The predicted label index tensor from add_evaluation_step.
+    bottleneck_input: The bottleneck placeholder of the new layer.
+    ground_truth_input: The ground truth placeholder of the new layer.
+    keep_misclassified: Whether to collect the misclassified images.
+
+  Returns:
+    Tuple of the accuracy, the mean cross entropy, the number of bottlenecks
+    evaluated, the int64 array of predicted label indices, and a list of
+    (filename, predicted label index) pairs of the misclassified images if
+    keep_misclassified is set.
+  """
+  how_many = 0
+  correct = 0.0
+  cross_entropy_sum = 0.0
+  predictions = []
+  misclassified = []
+  for bottlenecks, ground_truth, filenames in chunks:
+    accuracy, cross_entropy_value, chunk_predictions = sess.run(
+        [evaluation_step, cross_entropy, prediction],
+        feed_dict={bottleneck_input: bottlenecks,
+                   ground_truth_input: ground_truth})
+    how_many += len(chunk_predictions)
+    correct += accuracy * len(chunk_predictions)
+    cross_entropy_sum += cross_entropy_value * len(chunk_predictions)
+    predictions.append(np.asarray(chunk_predictions, dtype=np.int64))
+    if keep_misclassified:
+      labels = np.argmax(ground_truth, axis=1)
+      misclassified.extend(
+          (filenames[i], chunk_predictions[i])
+          for i in np.flatnonzero(chunk_predictions != labels))
+  if not how_many:
+    return 0.0, 0.0, 0, np.zeros([0], dtype=np.int64), misclassified
+  return (correct / how_many, cross_entropy_sum / how_many, how_many,
+          np.concatenate(predictions), misclassified)
+
+
+SUMMARY_MODES = ('all', 'scalars', 'none')
+
+
+def add_summary_op(summary_mode):
+  """Merges the summaries that are recorded under a summary mode.
+
+  Args:
+    summary_mode: Name string of the mode, one of SUMMARY_MODES. 'all' records
+    every summary in the graph, including the histograms and statistics from
+    variable_summaries, 'scalars' only the other scalar summaries such as
+    accuracy and cross entropy, and 'none' nothing at all.
+
+  Returns:
+    The merged summary op, or None if nothing is recorded.
+
+  Raises:
+    ValueError: If the mode is unknown.
+  """
+  if summary_mode not in SUMMARY_MODES:
+    raise ValueError('Unknown summary mode', summary_mode)
+  if summary_mode == 'none':
+    return None
+  summaries = tf.get_collection(tf.GraphKeys.SUMMARIES)
+  if summary_mode == 'scalars':
+    variable_summary_set = set(tf.get_collection(VARIABLE_SUMMARIES))
+    summaries = [summary for summary in summaries
+                 if summary.op.type == 'ScalarSummary' and
+                 summary not in variable_summary_set]
+  if not summaries:
+    return None
+  return tf.summary.merge(summaries)
+
+
+def run_train_step(sess, step, train_step, summary_op, summary_interval,
+                   train_writer, feed_dict):
+  """Runs a training step, recording summaries every summary_interval steps.
+
+  Args:
+    sess: Current active TensorFlow Session.
+    step: Integer index of the training step.
+    train_step: The training operation of the new layer.
+    summary_op: Merged summary op from add_summary_op, or None.
+    summary_interval: Integer number of steps between recorded summaries, or
+    zero or less to never record them.
+    train_writer: FileWriter for the training summaries, or None if summary_op
+    is None.
+    feed_dict: Dictionary feeding the bottleneck and ground truth inputs.
+
+  Returns:
+    Whether summaries were recorded for this step.
+  """
+  if (summary_op is None or summary_interval <= 0 or
+      step % summary_interval != 0):
+    sess.run(train_step, feed_dict=feed_dict)
+    return False
+  train_summary, _ = sess.run([summary_op, train_step], feed_dict=feed_dict)
+  train_writer.add_summary(train_summary, step)
+  return True
+
+
+class EarlyStopping(object):
+  """Tracks validation results and decides when training has stopped helping.
+
+  Each evaluation is smoothed over a moving window of the last few
+  evaluations. The smoothed value counts as an improvement when it beats the
+  best one so far by more than min_delta, and training should stop once
+  patience evaluations in a row have brought no improvement.
+  """
+
+  METRICS = ('cross_entropy', 'accuracy')
+
+  def __init__(self, metric='cross_entropy', patience=0, min_delta=0.0,
+               window=1):
+    """Sets up the tracker.
+
+    Args:
+      metric: Name string of the validation metric to watch, one of METRICS.
+      patience: Integer number of evaluations without improvement to allow
+      before stopping. Zero never stops.
+      min_delta: Float smallest change of the smoothed metric that counts as
+      an improvement.
+      window: Integer number of evaluations to average the metric over.
+
+    Raises:
+      ValueError: If the metric is unknown.
+    """
+    if metric not in self.METRICS:
+      raise ValueError('Unknown early stopping metric', metric)
+    self.metric = metric
+    self.patience = patience
+    self.min_delta = min_delta
+    self.recent = collections.deque(maxlen=max(1, window))
+    self.best = None
+    self.evaluations_since_best = 0
+
+  def update(self, accuracy, cross_entropy):
+    """Records an evaluation and returns whether it is the best so far.
+
+    Args:
+      accuracy: Float validation accuracy.
+      cross_entropy: Float validation cross entropy.
+
+    Returns:
+      True if the smoothed metric improved on the best so far.
+    """
+    if self.metric == 'accuracy':
+      self.recent.append(accuracy)
+    else:
+      # Lower is better, so track the negated value.
+      self.recent.append(-cross_entropy)
+    smoothed = np.mean(self.recent)
+    if self.best is None or smoothed > self.best + self.min_delta:
+      self.best = smoothed
+      self.evaluations_since_best = 0
+      return True
+    self.evaluations_since_best += 1
+    return False
+
+  def should_stop(self):
+    """Whether patience has run out."""
+    return 0 < self.patience <= self.evaluations_since_best
+
+  def best_value(self):
+    """Returns the best smoothed value of the metric."""
+    return self.best if self.metric == 'accuracy' else -self.best
+
+
+TRAINERS = ('tensorflow', 'sgd', 'lbfgs')
+
+
+def softmax_cross_entropy(weights, biases, bottlenecks, ground_truth):
+  """Evaluates the new layer's loss and its gradients with NumPy.
+
+  Args:
+    weights: Array of shape [bottleneck size, class count].
+    biases: Array of shape [class count].
+    bottlenecks: Array of shape [batch size, bottleneck size].
+    ground_truth: One-hot array of shape [batch size, class count].
+
+  Returns:
+    The mean softmax cross entropy over the batch, and its gradients with
+    respect to the weights and the biases.
+  """
+  logits = np.dot(bottlenecks, weights) + biases
+  logits -= logits.max(axis=1, keepdims=True)
+  exp_logits = np.exp(logits)
+  sum_exp = exp_logits.sum(axis=1, keepdims=True)
+  log_probabilities = logits - np.log(sum_exp)
+  batch_size = len(bottlenecks)
+  loss = -np.sum(ground_truth * log_probabilities) / batch_size
+  delta = (exp_logits / sum_exp - ground_truth) / batch_size
+  return loss, np.dot(bottlenecks.T, delta), delta.sum(axis=0)
+
+
+def train_softmax_sgd(weights, biases, get_batch, steps, learning_rate,
+                      momentum=0.9, log_interval=100):
+  """Trains the new layer with mini-batch SGD with momentum in NumPy.
+
+  Args:
+    weights: Initial array of shape [bottleneck size, class count].
+    biases: Initial array of shape [class count].
+    get_batch: Function returning a (bottlenecks, ground truth) batch, as
+    arrays or lists of rows.
+    steps: Integer number of training steps.
+    learning_rate: Float learning rate.
+    momentum: Float momentum coefficient.
+    log_interval: Integer number of steps between logged losses.
+
+  Returns:
+    The trained weights and biases.
+  """
+  weights = np.array(weights, dtype=np.float32)
+  biases = np.array(biases, dtype=np.float32)
+  weights_velocity = np.zeros_like(weights)
+  biases_velocity = np.zeros_like(biases)
+  for step in range(steps):
+    bottlenecks, ground_truth = get_batch()
+    # Batches read from the bottleneck store come back as lists of rows.
+    loss, weights_gradient, biases_gradient = softmax_cross_entropy(
+        weights, biases, np.asarray(bottlenecks, dtype=np.float32),
+        np.asarray(ground_truth, dtype=np.float32))
+    weights_velocity *= momentum
+    weights_velocity -= learning_rate * weights_gradient
+    biases_velocity *= momentum
+    biases_velocity -= learning_rate * biases_gradient
+    weights += weights_velocity
+    biases += biases_velocity
+    if step % log_interval == 0 or step + 1 == steps:
+      tf.logging.info('%s: Step %d: Cross entropy = %f' %
+                      (datetime.now(), step, loss))
+  return weights, biases
+
+
+def train_softmax_lbfgs(weights, biases, bottlenecks, ground_truth,
+                        iterations, history=10, log_interval=10):
+  """Trains the new layer with full-batch L-BFGS in NumPy.
+
+  Search directions come from the usual two-loop recursion over the last
+  history steps, and a backtracking line search picks the step length.
+
+  Args:
+    weights: Initial array of shape [bottleneck size, class count].
+    biases: Initial array of shape [class count].
+    bottlenecks: Array of every training bottleneck.
+    ground_truth: One-hot array of the matching ground truths.
+    iterations: Integer maximum number of L-BFGS iterations.
+    history: Integer number of past steps approximating the curvature.
+    log_interval: Integer number of iterations between logged losses.
+
+  Returns:
+    The trained weights, the trained biases, and the integer number of
+    iterations run.
+  """
+  weights_size = weights.size
+
+  def evaluate(parameters):
+    loss, weights_gradient, biases_gradient = softmax_cross_entropy(
+        parameters[:weights_size].reshape(weights.shape),
+        parameters[weights_size:], bottlenecks, ground_truth)
+    return loss, np.concatenate([weights_gradient.ravel(), biases_gradient])
+
+  parameters = np.concatenate([np.ravel(weights), np.ravel(biases)]).astype(
+      np.float64)
+  loss, gradient = evaluate(parameters)
+  corrections = collections.deque(maxlen=history)
+  iteration = 0
+  while iteration < iterations:
+    direction = -gradient
+    alphas = []
+    for position_change, gradient_change, rho in reversed(corrections):
+      alpha = rho * np.dot(position_change, direction)
+      direction -= alpha * gradient_change
+      alphas.append(alpha)
+    if corrections:
+      position_change, gradient_change, _ = corrections[-1]
+      direction *= (np.dot(position_change, gradient_change) /
+                    np.dot(gradient_change, gradient_change))
+    for (position_change, gradient_change, rho), alpha in zip(
+        corrections, reversed(alphas)):
+      beta = rho * np.dot(gradient_change, direction)
+      direction += position_change * (alpha - beta)
+    slope = np.dot(gradient, direction)
+    if slope >= 0:
+      # Not a descent direction, so start again from steepest descent.
+      corrections.clear()
+      direction = -gradient
+      slope = -np.dot(gradient, gradient)
+    step_length = 1.0
+    while True:
+      new_parameters = parameters + step_length * direction
+      new_loss, new_gradient = evaluate(new_parameters)
+      if new_loss <= loss + 1e-4 * step_length * slope or step_length < 1e-10:
+        break
+      step_length *= 0.5
+    position_change = new_parameters - parameters
+    gradient_change = new_gradient - gradient
+    curvature = np.dot(position_change, gradient_change)
+    if curvature > 1e-10:
+      corrections.append((position_change, gradient_change, 1.0 / curvature))
+    parameters, loss, gradient = new_parameters, new_loss, new_gradient
+    iteration += 1
+    if iteration % log_interval == 0 or iteration == iterations:
+      tf.logging.info('%s: Iteration %d: Cross entropy = %f' %
+                      (datetime.now(), iteration, loss))
+    if np.max(np.abs(gradient)) < 1e-6:
+      break
+  return (parameters[:weights_size].reshape(weights.shape).astype(np.float32),
+          parameters[weights_size:].astype(np.float32), iteration)
+
+
+def train_final_layer_with_numpy(sess, trainer, get_train_batch, train_data,
+                                 final_layer_variables):
+  """Trains the new layer outside the session and loads it into the graph.
+
+  The weights start from the values the graph initialized them to, and the
+  trained ones are loaded back into the final_weights and final_biases
+  variables, so evaluation and export work exactly as after TensorFlow
+  training.
+
+  Args:
+    sess: Current active TensorFlow Session.
+    trainer: Name string of the NumPy trainer, 'sgd' or 'lbfgs'.
+    get_train_batch: Function taking an ignored argument and returning a
+    (bottlenecks, ground truth) training batch, used by 'sgd'.
+    train_data: ResidentBottlenecks holding every training bottleneck, used
+    by 'lbfgs'.
+    final_layer_variables: The weights and biases variables of the new layer.
+
+  Returns:
+    The integer number of steps or iterations run and the seconds they took.
+  """
+  weights_variable, biases_variable = sorted(
+      final_layer_variables,
+      key=lambda variable: variable.op.name.endswith('final_biases'))
+  weights, biases = sess.run([weights_variable, biases_variable])
+  start_time = time.time()
+  if trainer == 'sgd':
+    how_many_steps = FLAGS.how_many_training_steps
+    weights, biases = train_softmax_sgd(
+        weights, biases, lambda: get_train_batch(None), how_many_steps,
+        FLAGS.learning_rate, FLAGS.momentum, FLAGS.eval_step_interval)
+  else:
+    bottlenecks = dequantize_bottlenecks(train_data.bottlenecks,
+                                         train_data.scales)
+    ground_truth = np.eye(len(biases),
+                          dtype=np.float32)[train_data.label_indices]
+    weights, biases, how_many_steps = train_softmax_lbfgs(
+        weights, biases, bottlenecks, ground_truth, FLAGS.lbfgs_iterations)
+  training_secs = time.time() - start_time
+  weights_variable.load(weights, sess)
+  biases_variable.load(biases, sess)
+  return how_many_steps, training_secs
+
+
+# Data shared by the training heads of a sweep, set in each worker process by
+# init_sweep_worker.
+sweep_data = None
+
+
+def share_resident_bottlenecks(resident, path):
+  """Writes bottlenecks held in memory to files other processes can map.
+
+  Args:
+    resident: ResidentBottlenecks to share.
+    path: Path string prefix of the .npy files to write.
+
+  Returns:
+    Picklable tuple of the paths of the bottleneck and scale files, the label
+    indices, and the filenames, for open_shared_bottlenecks.
+  """
+  bottlenecks_path = path + '.npy'
+  np.save(bottlenecks_path, resident.bottlenecks)
+  scales_path = None
+  if resident.scales is not None:
+    scales_path = path + '.scales.npy'
+    np.save(scales_path, resident.scales)
+  return (bottlenecks_path, scales_path, resident.label_indices,
+          resident.filenames)
+
+
+def open_shared_bottlenecks(shared):
+  """Maps the files written by share_resident_bottlenecks, read-only.
+
+  Args:
+    shared: Tuple returned by share_resident_bottlenecks.
+
+  Returns:
+    ResidentBottlenecks whose bottlenecks and scales are memory-mapped.
+  """
+  bottlenecks_path, scales_path, label_indices, filenames = shared
+  scales = None
+  if scales_path is not None:
+    scales = np.load(scales_path, mmap_mode='r')
+  return ResidentBottlenecks(np.load(bottlenecks_path, mmap_mode='r'), scales,
+                             label_indices, filenames)
+
+
+def init_sweep_worker(flags, train_data, variants, validation_data,
+                      image_lists):
+  """Keeps the data every head of a sweep trains on in a worker process.
+
+  Args:
+    flags: The parsed flags of the parent process.
+    train_data: Training bottlenecks from share_resident_bottlenecks.
+    variants: Integer number of consecutive rows per training image.
+    validation_data: Validation bottlenecks from share_resident_bottlenecks.
+    image_lists: Dictionary of training images for each label.
+  """
+  global FLAGS, sweep_data
+  FLAGS = flags
+  sweep_data = (open_shared_bottlenecks(train_data), variants,
+                open_shared_bottlenecks(validation_data), image_lists)
+  tf.logging.set_verbosity(tf.logging.WARN)
+
+
+def train_sweep_head(head_args):
+  """Trains one head of a sweep in a worker process.
+
+  The head is the layer from add_final_training_ops on top of a placeholder
+  rather than the full network, trained with --trainer on the bottlenecks
+  held by init_sweep_worker, and evaluated on the whole validation set.
+
+  Args:
+    head_args: Tuple of the float learning rate, the integer batch size, and
+    the integer intra-op thread count of the head's session.
+
+  Returns:
+    Tuple of the learning rate, the batch size, the trained weights and
+    biases, the validation accuracy, and the training seconds.
+  """
+  learning_rate, batch_size, threads = head_args
+  FLAGS.learning_rate = learning_rate
+  FLAGS.train_batch_size = batch_size
+  train_data, variants, validation_data, image_lists = sweep_data
+  sampler = BottleneckSampler(image_lists, 'training', FLAGS.sampling_mode,
+                              exponent=FLAGS.sampling_exponent)
+  bottleneck_size = train_data.bottlenecks.shape[1]
+  class_count = len(image_lists.keys())
+
+  def get_train_batch(unused_step):
+    return get_random_augmented_bottlenecks(train_data, variants, batch_size,
+                                            sampler)[:2]
+
+  with tf.Graph().as_default() as graph:
+    bottleneck_tensor = tf.placeholder(tf.float32, [None, bottleneck_size])
+    (train_step, cross_entropy, bottleneck_input, ground_truth_input,
+     final_tensor) = add_final_training_ops(class_count,
+                                            FLAGS.final_tensor_name,
+                                            bottleneck_tensor, bottleneck_size)
+    evaluation_step, prediction = add_evaluation_step(final_tensor,
+                                                      ground_truth_input)
+    final_layer_variables = tf.trainable_variables()
+    config = tf.ConfigProto(intra_op_parallelism_threads=threads,
+                            inter_op_parallelism_threads=threads)
+    with tf.Session(graph=graph, config=config) as sess:
+      sess.run(tf.global_variables_initializer())
+      if FLAGS.trainer == 'tensorflow':
+        start_time = time.time()
+        for _ in range(FLAGS.how_many_training_steps):
+          train_bottlenecks, train_ground_truth = get_train_batch(None)
+          sess.run(train_step,
+                   feed_dict={bottleneck_input: train_bottlenecks,
+                              ground_truth_input: train_ground_truth})
+        training_secs = time.time() - start_time
+      else:
+        _, training_secs = train_final_layer_with_numpy(
+            sess, FLAGS.trainer, get_train_batch, train_data,
+            final_layer_variables)
+      validation_accuracy, _, _, _, _ = evaluate_in_chunks(
+          sess, iterate_resident_bottleneck_chunks(
+              validation_data, -1, FLAGS.eval_chunk_size,
+              BottleneckSampler(image_lists, 'validation')),
+          evaluation_step, cross_entropy, prediction, bottleneck_input,
+          ground_truth_input)
+      weights, biases = sess.run(sorted(
+          final_layer_variables,
+          key=lambda variable: variable.op.name.endswith('final_biases')))
+  return (learning_rate, batch_size, weights, biases, validation_accuracy,
+          training_secs)
+
+
+def run_sweep(sess, image_lists, train_data, variants, validation_data,
+              final_layer_variables, learning_rates, batch_sizes, num_workers):
+  """Trains a head for every combination of settings and keeps the best one.
+
+  The bottlenecks are loaded once by the caller and written to files under
+  --bottleneck_dir, which a pool of worker processes map rather than each
+  receiving its own copy, and the workers train the heads concurrently with
+  train_sweep_head. The head with the best validation accuracy is loaded into
+  final_layer_variables, so it is the one evaluated and exported, and every
+  head's timing and accuracy is logged as a table.
+
+  Args:
+    sess: Current active TensorFlow Session.
+    image_lists: Dictionary of training images for each label.
+    train_data: ResidentBottlenecks holding the training bottlenecks.
+    variants: Integer number of consecutive rows per training image, one
+    unless training on a bank of distorted variants.
+    validation_data: ResidentBottlenecks holding the validation bottlenecks.
+    final_layer_variables: The weights and biases variables of the new layer.
+    learning_rates: List of float learning rates to try.
+    batch_sizes: List of integer batch sizes to try.
+    num_workers: Integer number of worker processes.
+
+  Returns:
+    The seconds the whole sweep took.
+  """
+  head_settings = list(itertools.product(learning_rates, batch_sizes))
+  num_workers = max(1, min(num_workers, len(head_settings)))
+  threads = max(1, multiprocessing.cpu_count() // num_workers)
+  tf.logging.info('Training %d heads across %d processes' %
+                  (len(head_settings), num_workers))
+  if hasattr(multiprocessing, 'get_context'):
+    context = multiprocessing.get_context('spawn')
+  else:
+    context = multiprocessing
+  start_time = time.time()
+  results = []
+  shared_dir = tempfile.mkdtemp(prefix='sweep_', dir=FLAGS.bottleneck_dir)
+  try:
+    pool = context.Pool(
+        num_workers, initializer=init_sweep_worker,
+        initargs=(FLAGS,
+                  share_resident_bottlenecks(
+                      train_data, os.path.join(shared_dir, 'training')),
+                  variants,
+                  share_resident_bottlenecks(
+                      validation_data, os.path.join(shared_dir, 'validation')),
+                  image_lists))
+    try:
+      for result in pool.imap_unordered(
+          train_sweep_head, [(learning_rate, batch_size, threads)
+                             for learning_rate, batch_size in head_settings]):
+        results.append(result)
+    finally:
+      pool.close()
+      pool.join()
+  finally:
+    shutil.rmtree(shared_dir)
+  sweep_secs = time.time() - start_time
+
+  results.sort(key=lambda result: (result[0], result[1]))
+  best = max(results, key=lambda result: result[4])
+  tf.logging.info('%14s %11s %14s %20s' % ('learning rate', 'batch size',
+                                          'training time',
+                                          'validation accuracy'))
+  for result in results:
+    learning_rate, batch_size, _, _, validation_accuracy, training_secs = result
+    tf.logging.info('%14g %11d %13.1fs %19.1f%% %s' %
+                    (learning_rate, batch_size, training_secs,
+                     validation_accuracy * 100,
+                     '*' if result is best else ''))
+  tf.logging.info('Sweep of %d heads took %.1fs, exporting the head with '
+                  'learning rate %g and batch size %d' %
+                  (len(results), sweep_secs, best[0], best[1]))
+  weights_variable, biases_variable = sorted(
+      final_layer_variables,
+      key=lambda variable: variable.op.name.endswith('final_biases'))
+  weights_variable.load(best[2], sess)
+  biases_variable.load(best[3], sess)
+  return sweep_secs
+
+
+def restore_model_input(graph_def, model_input_name):
+  """Points a graph back at the model's own input, dropping fused decoding.
+
+  create_model_graph wires the JPEG decoding operations into the model's
+  input, but exported graphs should keep the input that label_image.py and
+  the mobile converters feed preprocessed images into. This has to be done
+  before the graph is frozen: the model's own input has no consumers until
+  it's rewired, so freezing would prune it.
+
+  Args:
+    graph_def: GraphDef of the whole training graph, before freezing.
+    model_input_name: Name of the model's input tensor, from create_model_info.
+
+  Returns:
+    The GraphDef, with the operations that read the fused decoding's output
+    reading the model's input instead. The fused decoding is no longer
+    reachable from the final result, so freezing drops it.
+  """
+  fused_input_name = FUSED_INPUT_SCOPE + '/ResizedInput'
+  model_input_name = model_input_name.split(':')[0]
+  for node in graph_def.node:
+    for i, input_name in enumerate(node.input):
+      if input_name == fused_input_name:
+        node.input[i] = model_input_name
+  return graph_def
+
+
+def save_head_checkpoint(sess, checkpoint_dir, step, head_variables, sampler,
+                         early_stopping, best_weights):
+  """Saves what is needed to carry on training the new layer from a step.
+
+  Only the variables of the new layer are saved, along with the step to carry
+  on from, the state of the training sampler, and the early stopping progress,
+  so a checkpoint is a few hundred KB rather than a frozen copy of the whole
+  network. It's written to a temporary file and renamed into place before the
+  previous checkpoint is removed, so a job stopped partway through a write
+  still leaves a complete checkpoint behind.
+
+  Args:
+    sess: Current active TensorFlow Session.
+    checkpoint_dir: Folder string to write the checkpoint to.
+    step: Integer number of training steps run so far.
+    head_variables: List of the variables of the new layer.
+    sampler: BottleneckSampler that training batches are drawn with.
+    early_stopping: EarlyStopping tracking the validation results.
+    best_weights: None, or tuple of the step and the variable values of the
+    best evaluation so far.
+
+  Returns:
+    Path string of the checkpoint written.
+  """
+  arrays = {'global_step': np.array(step)}
+  for variable, value in zip(head_variables, sess.run(head_variables)):
+    arrays['variable/' + variable.op.name] = value
+  for name, value in sampler.get_state().items():
+    arrays['sampler/' + name] = value
+  arrays['early_stopping/recent'] = np.array(list(early_stopping.recent),
+                                             dtype=np.float64)
+  arrays['early_stopping/best'] = np.array(
+      np.nan if early_stopping.best is None else early_stopping.best)
+  arrays['early_stopping/evaluations_since_best'] = np.array(
+      early_stopping.evaluations_since_best)
+  if best_weights is not None:
+    best_step, best_values = best_weights
+    arrays['best_step'] = np.array(best_step)
+    for variable, value in zip(head_variables, best_values):
+      arrays['best_variable/' + variable.op.name] = value
+
+  checkpoint_file = os.path.join(checkpoint_dir,
+                                 'head_checkpoint_%d.npz' % step)
+  with open(checkpoint_file + '.tmp', 'wb') as f:
+    np.savez(f, **arrays)
+  os.rename(checkpoint_file + '.tmp', checkpoint_file)
+  for file_name in os.listdir(checkpoint_dir):
+    path = os.path.join(checkpoint_dir, file_name)
+    if HEAD_CHECKPOINT_RE.match(file_name) and path != checkpoint_file:
+      os.remove(path)
+  return checkpoint_file
+
+
+def latest_head_checkpoint(checkpoint_dir):
+  """Returns the path of the newest checkpoint in a folder, or None."""
+  if not os.path.isdir(checkpoint_dir):
+    return None
+  steps = []
+  for file_name in os.listdir(checkpoint_dir):
+    match = HEAD_CHECKPOINT_RE.match(file_name)
+    if match:
+      steps.append((int(match.group(1)), file_name))
+  if not steps:
+    return None
+  return os.path.join(checkpoint_dir, max(steps)[1])
+
+
+def restore_head_checkpoint(sess, checkpoint_file, head_variables, sampler,
+                            early_stopping):
+  """Loads a checkpoint written by save_head_checkpoint.
+
+  Args:
+    sess: Current active TensorFlow Session.
+    checkpoint_file: Path string of the checkpoint.
+    head_variables: List of the variables of the new layer.
+    sampler: BottleneckSampler that training batches are drawn with.
+    early_stopping: EarlyStopping tracking the validation results.
+
+  Returns:
+    The integer step to carry on training from, and None or a tuple of the
+    step and the variable values of the best evaluation so far.
+
+  Raises:
+    ValueError: If the checkpoint is missing one of the variables.
+  """
+  with np.load(checkpoint_file) as checkpoint:
+    arrays = dict((name, checkpoint[name]) for name in checkpoint.files)
+  for variable in head_variables:
+    if 'variable/' + variable.op.name not in arrays:
+      raise ValueError('Checkpoint has no value for variable',
+                       variable.op.name, checkpoint_file)
+    variable.load(arrays['variable/' + variable.op.name], sess)
+  sampler.set_state(dict((name[len('sampler/'):], value)
+                         for name, value in arrays.items()
+                         if name.startswith('sampler/')))
+  early_stopping.recent.clear()
+  early_stopping.recent.extend(arrays['early_stopping/recent'])
+  best = float(arrays['early_stopping/best'])
+  early_stopping.best = None if np.isnan(best) else best
+  early_stopping.evaluations_since_best = int(
+      arrays['early_stopping/evaluations_since_best'])
+  best_weights = None
+  if 'best_step' in arrays:
+    best_weights = (int(arrays['best_step']),
+                    [arrays['best_variable/' + variable.op.name]
+                     for variable in head_variables])
+  return int(arrays['global_step']), best_weights
+
+
+# Frozen graphs keyed by the graph they were frozen from, as a tuple of the
+# serialized graph without the new layer's variables, the constant nodes that
+# replaced those, and the variables themselves.
+frozen_graphs = {}
+
+
+def freeze_graph(sess, graph):
+  """Freezes a graph once, splitting off the nodes of the new layer.
 
   Args:
-    result_tensor: The new final node that produces results.
-    ground_truth_tensor: The node we feed ground truth data
-    into.
+    sess: Current active TensorFlow Session.
+    graph: The graph holding the model and the new layer.
 
   Returns:
-    Tuple of (evaluation step, prediction).
+    Tuple of the serialized frozen graph without the constants holding the
+    new layer's variables, a list of those constant nodes, and a list of the
+    matching variables.
   """
-  with tf.name_scope('accuracy'):
-    with tf.name_scope('correct_prediction'):
-      prediction = tf.argmax(result_tensor, 1)
-      correct_prediction = tf.equal(
-          prediction, tf.argmax(ground_truth_tensor, 1))
-    with tf.name_scope('accuracy'):
-      evaluation_step = tf.reduce_mean(tf.cast(correct_prediction, tf.float32))
-  tf.summary.scalar('accuracy', evaluation_step)
-  return evaluation_step, prediction
+  if graph not in frozen_graphs:
+    graph_def = restore_model_input(
+        graph.as_graph_def(),
+        create_model_info(FLAGS.architecture)['resized_input_tensor_name'])
+    output_graph_def = graph_util.convert_variables_to_constants(
+        sess, graph_def, [FLAGS.final_tensor_name])
+    variables = dict(
+        (variable.op.name, variable)
+        for variable in graph.get_collection(tf.GraphKeys.GLOBAL_VARIABLES))
+    head_nodes = [node for node in output_graph_def.node
+                  if node.name in variables]
+    model_graph_def = tf.GraphDef()
+    model_graph_def.CopyFrom(output_graph_def)
+    del model_graph_def.node[:]
+    model_graph_def.node.extend(node for node in output_graph_def.node
+                                if node.name not in variables)
+    frozen_graphs[graph] = (model_graph_def.SerializeToString(), head_nodes,
+                            [variables[node.name] for node in head_nodes])
+  return frozen_graphs[graph]
 
 
 def save_graph_to_file(sess, graph, graph_file_name):
-  output_graph_def = graph_util.convert_variables_to_constants(
-      sess, graph.as_graph_def(), [FLAGS.final_tensor_name])
+  """Writes a graph with the current weights of the new layer frozen in.
+
+  Freezing copies the whole model, so it's only done the first time a graph is
+  saved, by freeze_graph. After that only the new layer's variables are turned
+  into constant nodes and serialized. A serialized GraphDef is a run of its
+  fields and repeated fields concatenate, so appending those nodes to the
+  cached bytes gives the full frozen graph, and each snapshot costs about as
+  much as the new layer rather than the model.
+
+  Args:
+    sess: Current active TensorFlow Session.
+    graph: The graph holding the model and the new layer.
+    graph_file_name: Path string to write the frozen graph to.
+  """
+  start_time = time.time()
+  model_graph, head_nodes, head_variables = freeze_graph(sess, graph)
+  head_graph_def = tf.GraphDef()
+  for node, value in zip(head_nodes, sess.run(head_variables)):
+    head_node = head_graph_def.node.add()
+    head_node.CopyFrom(node)
+    head_node.attr['value'].tensor.CopyFrom(
+        tf.make_tensor_proto(value, dtype=node.attr['dtype'].type))
   with gfile.FastGFile(graph_file_name, 'wb') as f:
-    f.write(output_graph_def.SerializeToString())
+    f.write(model_graph)
+    f.write(head_graph_def.SerializeToString())
+  tf.logging.info('Wrote %s in %.2fs' %
+                  (graph_file_name, time.time() - start_time))
   return
 
 
 def prepare_file_system():
-  # Setup the directory we'll write summaries to for TensorBoard
-  if tf.gfile.Exists(FLAGS.summaries_dir):
+  # Setup the directory we'll write summaries to for TensorBoard, keeping the
+  # earlier summaries when carrying on from a checkpoint.
+  if tf.gfile.Exists(FLAGS.summaries_dir) and not FLAGS.resume:
     tf.gfile.DeleteRecursively(FLAGS.summaries_dir)
   tf.gfile.MakeDirs(FLAGS.summaries_dir)
   if FLAGS.intermediate_store_frequency > 0:
     ensure_dir_exists(FLAGS.intermediate_output_graphs_dir)
+  if FLAGS.checkpoint_frequency > 0:
+    ensure_dir_exists(FLAGS.checkpoint_dir)
   return
 
 
@@ -937,7 +4409,7 @@ def create_model_info(architecture):
 
 
 def add_jpeg_decoding(input_width, input_height, input_depth, input_mean,
-                      input_std):
+                      input_std, jpeg_data=None):
   """Adds operations that perform JPEG decoding and resizing to the graph..
 
   Args:
@@ -946,13 +4418,16 @@ def add_jpeg_decoding(input_width, input_height, input_depth, input_mean,
     input_depth: Desired channels of the image fed into the recognizer graph.
     input_mean: Pixel value that should be zero in the image for the graph.
     input_std: How much to divide the pixel values by before recognition.
+    jpeg_data: Optional string tensor holding the JPEG data to decode. A new
+    placeholder is created if it's None.
 
   Returns:
     Tensors for the node to feed JPEG data into, and the output of the
       preprocessing steps.
   """
-  jpeg_data = tf.placeholder(tf.string, name='DecodeJPGInput')
-  decoded_image = tf.image.decode_jpeg(jpeg_data, channels=input_depth)
+  if jpeg_data is None:
+    jpeg_data = tf.placeholder(tf.string, name='DecodeJPGInput')
+  decoded_image = decode_jpeg_or_png(jpeg_data, input_depth)
   decoded_image_as_float = tf.cast(decoded_image, dtype=tf.float32)
   decoded_image_4d = tf.expand_dims(decoded_image_as_float, 0)
   resize_shape = tf.stack([input_height, input_width])
@@ -978,51 +4453,114 @@ def main(_):
     tf.logging.error('Did not recognize architecture flag')
     return -1
 
-  # Set up the pre-trained graph.
-  maybe_download_and_extract(model_info['data_url'])
-  graph, bottleneck_tensor, resized_image_tensor = (
-      create_model_graph(model_info))
+  # See if the command-line flags mean we're applying any distortions.
+  do_distort_images = should_distort_images(
+      FLAGS.flip_left_right, FLAGS.random_crop, FLAGS.random_scale,
+      FLAGS.random_brightness)
+  if do_distort_images:
+    distortions = (FLAGS.flip_left_right, FLAGS.random_crop,
+                   FLAGS.random_scale, FLAGS.random_brightness)
+  else:
+    distortions = None
 
-  # Look at the folder structure, and create lists of all the images.
-  image_lists = create_image_lists(FLAGS.image_dir, FLAGS.testing_percentage,
-                                   FLAGS.validation_percentage)
+  # Set up the pre-trained graph, with the image decoding sub-graph and any
+  # distortions wired into its input.
+  maybe_download_and_extract(model_info['data_url'])
+  (graph, bottleneck_tensor, resized_image_tensor, jpeg_data_tensor,
+   decoded_image_tensor, distorted_jpeg_data_tensor) = (
+       create_model_graph(model_info, distortions))
+
+  if FLAGS.bucket:
+    # List the images of the bucket from its annotations. They're downloaded
+    # into the cache folder as they're needed, so that folder stands in for
+    # the image directory from here on.
+    FLAGS.image_dir = FLAGS.bucket_cache_dir
+    image_lists = create_bucket_image_lists(
+        open_object_storage(FLAGS.bucket_endpoint), FLAGS.bucket,
+        FLAGS.bucket_cache_dir, FLAGS.testing_percentage,
+        FLAGS.validation_percentage, FLAGS.bucket_cache_size * 2 ** 20,
+        FLAGS.download_workers, FLAGS.prefetch_window)
+  else:
+    # Look at the folder structure, and create lists of all the images.
+    image_lists = create_image_lists(FLAGS.image_dir, FLAGS.testing_percentage,
+                                     FLAGS.validation_percentage,
+                                     FLAGS.image_manifest)
   class_count = len(image_lists.keys())
   if class_count == 0:
     tf.logging.error('No valid folders of images found at ' + FLAGS.image_dir)
     return -1
+  if FLAGS.report_image_lists:
+    report_image_lists(image_lists, FLAGS.image_dir)
   if class_count == 1:
     tf.logging.error('Only one valid folder of images found at ' +
                      FLAGS.image_dir +
                      ' - multiple classes are needed for classification.')
     return -1
 
-  # See if the command-line flags mean we're applying any distortions.
-  do_distort_images = should_distort_images(
-      FLAGS.flip_left_right, FLAGS.random_crop, FLAGS.random_scale,
-      FLAGS.random_brightness)
+  if FLAGS.gc_bottlenecks:
+    collect_bottleneck_garbage(image_lists, FLAGS.image_dir,
+                               FLAGS.bottleneck_dir, FLAGS.architecture,
+                               FLAGS.bottleneck_precision, distortions,
+                               FLAGS.augmented_variants)
+    save_image_fingerprints(FLAGS.image_manifest, image_lists, FLAGS.image_dir)
+    return 0
+
+  # With a bank of precomputed distorted variants, training reads cached
+  # bottlenecks and only the bank itself is built with the distortion graph.
+  use_augmented_bank = do_distort_images and FLAGS.augmented_variants > 0
+  live_distortion = do_distort_images and not use_augmented_bank
+  if FLAGS.trainer == 'lbfgs' and live_distortion:
+    tf.logging.error('The lbfgs trainer needs cached bottlenecks and cannot '
+                     'be used with live distortions')
+    return -1
+  if (FLAGS.sweep_learning_rates or FLAGS.sweep_batch_sizes) and (
+      live_distortion):
+    tf.logging.error('Sweeps train on cached bottlenecks and cannot be used '
+                     'with live distortions')
+    return -1
+
+  if FLAGS.cache_workers > 1 and not live_distortion and not FLAGS.bucket:
+    # Calculate the missing bottlenecks in worker processes before this
+    # process starts its own session. The images of a bucket are fetched
+    # through this process's cache, so those are calculated here instead.
+    cache_bottlenecks_in_parallel(image_lists, FLAGS.image_dir,
+                                  FLAGS.bottleneck_dir, FLAGS.architecture,
+                                  FLAGS.bottleneck_precision,
+                                  FLAGS.cache_workers,
+                                  FLAGS.cache_threads_per_worker)
 
   with tf.Session(graph=graph) as sess:
-    # Set up the image decoding sub-graph.
-    jpeg_data_tensor, decoded_image_tensor = add_jpeg_decoding(
-        model_info['input_width'], model_info['input_height'],
-        model_info['input_depth'], model_info['input_mean'],
-        model_info['input_std'])
-
-    if do_distort_images:
-      # We will be applying distortions, so setup the operations we'll need.
-      (distorted_jpeg_data_tensor,
-       distorted_image_tensor) = add_input_distortions(
-           FLAGS.flip_left_right, FLAGS.random_crop, FLAGS.random_scale,
-           FLAGS.random_brightness, model_info['input_width'],
-           model_info['input_height'], model_info['input_depth'],
-           model_info['input_mean'], model_info['input_std'])
-    else:
+    if not live_distortion:
       # We'll make sure we've calculated the 'bottleneck' image summaries and
       # cached them on disk.
       cache_bottlenecks(sess, image_lists, FLAGS.image_dir,
                         FLAGS.bottleneck_dir, jpeg_data_tensor,
                         decoded_image_tensor, resized_image_tensor,
-                        bottleneck_tensor, FLAGS.architecture)
+                        bottleneck_tensor, FLAGS.architecture,
+                        FLAGS.bottleneck_precision,
+                        FLAGS.bottleneck_batch_size, FLAGS.decode_workers,
+                        FLAGS.prefetch_queue_size)
+      save_image_fingerprints(FLAGS.image_manifest, image_lists,
+                              FLAGS.image_dir)
+      if use_augmented_bank:
+        cache_augmented_bottlenecks(
+            sess, image_lists, FLAGS.image_dir, FLAGS.bottleneck_dir,
+            FLAGS.architecture, FLAGS.bottleneck_precision, distortions,
+            FLAGS.augmented_variants, distorted_jpeg_data_tensor,
+            bottleneck_tensor,
+            FLAGS.decode_workers, FLAGS.prefetch_queue_size)
+        train_bank = load_augmented_bottlenecks(
+            image_lists, FLAGS.image_dir, FLAGS.bottleneck_dir,
+            FLAGS.architecture, FLAGS.bottleneck_precision, distortions,
+            FLAGS.augmented_variants)
+      if FLAGS.resident_bottlenecks:
+        # Keep the training and validation sets in memory from here on.
+        train_resident = load_resident_bottlenecks(
+            image_lists, 'training', FLAGS.image_dir, FLAGS.bottleneck_dir,
+            FLAGS.architecture, FLAGS.bottleneck_precision)
+        validation_resident = load_resident_bottlenecks(
+            image_lists, 'validation', FLAGS.image_dir, FLAGS.bottleneck_dir,
+            FLAGS.architecture, FLAGS.bottleneck_precision)
 
     # Add the new layer that we'll be training.
     (train_step, cross_entropy, bottleneck_input, ground_truth_input,
@@ -1034,104 +4572,370 @@ def main(_):
     evaluation_step, prediction = add_evaluation_step(
         final_tensor, ground_truth_input)
 
-    # Merge all the summaries and write them out to the summaries_dir
-    merged = tf.summary.merge_all()
-    train_writer = tf.summary.FileWriter(FLAGS.summaries_dir + '/train',
-                                         sess.graph)
+    # Merge the summaries selected by --summary_mode and write them out to the
+    # summaries_dir
+    summary_op = add_summary_op(FLAGS.summary_mode)
+    if summary_op is not None:
+      train_writer = tf.summary.FileWriter(FLAGS.summaries_dir + '/train',
+                                           sess.graph)
 
-    validation_writer = tf.summary.FileWriter(
-        FLAGS.summaries_dir + '/validation')
+      validation_writer = tf.summary.FileWriter(
+          FLAGS.summaries_dir + '/validation')
+    else:
+      train_writer = None
 
     # Set up all our weights to their initial default values.
     init = tf.global_variables_initializer()
     sess.run(init)
 
-    # Run the training for as many cycles as requested on the command line.
-    for i in range(FLAGS.how_many_training_steps):
+    # Precompute the index arrays we draw training and validation batches from.
+    train_sampler = BottleneckSampler(image_lists, 'training',
+                                      FLAGS.sampling_mode,
+                                      exponent=FLAGS.sampling_exponent)
+    validation_sampler = BottleneckSampler(image_lists, 'validation')
+
+    def prefetch_training_distortions(how_many_batches):
+      # Distort upcoming training batches on background threads. They draw
+      # from the training sampler, so this is only called once the sampler
+      # won't be restored any more.
+      return prefetch_distorted_bottlenecks(
+          sess, image_lists, how_many_batches, FLAGS.train_batch_size,
+          'training', FLAGS.image_dir, distorted_jpeg_data_tensor,
+          bottleneck_tensor, train_sampler, FLAGS.distortion_workers,
+          FLAGS.distortion_queue_size)
+
+    distorted_batches_lock = threading.Lock()
+    use_resident = FLAGS.resident_bottlenecks and not live_distortion
+
+    def get_train_batch(unused_step):
       # Get a batch of input bottleneck values, either calculated fresh every
-      # time with distortions applied, or from the cache stored on disk.
-      if do_distort_images:
-        (train_bottlenecks,
-         train_ground_truth) = get_random_distorted_bottlenecks(
-             sess, image_lists, FLAGS.train_batch_size, 'training',
-             FLAGS.image_dir, distorted_jpeg_data_tensor,
-             distorted_image_tensor, resized_image_tensor, bottleneck_tensor)
+      # time with distortions applied, from the bank of distorted variants, or
+      # from the cache stored on disk or in memory.
+      if live_distortion:
+        with distorted_batches_lock:
+          distorted_bottlenecks = next(distorted_batches)
+        return get_random_distorted_bottlenecks(
+            sess, image_lists, FLAGS.train_batch_size, 'training',
+            FLAGS.image_dir, distorted_jpeg_data_tensor, bottleneck_tensor,
+            train_sampler, distorted_bottlenecks)
+      elif use_augmented_bank:
+        return get_random_augmented_bottlenecks(
+            train_bank, FLAGS.augmented_variants, FLAGS.train_batch_size,
+            train_sampler)[:2]
+      elif use_resident:
+        return get_random_resident_bottlenecks(
+            train_resident, FLAGS.train_batch_size, train_sampler)[:2]
+      return get_random_cached_bottlenecks(
+          sess, image_lists, FLAGS.train_batch_size, 'training',
+          FLAGS.bottleneck_dir, FLAGS.image_dir, jpeg_data_tensor,
+          decoded_image_tensor, resized_image_tensor, bottleneck_tensor,
+          FLAGS.architecture, FLAGS.bottleneck_precision, train_sampler)[:2]
+
+    def get_validation_batch(unused_evaluation):
+      if use_resident:
+        return get_random_resident_bottlenecks(
+            validation_resident, FLAGS.validation_batch_size,
+            validation_sampler)[:2]
+      return get_random_cached_bottlenecks(
+          sess, image_lists, FLAGS.validation_batch_size, 'validation',
+          FLAGS.bottleneck_dir, FLAGS.image_dir, jpeg_data_tensor,
+          decoded_image_tensor, resized_image_tensor, bottleneck_tensor,
+          FLAGS.architecture, FLAGS.bottleneck_precision,
+          validation_sampler)[:2]
+
+    def get_validation_chunks():
+      # The validation bottlenecks of one evaluation in chunks of at most
+      # --eval_chunk_size, so the whole split can be evaluated at once.
+      if use_resident:
+        return iterate_resident_bottleneck_chunks(
+            validation_resident, FLAGS.validation_batch_size,
+            FLAGS.eval_chunk_size, validation_sampler)
+      return iterate_cached_bottleneck_chunks(
+          sess, image_lists, FLAGS.validation_batch_size, 'validation',
+          FLAGS.eval_chunk_size, FLAGS.bottleneck_dir, FLAGS.image_dir,
+          jpeg_data_tensor, decoded_image_tensor, resized_image_tensor,
+          bottleneck_tensor, FLAGS.architecture, FLAGS.bottleneck_precision,
+          validation_sampler)
+
+    # The weights and biases of the new layer.
+    final_layer_variables = tf.trainable_variables()
+
+    sweep_learning_rates = [float(value) for value in
+                            FLAGS.sweep_learning_rates.split(',') if value]
+    sweep_batch_sizes = [int(value) for value in
+                         FLAGS.sweep_batch_sizes.split(',') if value]
+    if sweep_learning_rates or sweep_batch_sizes:
+      # Train a head per combination of settings on the bottlenecks loaded
+      # here, and keep the one with the best validation accuracy.
+      if use_augmented_bank:
+        sweep_train_data, sweep_variants = train_bank, FLAGS.augmented_variants
+      else:
+        sweep_train_data = train_resident if use_resident else (
+            load_resident_bottlenecks(image_lists, 'training',
+                                      FLAGS.image_dir, FLAGS.bottleneck_dir,
+                                      FLAGS.architecture,
+                                      FLAGS.bottleneck_precision))
+        sweep_variants = 1
+      step_secs = run_sweep(
+          sess, image_lists, sweep_train_data, sweep_variants,
+          validation_resident if use_resident else load_resident_bottlenecks(
+              image_lists, 'validation', FLAGS.image_dir,
+              FLAGS.bottleneck_dir, FLAGS.architecture,
+              FLAGS.bottleneck_precision),
+          final_layer_variables,
+          sweep_learning_rates or [FLAGS.learning_rate],
+          sweep_batch_sizes or [FLAGS.train_batch_size], FLAGS.sweep_workers)
+      how_many_steps_run = FLAGS.how_many_training_steps
+      best_weights = None
+    elif FLAGS.trainer == 'tensorflow':
+      # Keep the weights of the new layer from the best evaluation when
+      # training can stop early or run out of time, so those are the ones
+      # exported.
+      early_stopping = EarlyStopping(
+          FLAGS.early_stopping_metric, FLAGS.early_stopping_patience,
+          FLAGS.early_stopping_min_delta, FLAGS.early_stopping_window)
+      keep_best_weights = (FLAGS.early_stopping_patience > 0 or
+                           FLAGS.max_training_secs > 0)
+      best_weights = None
+
+      # Carry on from the latest checkpoint of the new layer if asked to. This
+      # has to happen before the batch producers below start drawing from the
+      # training sampler.
+      start_step = 0
+      if FLAGS.resume:
+        checkpoint_file = latest_head_checkpoint(FLAGS.checkpoint_dir)
+        if checkpoint_file is None:
+          tf.logging.info('No checkpoint found in %s, starting from step 0' %
+                          FLAGS.checkpoint_dir)
+        else:
+          start_step, best_weights = restore_head_checkpoint(
+              sess, checkpoint_file, final_layer_variables, train_sampler,
+              early_stopping)
+          tf.logging.info('Resuming from %s at step %d' %
+                          (checkpoint_file, start_step))
+
+      # Background threads prepare upcoming training and validation batches
+      # into bounded queues while the session runs the current step.
+      # Training can stop early, so validation batches are produced for as
+      # long as they are asked for. The training batches are drawn from the
+      # sampler ahead of the steps that use them, so they're produced one
+      # checkpoint interval at a time: by the time the sampler's state is
+      # saved, every batch drawn from it has been trained on.
+      train_batches = distorted_batches = None
+      train_segment_stop = start_step
+      # Whole validation sets are streamed in chunks at each evaluation
+      # instead, since queueing several of them would hold several copies.
+      stream_validation = FLAGS.validation_batch_size < 0
+      if not stream_validation:
+        validation_batches = iter(ImagePipeline(
+            itertools.count(), get_validation_batch,
+            FLAGS.batch_producer_threads, FLAGS.batch_queue_size))
+
+      # Run the training for as many cycles as requested on the command line,
+      # or until it stops improving or runs out of time.
+      training_start_time = time.time()
+      step_secs = 0.0
+      how_many_steps_run = start_step
+      queue_wait_secs = 0.0
+      max_queue_wait_secs = 0.0
+      for i in range(start_step, FLAGS.how_many_training_steps):
+        step_start_time = time.time()
+        if i == train_segment_stop:
+          if train_batches is not None:
+            # Let the producers of the last interval finish.
+            for _ in train_batches:
+              pass
+            if live_distortion:
+              for _ in distorted_batches:
+                pass
+          train_segment_stop = FLAGS.how_many_training_steps
+          if FLAGS.checkpoint_frequency > 0:
+            train_segment_stop = min(
+                train_segment_stop,
+                (i // FLAGS.checkpoint_frequency + 1) *
+                FLAGS.checkpoint_frequency)
+          if live_distortion:
+            distorted_batches = prefetch_training_distortions(
+                train_segment_stop - i)
+          train_batches = iter(ImagePipeline(
+              range(i, train_segment_stop), get_train_batch,
+              FLAGS.batch_producer_threads, FLAGS.batch_queue_size))
+        _, (train_bottlenecks, train_ground_truth) = next(train_batches)
+        wait_secs = time.time() - step_start_time
+        queue_wait_secs += wait_secs
+        max_queue_wait_secs = max(max_queue_wait_secs, wait_secs)
+        # Feed the bottlenecks and ground truth into the graph, and run a
+        # training step. Every --summary_interval steps capture training
+        # summaries for TensorBoard with the summary op.
+        if run_train_step(sess, i, train_step, summary_op,
+                          FLAGS.summary_interval, train_writer,
+                          {bottleneck_input: train_bottlenecks,
+                           ground_truth_input: train_ground_truth}):
+          train_writer.add_summary(tf.Summary(value=[tf.Summary.Value(
+              tag='input_queue_wait_ms', simple_value=wait_secs * 1000)]), i)
+        step_secs += time.time() - step_start_time
+        how_many_steps_run = i + 1
+
+        # Every so often, print out how well the graph is training.
+        out_of_time = (FLAGS.max_training_secs > 0 and
+                       time.time() - training_start_time >
+                       FLAGS.max_training_secs)
+        is_last_step = (i + 1 == FLAGS.how_many_training_steps) or out_of_time
+        if (i % FLAGS.eval_step_interval) == 0 or is_last_step:
+          train_accuracy, cross_entropy_value = sess.run(
+              [evaluation_step, cross_entropy],
+              feed_dict={bottleneck_input: train_bottlenecks,
+                         ground_truth_input: train_ground_truth})
+          tf.logging.info('%s: Step %d: Train accuracy = %.1f%%' %
+                          (datetime.now(), i, train_accuracy * 100))
+          tf.logging.info('%s: Step %d: Cross entropy = %f' %
+                          (datetime.now(), i, cross_entropy_value))
+          steps_this_run = i + 1 - start_step
+          tf.logging.info('%s: Step %d: Mean step time = %.2fms, of which '
+                          '%.2fms waiting for input (max %.2fms)' %
+                          (datetime.now(), i, step_secs * 1000 / steps_this_run,
+                           queue_wait_secs * 1000 / steps_this_run,
+                           max_queue_wait_secs * 1000))
+          if stream_validation:
+            # Evaluate the whole validation set chunk by chunk, and write the
+            # accumulated results under the tags of the summary op.
+            (validation_accuracy, validation_cross_entropy,
+             how_many_validated, _, _) = evaluate_in_chunks(
+                 sess, get_validation_chunks(), evaluation_step,
+                 cross_entropy, prediction, bottleneck_input,
+                 ground_truth_input)
+            if summary_op is not None:
+              validation_summary = tf.Summary(value=[
+                  tf.Summary.Value(tag='accuracy',
+                                   simple_value=validation_accuracy),
+                  tf.Summary.Value(tag='cross_entropy',
+                                   simple_value=validation_cross_entropy)])
+              validation_writer.add_summary(validation_summary, i)
+          else:
+            _, (validation_bottlenecks,
+                validation_ground_truth) = next(validation_batches)
+            how_many_validated = len(validation_bottlenecks)
+            # Run a validation step and capture training summaries for
+            # TensorBoard with the summary op.
+            validation_feed_dict = {
+                bottleneck_input: validation_bottlenecks,
+                ground_truth_input: validation_ground_truth}
+            if summary_op is not None:
+              (validation_summary, validation_accuracy,
+               validation_cross_entropy) = sess.run(
+                   [summary_op, evaluation_step, cross_entropy],
+                   feed_dict=validation_feed_dict)
+              validation_writer.add_summary(validation_summary, i)
+            else:
+              validation_accuracy, validation_cross_entropy = sess.run(
+                  [evaluation_step, cross_entropy],
+                  feed_dict=validation_feed_dict)
+          tf.logging.info('%s: Step %d: Validation accuracy = %.1f%% (N=%d)' %
+                          (datetime.now(), i, validation_accuracy * 100,
+                           how_many_validated))
+          if (early_stopping.update(validation_accuracy,
+                                    validation_cross_entropy) and
+              keep_best_weights):
+            best_weights = (i, sess.run(final_layer_variables))
+          if early_stopping.should_stop():
+            tf.logging.info('%s: Step %d: Stopping early, validation %s has '
+                            'not improved for %d evaluations' %
+                            (datetime.now(), i, early_stopping.metric,
+                             early_stopping.patience))
+            break
+          if out_of_time:
+            tf.logging.info('%s: Step %d: Stopping after the %ds training time '
+                            'budget' % (datetime.now(), i,
+                                        FLAGS.max_training_secs))
+            break
+
+        # Store intermediate results
+        intermediate_frequency = FLAGS.intermediate_store_frequency
+
+        if (intermediate_frequency > 0 and (i % intermediate_frequency == 0)
+            and i > 0):
+          intermediate_file_name = (FLAGS.intermediate_output_graphs_dir +
+                                    'intermediate_' + str(i) + '.pb')
+          tf.logging.info('Save intermediate result to : ' +
+                          intermediate_file_name)
+          save_graph_to_file(sess, graph, intermediate_file_name)
+
+        # Checkpoint the new layer so a stopped job can carry on from here.
+        if (FLAGS.checkpoint_frequency > 0 and
+            (i + 1) % FLAGS.checkpoint_frequency == 0):
+          save_head_checkpoint(sess, FLAGS.checkpoint_dir, i + 1,
+                               final_layer_variables, train_sampler,
+                               early_stopping, best_weights)
+    else:
+      # Train the new layer in NumPy and load the learned weights back into
+      # the graph for the evaluation and export below.
+      if FLAGS.trainer == 'lbfgs':
+        if use_augmented_bank:
+          train_data = train_bank
+        elif use_resident:
+          train_data = train_resident
+        else:
+          train_data = load_resident_bottlenecks(
+              image_lists, 'training', FLAGS.image_dir, FLAGS.bottleneck_dir,
+              FLAGS.architecture, FLAGS.bottleneck_precision)
       else:
-        (train_bottlenecks,
-         train_ground_truth, _) = get_random_cached_bottlenecks(
-             sess, image_lists, FLAGS.train_batch_size, 'training',
-             FLAGS.bottleneck_dir, FLAGS.image_dir, jpeg_data_tensor,
-             decoded_image_tensor, resized_image_tensor, bottleneck_tensor,
-             FLAGS.architecture)
-      # Feed the bottlenecks and ground truth into the graph, and run a training
-      # step. Capture training summaries for TensorBoard with the `merged` op.
-      train_summary, _ = sess.run(
-          [merged, train_step],
-          feed_dict={bottleneck_input: train_bottlenecks,
-                     ground_truth_input: train_ground_truth})
-      train_writer.add_summary(train_summary, i)
-
-      # Every so often, print out how well the graph is training.
-      is_last_step = (i + 1 == FLAGS.how_many_training_steps)
-      if (i % FLAGS.eval_step_interval) == 0 or is_last_step:
-        train_accuracy, cross_entropy_value = sess.run(
-            [evaluation_step, cross_entropy],
-            feed_dict={bottleneck_input: train_bottlenecks,
-                       ground_truth_input: train_ground_truth})
-        tf.logging.info('%s: Step %d: Train accuracy = %.1f%%' %
-                        (datetime.now(), i, train_accuracy * 100))
-        tf.logging.info('%s: Step %d: Cross entropy = %f' %
-                        (datetime.now(), i, cross_entropy_value))
-        validation_bottlenecks, validation_ground_truth, _ = (
-            get_random_cached_bottlenecks(
-                sess, image_lists, FLAGS.validation_batch_size, 'validation',
-                FLAGS.bottleneck_dir, FLAGS.image_dir, jpeg_data_tensor,
-                decoded_image_tensor, resized_image_tensor, bottleneck_tensor,
-                FLAGS.architecture))
-        # Run a validation step and capture training summaries for TensorBoard
-        # with the `merged` op.
-        validation_summary, validation_accuracy = sess.run(
-            [merged, evaluation_step],
-            feed_dict={bottleneck_input: validation_bottlenecks,
-                       ground_truth_input: validation_ground_truth})
-        validation_writer.add_summary(validation_summary, i)
-        tf.logging.info('%s: Step %d: Validation accuracy = %.1f%% (N=%d)' %
-                        (datetime.now(), i, validation_accuracy * 100,
-                         len(validation_bottlenecks)))
-
-      # Store intermediate results
-      intermediate_frequency = FLAGS.intermediate_store_frequency
-
-      if (intermediate_frequency > 0 and (i % intermediate_frequency == 0)
-          and i > 0):
-        intermediate_file_name = (FLAGS.intermediate_output_graphs_dir +
-                                  'intermediate_' + str(i) + '.pb')
-        tf.logging.info('Save intermediate result to : ' +
-                        intermediate_file_name)
-        save_graph_to_file(sess, graph, intermediate_file_name)
+        train_data = None
+        if live_distortion:
+          distorted_batches = prefetch_training_distortions(
+              FLAGS.how_many_training_steps)
+      how_many_steps_run, step_secs = train_final_layer_with_numpy(
+          sess, FLAGS.trainer, get_train_batch, train_data,
+          final_layer_variables)
+      validation_accuracy, _, how_many_validated, _, _ = evaluate_in_chunks(
+          sess, get_validation_chunks(), evaluation_step, cross_entropy,
+          prediction, bottleneck_input, ground_truth_input)
+      tf.logging.info('%s: Trained with %s for %d steps in %.1fs: '
+                      'Validation accuracy = %.1f%% (N=%d)' %
+                      (datetime.now(), FLAGS.trainer, how_many_steps_run,
+                       step_secs, validation_accuracy * 100,
+                       how_many_validated))
+      best_weights = None
+
+    if best_weights is not None:
+      best_step, best_values = best_weights
+      tf.logging.info('Restoring the weights from step %d, the best smoothed '
+                      'validation %s of %f' %
+                      (best_step, early_stopping.metric,
+                       early_stopping.best_value()))
+      for variable, value in zip(final_layer_variables, best_values):
+        variable.load(value, sess)
 
     # We've completed all our training, so run a final test evaluation on
     # some new images we haven't used before.
-    test_bottlenecks, test_ground_truth, test_filenames = (
-        get_random_cached_bottlenecks(
+    # The test images are streamed through in chunks, so the whole test set
+    # can be used however large it is.
+    test_accuracy, _, how_many_tested, _, misclassified = evaluate_in_chunks(
+        sess, iterate_cached_bottleneck_chunks(
             sess, image_lists, FLAGS.test_batch_size, 'testing',
-            FLAGS.bottleneck_dir, FLAGS.image_dir, jpeg_data_tensor,
-            decoded_image_tensor, resized_image_tensor, bottleneck_tensor,
-            FLAGS.architecture))
-    test_accuracy, predictions = sess.run(
-        [evaluation_step, prediction],
-        feed_dict={bottleneck_input: test_bottlenecks,
-                   ground_truth_input: test_ground_truth})
+            FLAGS.eval_chunk_size, FLAGS.bottleneck_dir, FLAGS.image_dir,
+            jpeg_data_tensor, decoded_image_tensor, resized_image_tensor,
+            bottleneck_tensor, FLAGS.architecture,
+            FLAGS.bottleneck_precision),
+        evaluation_step, cross_entropy, prediction, bottleneck_input,
+        ground_truth_input, FLAGS.print_misclassified_test_images)
     tf.logging.info('Final test accuracy = %.1f%% (N=%d)' %
-                    (test_accuracy * 100, len(test_bottlenecks)))
+                    (test_accuracy * 100, how_many_tested))
 
     if FLAGS.print_misclassified_test_images:
       tf.logging.info('=== MISCLASSIFIED TEST IMAGES ===')
-      for i, test_filename in enumerate(test_filenames):
-        if predictions[i] != test_ground_truth[i].argmax():
-          tf.logging.info('%70s  %s' %
-                          (test_filename,
-                           list(image_lists.keys())[predictions[i]]))
+      for test_filename, predicted_index in misclassified:
+        tf.logging.info('%70s  %s' %
+                        (test_filename,
+                         list(image_lists.keys())[predicted_index]))
+
+    if (FLAGS.report_bottleneck_precision and not live_distortion and
+        FLAGS.bottleneck_precision != 'float32'):
+      report_bottleneck_precision(
+          sess, image_lists, FLAGS.image_dir, FLAGS.bottleneck_dir,
+          FLAGS.architecture, FLAGS.bottleneck_precision, jpeg_data_tensor,
+          decoded_image_tensor, resized_image_tensor, bottleneck_tensor,
+          evaluation_step,
+          bottleneck_input, ground_truth_input)
 
     # Write out the trained graph and labels with the weights stored as
     # constants.
@@ -1139,6 +4943,18 @@ def main(_):
     with gfile.FastGFile(FLAGS.output_labels, 'w') as f:
       f.write('\n'.join(image_lists.keys()) + '\n')
 
+    if FLAGS.report_augmentation and use_augmented_bank:
+      # This retrains the new layer, so it has to come after the export.
+      report_augmentation(
+          sess, image_lists, step_secs / max(how_many_steps_run, 1), init,
+          train_step, evaluation_step, cross_entropy, prediction,
+          bottleneck_input, ground_truth_input, jpeg_data_tensor,
+          decoded_image_tensor, distorted_jpeg_data_tensor,
+          resized_image_tensor, bottleneck_tensor)
+
+  # Keep any bottlenecks that were calculated lazily during training.
+  flush_bottleneck_stores()
+
 
 if __name__ == '__main__':
   parser = argparse.ArgumentParser()
@@ -1148,6 +4964,75 @@ if __name__ == '__main__':
       default='.tmp/training_data',
       help='Path to folders of labeled images.'
   )
+  parser.add_argument(
+      '--bucket',
+      type=str,
+      default='',
+      help="""\
+      Name of a Cloud Object Storage bucket to train on instead of
+      --image_dir. The images and their labels are listed from the bucket's
+      _annotations.csv and downloaded as they're needed.\
+      """
+  )
+  parser.add_argument(
+      '--bucket_endpoint',
+      type=str,
+      default='https://s3-api.us-geo.objectstorage.softlayer.net',
+      help="""\
+      S3 API endpoint of the bucket. A file:// URL of a folder uses its
+      subfolders as buckets instead, for testing.\
+      """
+  )
+  parser.add_argument(
+      '--bucket_cache_dir',
+      type=str,
+      default='.tmp/bucket_cache',
+      help='Where to keep the images downloaded from the bucket.'
+  )
+  parser.add_argument(
+      '--bucket_cache_size',
+      type=int,
+      default=2048,
+      help="""\
+      How many MB of downloaded images to keep, deleting the least recently
+      read ones beyond that.\
+      """
+  )
+  parser.add_argument(
+      '--download_workers',
+      type=int,
+      default=8,
+      help='How many threads download images from the bucket ahead of use.'
+  )
+  parser.add_argument(
+      '--prefetch_window',
+      type=int,
+      default=256,
+      help="""\
+      How many downloaded images can wait to be read before the download
+      threads pause.\
+      """
+  )
+  parser.add_argument(
+      '--image_manifest',
+      type=str,
+      default='.tmp/image_manifest.json',
+      help="""\
+      Where to record the images found in each folder of --image_dir, the
+      set each was assigned to, and their content hashes, so unchanged folders
+      aren't listed and unchanged images aren't hashed again on the next run.
+      If empty, the folders are scanned and the images hashed every time.\
+      """
+  )
+  parser.add_argument(
+      '--report_image_lists',
+      default=False,
+      help="""\
+      Log the memory and path lookup time of the columnar image lists against
+      the dictionaries of strings they replace.\
+      """,
+      action='store_true'
+  )
   parser.add_argument(
       '--output_graph',
       type=str,
@@ -1169,6 +5054,32 @@ if __name__ == '__main__':
          store.\
       """
   )
+  parser.add_argument(
+      '--checkpoint_dir',
+      type=str,
+      default='.tmp/checkpoints',
+      help='Where to save checkpoints of the new layer.'
+  )
+  parser.add_argument(
+      '--checkpoint_frequency',
+      type=int,
+      default=0,
+      help="""\
+      How many training steps between checkpoints of the new layer's weights,
+      the step count, and the state of the training sampler. Only the latest
+      checkpoint is kept, and the training batch queue runs dry at each one.
+      If "0" then will not checkpoint.\
+      """
+  )
+  parser.add_argument(
+      '--resume',
+      default=False,
+      help="""\
+      Whether to carry on training from the latest checkpoint in
+      --checkpoint_dir, keeping the summaries written so far.\
+      """,
+      action='store_true'
+  )
   parser.add_argument(
       '--output_labels',
       type=str,
@@ -1181,12 +5092,122 @@ if __name__ == '__main__':
       default='.tmp/retrain_logs',
       help='Where to save summary logs for TensorBoard.'
   )
+  parser.add_argument(
+      '--summary_mode',
+      type=str,
+      default='all',
+      choices=SUMMARY_MODES,
+      help="""\
+      Which TensorBoard summaries to record: 'all' of them, including the
+      weight histograms, only the 'scalars' such as accuracy and cross entropy,
+      or 'none'.\
+      """
+  )
+  parser.add_argument(
+      '--summary_interval',
+      type=int,
+      default=1,
+      help="""\
+      How many training steps between recorded training summaries. Steps in
+      between only run the training op. Zero or less never records them.\
+      """
+  )
   parser.add_argument(
       '--how_many_training_steps',
       type=int,
       default=4000,
       help='How many training steps to run before ending.'
   )
+  parser.add_argument(
+      '--early_stopping_patience',
+      type=int,
+      default=0,
+      help="""\
+      Stop training once this many evaluations in a row have not improved the
+      validation metric, and export the weights from the best evaluation. Zero
+      disables early stopping.\
+      """
+  )
+  parser.add_argument(
+      '--early_stopping_min_delta',
+      type=float,
+      default=0.0,
+      help="""\
+      How much the smoothed validation metric has to improve by to count as an
+      improvement for early stopping.\
+      """
+  )
+  parser.add_argument(
+      '--early_stopping_window',
+      type=int,
+      default=1,
+      help="""\
+      How many evaluations to average the validation metric over for early
+      stopping.\
+      """
+  )
+  parser.add_argument(
+      '--early_stopping_metric',
+      type=str,
+      default='cross_entropy',
+      choices=EarlyStopping.METRICS,
+      help='Which validation metric early stopping watches.'
+  )
+  parser.add_argument(
+      '--max_training_secs',
+      type=int,
+      default=0,
+      help="""\
+      Stop training after this many seconds of wall-clock time and export the
+      weights from the best evaluation. Zero means no limit.\
+      """
+  )
+  parser.add_argument(
+      '--trainer',
+      type=str,
+      default='tensorflow',
+      choices=TRAINERS,
+      help="""\
+      How to train the new layer: 'tensorflow' runs the training op in the
+      session, 'sgd' runs mini-batch SGD with momentum in NumPy, and 'lbfgs'
+      runs full-batch L-BFGS in NumPy on every training bottleneck in memory.\
+      """
+  )
+  parser.add_argument(
+      '--momentum',
+      type=float,
+      default=0.9,
+      help='Momentum of the sgd trainer.'
+  )
+  parser.add_argument(
+      '--lbfgs_iterations',
+      type=int,
+      default=100,
+      help='Maximum number of iterations of the lbfgs trainer.'
+  )
+  parser.add_argument(
+      '--sweep_learning_rates',
+      type=str,
+      default='',
+      help="""\
+      Comma-separated learning rates to sweep over. With this or
+      --sweep_batch_sizes set, a head is trained for every combination of the
+      two in worker processes sharing the cached bottlenecks, and the one with
+      the best validation accuracy is exported.\
+      """
+  )
+  parser.add_argument(
+      '--sweep_batch_sizes',
+      type=str,
+      default='',
+      help='Comma-separated training batch sizes to sweep over.'
+  )
+  parser.add_argument(
+      '--sweep_workers',
+      type=int,
+      default=4,
+      help='How many processes train the heads of a sweep.'
+  )
   parser.add_argument(
       '--learning_rate',
       type=float,
@@ -1241,6 +5262,16 @@ if __name__ == '__main__':
       training sets.\
       """
   )
+  parser.add_argument(
+      '--eval_chunk_size',
+      type=int,
+      default=1000,
+      help="""\
+      How many bottlenecks to evaluate per run when testing, and when
+      validating on the entire validation set. Only one chunk is held in
+      memory at a time.\
+      """
+  )
   parser.add_argument(
       '--print_misclassified_test_images',
       default=False,
@@ -1263,7 +5294,183 @@ if __name__ == '__main__':
       '--bottleneck_dir',
       type=str,
       default='.tmp/bottleneck',
-      help='Path to cache bottleneck layer values as files.'
+      help="""\
+      Path to the memory-mapped stores caching bottleneck layer values. Legacy
+      per-image text files found here are imported automatically.\
+      """
+  )
+  parser.add_argument(
+      '--bottleneck_precision',
+      type=str,
+      default='float32',
+      choices=BOTTLENECK_PRECISIONS,
+      help="""\
+      Precision to store cached bottlenecks in. 'float16' halves disk and
+      memory use, 'int8' stores each vector with its own scale and takes about
+      a quarter. Values are converted back to float32 as batches are built.\
+      """
+  )
+  parser.add_argument(
+      '--report_bottleneck_precision',
+      default=False,
+      help="""\
+      With a reduced --bottleneck_precision, log the disk savings and the test
+      accuracy difference against float32 bottlenecks recomputed for the test
+      set.\
+      """,
+      action='store_true'
+  )
+  parser.add_argument(
+      '--gc_bottlenecks',
+      default=False,
+      help="""\
+      Instead of training, remove cached bottlenecks for images that no longer
+      exist or that were calculated with a different model or preprocessing,
+      as well as distorted variants that weren't made with the current
+      distortion flags and --augmented_variants, compact the bottleneck
+      stores, and exit.\
+      """,
+      action='store_true'
+  )
+  parser.add_argument(
+      '--bottleneck_batch_size',
+      type=int,
+      default=1,
+      help="""\
+      How many images to send through the network at once while caching
+      bottlenecks. Values of 32 to 128 are much faster per image on CPU.\
+      """
+  )
+  parser.add_argument(
+      '--batch_producer_threads',
+      type=int,
+      default=1,
+      help="""\
+      How many background threads prepare upcoming training and validation
+      batches while the current training step runs.\
+      """
+  )
+  parser.add_argument(
+      '--batch_queue_size',
+      type=int,
+      default=8,
+      help="""\
+      How many prepared training batches, and separately validation batches,
+      to buffer ahead of the training loop.\
+      """
+  )
+  parser.add_argument(
+      '--distortion_workers',
+      type=int,
+      default=2,
+      help="""\
+      How many threads distort upcoming training batches while the current
+      training step runs, when training with distortions.\
+      """
+  )
+  parser.add_argument(
+      '--distortion_queue_size',
+      type=int,
+      default=4,
+      help="""\
+      How many distorted training batches to prepare ahead of the training
+      step.\
+      """
+  )
+  parser.add_argument(
+      '--sampling_mode',
+      type=str,
+      default='balanced',
+      choices=BottleneckSampler.MODES,
+      help="""\
+      How training batches are drawn. 'balanced' picks a label uniformly and
+      then an image within it, 'uniform' picks images uniformly from the whole
+      training set, 'tempered' picks labels by their image count raised to
+      --sampling_exponent, and 'epoch' visits every training image once per
+      epoch in a shuffled order.\
+      """
+  )
+  parser.add_argument(
+      '--sampling_exponent',
+      type=float,
+      default=0.5,
+      help="""\
+      Power of the image counts labels are weighted by with
+      --sampling_mode=tempered, between 0 for balanced and 1 for uniform.\
+      """
+  )
+  parser.add_argument(
+      '--resident_bottlenecks',
+      default=False,
+      help="""\
+      Whether to load all training and validation bottlenecks into memory once
+      they are cached, so that training steps do no file I/O.\
+      """,
+      action='store_true'
+  )
+  parser.add_argument(
+      '--augmented_variants',
+      type=int,
+      default=0,
+      help="""\
+      When training with distortions, precompute this many distorted variants
+      of every training image and cache their bottlenecks, then train on a
+      random cached variant of each image instead of distorting images live.
+      Zero distorts images live.\
+      """
+  )
+  parser.add_argument(
+      '--report_augmentation',
+      default=False,
+      help="""\
+      After training on a bank of distorted variants, retrain the new layer
+      without augmentation and with live distortions and log the test accuracy,
+      step time and cache size of each.\
+      """,
+      action='store_true'
+  )
+  parser.add_argument(
+      '--cache_summary_file',
+      type=str,
+      default='.tmp/bottleneck_cache_summary.json',
+      help="""\
+      Where to write a JSON summary of the time spent reading, decoding,
+      running the network, serializing and writing while caching bottlenecks.
+      Leave empty to skip it.\
+      """
+  )
+  parser.add_argument(
+      '--cache_workers',
+      type=int,
+      default=1,
+      help="""\
+      How many processes to calculate missing bottlenecks with. Each one loads
+      its own copy of the model and writes a shard of the cache, and the shards
+      are merged once they all finish.\
+      """
+  )
+  parser.add_argument(
+      '--cache_threads_per_worker',
+      type=int,
+      default=1,
+      help="""\
+      Size of the intra-op thread pool of each --cache_workers process.\
+      """
+  )
+  parser.add_argument(
+      '--decode_workers',
+      type=int,
+      default=4,
+      help="""\
+      How many threads read and decode images ahead of the network when
+      images have to be run through it.\
+      """
+  )
+  parser.add_argument(
+      '--prefetch_queue_size',
+      type=int,
+      default=64,
+      help='How many decoded images to buffer ahead of the network.'
   )
   parser.add_argument(
       '--final_tensor_name',
@@ -0,0 +1,778 @@
+#!/usr/bin/python
+#
+# Copyright 2017 Google Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+r"""Tests for retrain.py.
+
+  python -m scripts.retrain_test
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import collections
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+import tensorflow as tf
+
+import scripts.retrain as retrain
+
+ARCHITECTURE = 'test_architecture'
+
+
+class RetrainTest(tf.test.TestCase):
+
+  def setUp(self):
+    # Stores record the model and preprocessing each row was calculated with,
+    # which would otherwise need a downloaded model file.
+    patcher = tf.test.mock.patch.dict(
+        retrain.architecture_2_bottleneck_inputs,
+        {ARCHITECTURE: ('model', 'preprocessing', 'inputs')})
+    patcher.start()
+    self.addCleanup(patcher.stop)
+
+  def make_store(self, bottleneck_dir, category='training',
+                 precision='float32'):
+    return retrain.BottleneckStore(bottleneck_dir, ARCHITECTURE, category,
+                                   precision)
+
+  def testBottleneckStoreRoundTrip(self):
+    bottleneck_dir = tempfile.mkdtemp(dir=self.get_temp_dir())
+    values = np.random.RandomState(0).randn(5, 8).astype(np.float32)
+    store = self.make_store(bottleneck_dir)
+    for i, row_values in enumerate(values):
+      self.assertEqual(i, store.put('key%d' % i, row_values))
+    # Overwriting a key reuses its row.
+    self.assertEqual(2, store.put('key2', values[2] * 2))
+    store.flush()
+
+    reopened = self.make_store(bottleneck_dir)
+    self.assertEqual(5, len(reopened))
+    self.assertIn('key4', reopened)
+    self.assertNotIn('key5', reopened)
+    self.assertEqual(3, reopened.row('key3'))
+    self.assertAllEqual(values[0], reopened.get('key0'))
+    self.assertAllEqual(values[2] * 2, reopened.get('key2'))
+    self.assertAllEqual(values[3:5], reopened.rows(np.array([3, 4])))
+
+  def testBottleneckStoreDropsRowsPastTheIndex(self):
+    bottleneck_dir = tempfile.mkdtemp(dir=self.get_temp_dir())
+    store = self.make_store(bottleneck_dir)
+    store.put('flushed', np.ones(4))
+    store.flush()
+    store.put('unflushed', np.zeros(4))
+    # Rows written after the last flush are forgotten, not misread.
+    reopened = self.make_store(bottleneck_dir)
+    self.assertEqual(['flushed'], reopened.keys)
+
+  def testBottleneckStoreRejectsOtherSizes(self):
+    store = self.make_store(tempfile.mkdtemp(dir=self.get_temp_dir()))
+    store.put('key', np.zeros(4))
+    with self.assertRaises(ValueError):
+      store.put('other', np.zeros(5))
+
+  def testBottleneckStoreCompact(self):
+    bottleneck_dir = tempfile.mkdtemp(dir=self.get_temp_dir())
+    store = self.make_store(bottleneck_dir)
+    for i in range(10):
+      store.put('key%d' % i, np.full(4, i))
+    store.flush()
+    disk_bytes = store.disk_bytes()
+    self.assertEqual(7, store.compact(set(['key1', 'key5', 'key9'])))
+    self.assertLess(store.disk_bytes(), disk_bytes)
+    self.assertEqual(['key1', 'key5', 'key9'], store.keys)
+    self.assertAllEqual(np.full(4, 5), store.get('key5'))
+
+    reopened = self.make_store(bottleneck_dir)
+    self.assertEqual(['key1', 'key5', 'key9'], reopened.keys)
+    self.assertAllEqual(np.full(4, 9), reopened.get('key9'))
+    self.assertEqual(3, reopened.compact(set()))
+    self.assertEqual(0, len(self.make_store(bottleneck_dir)))
+
+  def testQuantizeInt8RoundTrip(self):
+    values = np.random.RandomState(0).randn(6, 32).astype(np.float32)
+    values[3] = 0.0
+    stored, scales = retrain.quantize_bottlenecks(values, 'int8')
+    self.assertEqual(np.int8, stored.dtype)
+    self.assertEqual((6,), scales.shape)
+    # The largest magnitude of each row maps to 127, and all-zero rows keep a
+    # usable scale.
+    nonzero_rows = [0, 1, 2, 4, 5]
+    self.assertAllEqual(
+        np.full(5, 127),
+        np.max(np.abs(stored[nonzero_rows].astype(np.int32)), axis=1))
+    self.assertEqual(1.0, scales[3])
+    restored = retrain.dequantize_bottlenecks(stored, scales)
+    self.assertEqual(np.float32, restored.dtype)
+    # Rounding is off by at most half a step of each row's scale.
+    self.assertTrue(np.all(np.abs(restored - values) <=
+                           scales[:, None] / 2 + 1e-6))
+    self.assertAllEqual(np.zeros(32), restored[3])
+
+  def testQuantizeFloatPrecisions(self):
+    values = np.random.RandomState(0).randn(3, 8).astype(np.float32)
+    stored, scales = retrain.quantize_bottlenecks(values, 'float32')
+    self.assertIsNone(scales)
+    self.assertAllEqual(values, retrain.dequantize_bottlenecks(stored, None))
+    stored, scales = retrain.quantize_bottlenecks(values, 'float16')
+    self.assertIsNone(scales)
+    self.assertEqual(np.float16, stored.dtype)
+    self.assertAllClose(values, retrain.dequantize_bottlenecks(stored, None),
+                        rtol=1e-3, atol=1e-3)
+
+  def testInt8BottleneckStoreRoundTrip(self):
+    bottleneck_dir = tempfile.mkdtemp(dir=self.get_temp_dir())
+    values = np.random.RandomState(0).randn(3, 16).astype(np.float32)
+    store = self.make_store(bottleneck_dir, precision='int8')
+    for i, row_values in enumerate(values):
+      store.put('key%d' % i, row_values)
+    store.flush()
+    reopened = self.make_store(bottleneck_dir, precision='int8')
+    expected = retrain.dequantize_bottlenecks(
+        *retrain.quantize_bottlenecks(values, 'int8'))
+    self.assertAllEqual(expected, reopened.rows(np.arange(3)))
+    # Stores of other precisions are separate files.
+    self.assertEqual(0, len(self.make_store(bottleneck_dir)))
+
+  def write_tiny_model(self, model_dir):
+    # A tiny stand-in for a downloaded model, with the input and bottleneck
+    # names of the MobileNet graphs.
+    with tf.Graph().as_default() as model_graph:
+      images = tf.placeholder(tf.float32, [None, 4, 4, 3], name='input')
+      tf.reduce_mean(images * 2.0, axis=[1, 2], name='pool')
+    tf.train.write_graph(model_graph.as_graph_def(), model_dir, 'model.pb',
+                         as_text=False)
+    return {
+        'input_width': 4,
+        'input_height': 4,
+        'input_depth': 3,
+        'input_mean': 127.5,
+        'input_std': 127.5,
+        'model_file_name': 'model.pb',
+        'resized_input_tensor_name': 'input:0',
+        'bottleneck_tensor_name': 'pool:0',
+        'bottleneck_tensor_size': 3,
+    }
+
+  @tf.test.mock.patch.object(retrain, 'create_model_info')
+  @tf.test.mock.patch.object(retrain, 'FLAGS', architecture=ARCHITECTURE,
+                             final_tensor_name='final_result',
+                             learning_rate=0.01)
+  def testExportedGraphRunsFromTheModelInput(self, flags_mock,
+                                             create_model_info_mock):
+    model_dir = tempfile.mkdtemp(dir=self.get_temp_dir())
+    model_info = self.write_tiny_model(model_dir)
+    flags_mock.model_dir = model_dir
+    create_model_info_mock.return_value = model_info
+    input_values = np.random.RandomState(0).rand(5, 4, 4, 3).astype(np.float32)
+    first_file = os.path.join(model_dir, 'first.pb')
+    second_file = os.path.join(model_dir, 'second.pb')
+
+    (graph, bottleneck_tensor, resized_input_tensor, _, _,
+     _) = retrain.create_model_graph(model_info)
+    with graph.as_default(), tf.Session(graph=graph) as sess:
+      final_tensor = retrain.add_final_training_ops(
+          2, 'final_result', bottleneck_tensor, 3)[4]
+      sess.run(tf.global_variables_initializer())
+      retrain.save_graph_to_file(sess, graph, first_file)
+      first_expected = sess.run(final_tensor,
+                                {resized_input_tensor: input_values})
+      # The second export splices new weights into the frozen model cached by
+      # the first one.
+      random = np.random.RandomState(1)
+      for variable in tf.trainable_variables():
+        variable.load(random.randn(*variable.get_shape().as_list()).astype(
+            np.float32), sess)
+      retrain.save_graph_to_file(sess, graph, second_file)
+      second_expected = sess.run(final_tensor,
+                                 {resized_input_tensor: input_values})
+
+    for graph_file, expected in [(first_file, first_expected),
+                                 (second_file, second_expected)]:
+      graph_def = tf.GraphDef()
+      with open(graph_file, 'rb') as f:
+        graph_def.ParseFromString(f.read())
+      node_names = [node.name for node in graph_def.node]
+      self.assertIn('input', node_names)
+      self.assertFalse(
+          [name for name in node_names
+           if name.startswith(retrain.FUSED_INPUT_SCOPE + '/')])
+      self.assertFalse([node.op for node in graph_def.node
+                        if node.op in ('VariableV2', 'Placeholder') and
+                        node.name != 'input'])
+      with tf.Graph().as_default(), tf.Session() as sess:
+        tf.import_graph_def(graph_def, name='')
+        result = sess.run('final_result:0', {'input:0': input_values})
+      self.assertAllClose(expected, result)
+
+  def testEarlyStoppingPatience(self):
+    early_stopping = retrain.EarlyStopping('cross_entropy', patience=2,
+                                           min_delta=0.05)
+    self.assertTrue(early_stopping.update(0.5, 1.0))
+    self.assertTrue(early_stopping.update(0.6, 0.9))
+    # Less than min_delta better isn't an improvement.
+    self.assertFalse(early_stopping.update(0.6, 0.88))
+    self.assertFalse(early_stopping.should_stop())
+    self.assertFalse(early_stopping.update(0.6, 1.2))
+    self.assertTrue(early_stopping.should_stop())
+    self.assertAllClose(0.9, early_stopping.best_value())
+
+  def testEarlyStoppingWindowAndAccuracy(self):
+    early_stopping = retrain.EarlyStopping('accuracy', patience=1, window=2)
+    self.assertTrue(early_stopping.update(0.5, 0.0))
+    # The smoothed accuracy drops from 0.5 to 0.45 despite the new value.
+    self.assertFalse(early_stopping.update(0.4, 0.0))
+    self.assertTrue(early_stopping.should_stop())
+    self.assertTrue(early_stopping.update(0.9, 0.0))
+    self.assertFalse(early_stopping.should_stop())
+    self.assertAllClose(0.65, early_stopping.best_value())
+
+  def testEarlyStoppingWithoutPatienceNeverStops(self):
+    early_stopping = retrain.EarlyStopping()
+    early_stopping.update(0.5, 1.0)
+    for _ in range(10):
+      early_stopping.update(0.1, 5.0)
+    self.assertFalse(early_stopping.should_stop())
+    with self.assertRaises(ValueError):
+      retrain.EarlyStopping('loss')
+
+  def testSoftmaxCrossEntropyGradients(self):
+    random = np.random.RandomState(0)
+    weights = random.randn(6, 3)
+    biases = random.randn(3)
+    bottlenecks = random.randn(4, 6)
+    ground_truth = np.eye(3)[[0, 2, 1, 2]]
+    loss, weights_gradient, biases_gradient = retrain.softmax_cross_entropy(
+        weights, biases, bottlenecks, ground_truth)
+    logits = np.dot(bottlenecks, weights) + biases
+    probabilities = np.exp(logits) / np.exp(logits).sum(axis=1, keepdims=True)
+    self.assertAllClose(
+        -np.mean(np.log(probabilities[np.arange(4), [0, 2, 1, 2]])), loss)
+
+    # Compare with central differences of the loss.
+    epsilon = 1e-6
+    for parameters, gradient in [(weights, weights_gradient),
+                                 (biases, biases_gradient)]:
+      numeric = np.zeros_like(parameters)
+      for index in np.ndindex(*parameters.shape):
+        original = parameters[index]
+        parameters[index] = original + epsilon
+        loss_up = retrain.softmax_cross_entropy(weights, biases, bottlenecks,
+                                                ground_truth)[0]
+        parameters[index] = original - epsilon
+        loss_down = retrain.softmax_cross_entropy(weights, biases,
+                                                  bottlenecks, ground_truth)[0]
+        parameters[index] = original
+        numeric[index] = (loss_up - loss_down) / (2 * epsilon)
+      self.assertAllClose(numeric, gradient, rtol=1e-5, atol=1e-7)
+
+  def testSoftmaxCrossEntropyIsStableForLargeLogits(self):
+    loss, weights_gradient, _ = retrain.softmax_cross_entropy(
+        np.array([[1000.0, -1000.0]]), np.zeros(2), np.array([[1.0]]),
+        np.array([[0.0, 1.0]]))
+    self.assertAllClose(2000.0, loss)
+    self.assertTrue(np.all(np.isfinite(weights_gradient)))
+
+  def make_image_lists(self, counts, category='training'):
+    return dict(
+        ('label%d' % label, {
+            'dir': 'label%d' % label,
+            'training': [],
+            'testing': [],
+            'validation': [],
+            category: ['image%d.jpg' % i for i in range(count)],
+        }) for label, count in enumerate(counts))
+
+  def testBottleneckSamplerStateRoundTrip(self):
+    image_lists = self.make_image_lists([5, 3, 8])
+    for mode in retrain.BottleneckSampler.MODES:
+      sampler = retrain.BottleneckSampler(image_lists, 'training', mode,
+                                          seed=0)
+      sampler.sample(7)
+      sampler.rng.randn()  # Leaves a cached gaussian in the state.
+      state = sampler.get_state()
+      expected = [sampler.sample(4) for _ in range(5)]
+
+      restored = retrain.BottleneckSampler(image_lists, 'training', mode,
+                                           seed=1)
+      restored.set_state(state)
+      self.assertAllEqual(expected, [restored.sample(4) for _ in range(5)])
+
+  def testBottleneckSamplerStateNeedsTheSameSplit(self):
+    state = retrain.BottleneckSampler(self.make_image_lists([5, 3]),
+                                      'training').get_state()
+    sampler = retrain.BottleneckSampler(self.make_image_lists([5, 4]),
+                                        'training')
+    with self.assertRaises(ValueError):
+      sampler.set_state(state)
+
+  def testImageListsRoundTrip(self):
+    image_dict = collections.OrderedDict([
+        ('daisy', {
+            'dir': 'Daisy',
+            'training': ['a.jpg', 'b.jpg', u'\u00e9t\u00e9.jpg'],
+            'testing': ['c.jpg'],
+            'validation': [],
+        }),
+        ('rose', {
+            'dir': 'rose',
+            'training': ['d.png'],
+            'testing': [],
+            'validation': ['e.jpg', 'f.jpg'],
+        }),
+    ])
+    image_lists = retrain.ImageLists.from_dict(image_dict)
+    self.assertEqual(image_dict, image_lists.to_dict())
+    self.assertEqual(['daisy', 'rose'], list(image_lists.keys()))
+    self.assertEqual(2, len(image_lists))
+    self.assertIn('rose', image_lists)
+    self.assertNotIn('tulip', image_lists)
+    self.assertEqual('Daisy', image_lists['daisy']['dir'])
+    self.assertEqual(3, image_lists.count('daisy', 'training'))
+    self.assertEqual(0, image_lists.count('rose', 'testing'))
+    self.assertEqual(['e.jpg', 'f.jpg'],
+                     list(image_lists['rose']['validation']))
+    self.assertEqual(u'\u00e9t\u00e9.jpg', image_lists['daisy']['training'][2])
+
+  def testImageListsImagePaths(self):
+    image_lists = retrain.ImageLists.from_dict({
+        'daisy': {
+            'dir': 'Daisy',
+            'training': ['a.jpg', 'b.jpg'],
+            'testing': [],
+            'validation': ['c.jpg'],
+        },
+    })
+    image_dir = os.path.join('images', 'flowers')
+    self.assertEqual(
+        os.path.join(image_dir, 'Daisy', 'b.jpg'),
+        retrain.get_image_path(image_lists, 'daisy', 1, image_dir, 'training'))
+    # Indices wrap around the images of the label in the category.
+    self.assertEqual(
+        os.path.join(image_dir, 'Daisy', 'a.jpg'),
+        retrain.get_image_path(image_lists, 'daisy', 4, image_dir, 'training'))
+    self.assertEqual(
+        os.path.join(image_dir, 'Daisy', 'c.jpg'),
+        retrain.get_image_path(image_lists, 'daisy', 7, image_dir,
+                               'validation'))
+
+  def testAliasTableProbabilities(self):
+    for weights in [[1.0], [1.0, 1.0, 1.0], [5.0, 0.0, 1.0, 2.0],
+                    np.random.RandomState(0).rand(50) ** 4]:
+      weights = np.asarray(weights)
+      accept, alias = retrain.build_alias_table(weights)
+      # Each column is drawn with probability 1/n and then keeps its own
+      # index with its acceptance probability or moves to its alias.
+      probabilities = accept / len(weights)
+      np.add.at(probabilities, alias, (1.0 - accept) / len(weights))
+      self.assertAllClose(weights / weights.sum(), probabilities)
+      self.assertTrue(np.all((accept >= 0) & (accept <= 1)))
+      # Indices of zero weight are never kept or aliased to.
+      for index in np.flatnonzero(weights == 0):
+        self.assertEqual(0.0, accept[index])
+        self.assertNotIn(index, alias[accept < 1])
+
+  def testBottleneckSamplerLabelWeights(self):
+    image_lists = self.make_image_lists([10, 90])
+    for mode, expected in [('balanced', 0.5), ('uniform', 0.9),
+                           ('tempered', 0.75)]:
+      sampler = retrain.BottleneckSampler(image_lists, 'training', mode,
+                                          seed=0, exponent=0.5)
+      rows = sampler.sample(20000)
+      self.assertAllClose(expected, np.mean(sampler.label_indices[rows]),
+                          atol=0.02)
+      self.assertTrue(np.all((rows >= 0) & (rows < 100)))
+
+  def testEvaluateInChunksWeightsByChunkSize(self):
+    random = np.random.RandomState(0)
+    scores = random.rand(7, 3)
+    ground_truth = np.eye(3)[random.randint(0, 3, 7)]
+    filenames = ['image%d.jpg' % i for i in range(7)]
+    bottleneck_input, ground_truth_input = object(), object()
+
+    def run(fetches, feed_dict):
+      # Stands in for the accuracy, cross entropy and prediction tensors of
+      # the new layer, taking the bottlenecks as class scores.
+      batch_scores = feed_dict[bottleneck_input]
+      batch_truth = feed_dict[ground_truth_input]
+      predictions = np.argmax(batch_scores, axis=1)
+      return [np.mean(predictions == np.argmax(batch_truth, axis=1)),
+              -np.mean(np.sum(batch_truth * np.log(batch_scores), axis=1)),
+              predictions]
+
+    sess = tf.test.mock.Mock()
+    sess.run.side_effect = run
+    # Uneven chunks, so an unweighted mean of the chunk results would differ.
+    chunks = [(scores[start:end], ground_truth[start:end],
+               filenames[start:end])
+              for start, end in [(0, 1), (1, 5), (5, 7)]]
+    accuracy, cross_entropy, how_many, predictions, misclassified = (
+        retrain.evaluate_in_chunks(sess, chunks, 'accuracy', 'cross_entropy',
+                                   'prediction', bottleneck_input,
+                                   ground_truth_input, True))
+    expected_accuracy, expected_cross_entropy, expected_predictions = run(
+        None, {bottleneck_input: scores, ground_truth_input: ground_truth})
+    self.assertEqual(3, sess.run.call_count)
+    self.assertEqual(7, how_many)
+    self.assertAllClose(expected_accuracy, accuracy)
+    self.assertAllClose(expected_cross_entropy, cross_entropy)
+    self.assertAllEqual(expected_predictions, predictions)
+    self.assertEqual(
+        [(filenames[i], expected_predictions[i]) for i in range(7)
+         if expected_predictions[i] != np.argmax(ground_truth[i])],
+        misclassified)
+
+  def testEvaluateInChunksWithoutChunks(self):
+    accuracy, cross_entropy, how_many, predictions, misclassified = (
+        retrain.evaluate_in_chunks(tf.test.mock.Mock(), [], None, None, None,
+                                   None, None))
+    self.assertEqual((0.0, 0.0, 0), (accuracy, cross_entropy, how_many))
+    self.assertEqual(0, len(predictions))
+    self.assertEqual([], misclassified)
+
+  @tf.test.mock.patch.dict(retrain.image_path_2_fingerprint)
+  @tf.test.mock.patch.object(retrain, 'bucket_image_cache', None)
+  def testBucketImageListsMergeLabels(self):
+    root = tempfile.mkdtemp(dir=self.get_temp_dir())
+    bucket_dir = os.path.join(root, 'bucket')
+    os.makedirs(bucket_dir)
+    rows = []
+    for i in range(6):
+      with open(os.path.join(bucket_dir, 'image%d.jpg' % i), 'wb') as f:
+        f.write(b'image%d' % i)
+      rows.append('image%d.jpg,%s' % (i, 'Cat' if i < 3 else 'cat'))
+    # A repeated annotation, and one of an image that isn't in the bucket.
+    rows += ['image1.jpg,Cat', 'missing.jpg,cat']
+    with open(os.path.join(bucket_dir, '_annotations.csv'), 'w') as f:
+      f.write('\n'.join(rows))
+
+    cache_dir = os.path.join(root, 'cache')
+    image_lists = retrain.create_bucket_image_lists(
+        retrain.open_object_storage('file://' + root), 'bucket', cache_dir,
+        0, 0, 2 ** 20, 2, 4)
+    self.assertEqual(['cat'], list(image_lists.keys()))
+    self.assertEqual(6, image_lists.count('cat', 'training'))
+    for index in range(6):
+      image_path = retrain.get_image_path(image_lists, 'cat', index,
+                                          cache_dir, 'training')
+      self.assertEqual(os.path.join(cache_dir, 'Cat'),
+                       os.path.dirname(image_path))
+      self.assertTrue(retrain.bucket_image_cache.owns(image_path))
+      self.assertEqual(
+          b'image%d' % int(os.path.basename(image_path)[5:-4]),
+          retrain.read_image_file(image_path))
+
+  @tf.test.mock.patch.dict(retrain.image_path_2_fingerprint)
+  @tf.test.mock.patch.dict(retrain.bottleneck_stores, clear=True)
+  def testGarbageCollectionKeepsCurrentDistortionVariants(self):
+    root = tempfile.mkdtemp(dir=self.get_temp_dir())
+    image_dir = os.path.join(root, 'images')
+    bottleneck_dir = os.path.join(root, 'bottlenecks')
+    os.makedirs(os.path.join(image_dir, 'cat'))
+    for i in range(3):
+      with open(os.path.join(image_dir, 'cat', 'cat%d.jpg' % i), 'wb') as f:
+        f.write(b'cat%d' % i)
+    image_lists = retrain.ImageLists.from_dict({
+        'cat': {
+            'dir': 'cat',
+            'training': ['cat0.jpg', 'cat1.jpg'],
+            'testing': ['cat2.jpg'],
+            'validation': [],
+        },
+    })
+    current, previous = (True, 10, 0, 0), (False, 0, 20, 0)
+    store = retrain.get_bottleneck_store(bottleneck_dir, 'augmented',
+                                         ARCHITECTURE, 'float32')
+    live_keys = []
+    for index in range(2):
+      key = retrain.get_bottleneck_key(image_lists, 'cat', index, image_dir,
+                                       'training', ARCHITECTURE)
+      for distortions in [current, previous]:
+        for variant in range(3):
+          variant_key = retrain.get_augmented_bottleneck_key(
+              key, distortions, variant)
+          store.put(variant_key, np.zeros(4))
+          if distortions == current and variant < 2:
+            live_keys.append(variant_key)
+    store.put('stale_aug_flip1-crop10-scale0-brightness0_0', np.zeros(4))
+    store.flush()
+
+    retrain.collect_bottleneck_garbage(image_lists, image_dir, bottleneck_dir,
+                                       ARCHITECTURE, 'float32', current, 2)
+    self.assertEqual(sorted(live_keys), sorted(store.keys))
+    retrain.collect_bottleneck_garbage(image_lists, image_dir, bottleneck_dir,
+                                       ARCHITECTURE, 'float32')
+    self.assertEqual([], store.keys)
+
+  def testRunTrainStepSummaryInterval(self):
+    sess = tf.test.mock.Mock()
+    sess.run.return_value = ('summary', None)
+    train_writer = tf.test.mock.Mock()
+    recorded = [
+        step for step in range(6)
+        if retrain.run_train_step(sess, step, 'train_step', 'summary_op', 3,
+                                  train_writer, {})]
+    self.assertEqual([0, 3], recorded)
+    self.assertEqual(6, sess.run.call_count)
+    self.assertEqual(2, train_writer.add_summary.call_count)
+    # Zero or less never records summaries.
+    for summary_interval in [0, -1]:
+      self.assertFalse(retrain.run_train_step(
+          sess, 0, 'train_step', 'summary_op', summary_interval, train_writer,
+          {}))
+    sess.run.assert_called_with('train_step', feed_dict={})
+
+  @tf.test.mock.patch.dict(retrain.image_path_2_fingerprint)
+  @tf.test.mock.patch.object(retrain, 'bucket_image_cache', None)
+  @tf.test.mock.patch.object(retrain.LocalObject, 'e_tag',
+                             property(lambda self: '"abc123-2"'))
+  def testBucketMultipartImagesAreHashed(self):
+    root = tempfile.mkdtemp(dir=self.get_temp_dir())
+    bucket_dir = os.path.join(root, 'bucket')
+    os.makedirs(bucket_dir)
+    rows = []
+    for i in range(20):
+      with open(os.path.join(bucket_dir, 'image%d.jpg' % i), 'wb') as f:
+        f.write(b'image%d' % i)
+      rows.append('image%d.jpg,cat' % i)
+    with open(os.path.join(bucket_dir, '_annotations.csv'), 'w') as f:
+      f.write('\n'.join(rows))
+
+    cache_dir = os.path.join(root, 'cache')
+    image_lists = retrain.create_bucket_image_lists(
+        retrain.open_object_storage('file://' + root), 'bucket', cache_dir,
+        0, 0, 2 ** 20, 2, 4)
+    image_path = retrain.get_image_path(image_lists, 'cat', 0, cache_dir,
+                                        'training')
+    self.assertNotIn(image_path, retrain.image_path_2_fingerprint)
+    with open(os.path.join(bucket_dir, os.path.basename(image_path)),
+              'rb') as f:
+      expected = hashlib.sha1(f.read()).hexdigest()
+    self.assertEqual(expected, retrain.get_image_fingerprint(image_path))
+
+  @tf.test.mock.patch.object(retrain, 'get_or_create_bottleneck')
+  def testSgdTrainsOnCachedBottleneckLists(self, mock_get_or_create):
+    # Without resident bottlenecks, batches are lists of rows from the store.
+    image_lists = retrain.ImageLists.from_dict(self.make_image_lists([4, 4]))
+    mock_get_or_create.side_effect = (
+        lambda sess, image_lists, label_name, *args: [
+            1.0 if label_name == 'label0' else -1.0, 0.5])
+    sampler = retrain.BottleneckSampler(image_lists, 'training', seed=0)
+
+    def get_train_batch():
+      return retrain.get_random_cached_bottlenecks(
+          None, image_lists, 4, 'training', '/tmp', '/tmp', None, None, None,
+          None, ARCHITECTURE, 'float32', sampler)[:2]
+
+    self.assertIsInstance(get_train_batch()[0], list)
+    weights, biases = retrain.train_softmax_sgd(
+        np.zeros((2, 2)), np.zeros(2), get_train_batch, 50, 0.5)
+    predictions = np.argmax(
+        np.dot([[1.0, 0.5], [-1.0, 0.5]], weights) + biases, axis=1)
+    self.assertAllEqual([0, 1], predictions)
+
+  def testResidentBottlenecksAllRowsKeepTheirLabels(self):
+    image_lists = retrain.ImageLists.from_dict(self.make_image_lists([1, 2, 3]))
+    sampler = retrain.BottleneckSampler(image_lists, 'training')
+    label_indices = np.array([0, 1, 1, 2, 2, 2])
+    resident = retrain.ResidentBottlenecks(
+        np.arange(12, dtype=np.float32).reshape(6, 2), None, label_indices,
+        ['image%d.jpg' % i for i in range(6)])
+    bottlenecks, ground_truth, filenames = (
+        retrain.get_random_resident_bottlenecks(resident, -1, sampler))
+    self.assertAllEqual(resident.bottlenecks, bottlenecks)
+    self.assertAllEqual(np.eye(3)[label_indices], ground_truth)
+    self.assertEqual(resident.filenames, filenames)
+
+  @tf.test.mock.patch.dict(retrain.image_path_2_fingerprint, clear=True)
+  @tf.test.mock.patch.dict(retrain.image_path_2_stat_fingerprint, clear=True)
+  def testImageFingerprintsPersistInTheManifest(self):
+    root = tempfile.mkdtemp(dir=self.get_temp_dir())
+    image_dir = os.path.join(root, 'images')
+    manifest_file = os.path.join(root, 'manifest.json')
+    os.makedirs(os.path.join(image_dir, 'cat'))
+    for i in range(20):
+      with open(os.path.join(image_dir, 'cat', 'cat%d.jpg' % i), 'wb') as f:
+        f.write(b'cat%d' % i)
+
+    def get_keys():
+      image_lists = retrain.create_image_lists(image_dir, 30, 30,
+                                               manifest_file)
+      keys = {}
+      for category in retrain.ImageLists.CATEGORIES:
+        for index in range(image_lists.count('cat', category)):
+          image_path = retrain.get_image_path(image_lists, 'cat', index,
+                                              image_dir, category)
+          keys[os.path.basename(image_path)] = retrain.get_bottleneck_key(
+              image_lists, 'cat', index, image_dir, category, ARCHITECTURE)
+      retrain.save_image_fingerprints(manifest_file, image_lists, image_dir)
+      retrain.image_path_2_fingerprint.clear()
+      retrain.image_path_2_stat_fingerprint.clear()
+      return keys
+
+    keys = get_keys()
+    with tf.test.mock.patch.object(
+        retrain, 'get_file_fingerprint',
+        wraps=retrain.get_file_fingerprint) as mock_get_file_fingerprint:
+      self.assertEqual(keys, get_keys())
+      self.assertEqual(0, mock_get_file_fingerprint.call_count)
+
+      # Rename an image so that it moves to another split.
+      old_path = os.path.join(image_dir, 'cat', 'cat0.jpg')
+      old_category = retrain.get_image_category(old_path, 30, 30)
+      new_path = next(
+          path for path in (os.path.join(image_dir, 'cat', 'moved%d.jpg' % i)
+                            for i in range(100))
+          if retrain.get_image_category(path, 30, 30) != old_category)
+      os.rename(old_path, new_path)
+      os.utime(os.path.dirname(new_path), (0, 0))
+      new_keys = get_keys()
+      self.assertEqual(1, mock_get_file_fingerprint.call_count)
+    self.assertEqual(keys.pop('cat0.jpg'),
+                     new_keys.pop(os.path.basename(new_path)))
+    self.assertEqual(keys, new_keys)
+
+  def testSharedBottlenecksAreMapped(self):
+    shared_dir = tempfile.mkdtemp(dir=self.get_temp_dir())
+    resident = retrain.ResidentBottlenecks(
+        np.arange(12, dtype=np.int8).reshape(4, 3),
+        np.array([0.5, 1.0, 1.5, 2.0], dtype=np.float32),
+        np.array([0, 0, 1, 1]), ['image%d.jpg' % i for i in range(4)])
+    shared = retrain.open_shared_bottlenecks(
+        retrain.share_resident_bottlenecks(
+            resident, os.path.join(shared_dir, 'training')))
+    self.assertIsInstance(shared.bottlenecks, np.memmap)
+    self.assertIsInstance(shared.scales, np.memmap)
+    for expected, actual in zip(resident, shared):
+      self.assertAllEqual(expected, actual)
+
+  @tf.test.mock.patch.object(retrain, 'FLAGS', learning_rate=0.01)
+  def testScalarSummariesSkipVariableStatistics(self, flags_mock):
+    with tf.Graph().as_default():
+      bottleneck_tensor = tf.placeholder(tf.float32, [None, 3])
+      retrain.add_final_training_ops(2, 'final_result', bottleneck_tensor, 3)
+      variable_summaries = tf.get_collection(retrain.VARIABLE_SUMMARIES)
+      all_summaries = retrain.add_summary_op('all').op.inputs
+      scalar_summaries = retrain.add_summary_op('scalars').op.inputs
+    self.assertEqual(10, len(variable_summaries))
+    for summary in variable_summaries:
+      self.assertIn(summary, list(all_summaries))
+      self.assertNotIn(summary, list(scalar_summaries))
+    self.assertEqual(['ScalarSummary'],
+                     [summary.op.type for summary in scalar_summaries])
+
+  def make_image_dir(self, counts):
+    image_dir = tempfile.mkdtemp(dir=self.get_temp_dir())
+    for label, count in enumerate(counts):
+      os.makedirs(os.path.join(image_dir, 'label%d' % label))
+      for i in range(count):
+        self.add_image(image_dir, 'label%d' % label, 'image%d.jpg' % i)
+    return image_dir
+
+  def add_image(self, image_dir, dir_name, base_name):
+    with open(os.path.join(image_dir, dir_name, base_name), 'wb') as f:
+      f.write((dir_name + base_name).encode('utf-8'))
+
+  def testImageManifestSkipsUnchangedFolders(self):
+    image_dir = self.make_image_dir([3, 2])
+    manifest_file = os.path.join(tempfile.mkdtemp(dir=self.get_temp_dir()),
+                                 'image_manifest.json')
+    expected = retrain.create_image_lists(image_dir, 30, 30, manifest_file)
+
+    with tf.test.mock.patch.object(
+        retrain, 'list_image_dir',
+        wraps=retrain.list_image_dir) as mock_list_image_dir:
+      image_lists = retrain.create_image_lists(image_dir, 30, 30,
+                                               manifest_file)
+      # Only the image directory itself is listed.
+      self.assertEqual(1, mock_list_image_dir.call_count)
+    self.assertEqual(expected.to_dict(), image_lists.to_dict())
+
+    self.add_image(image_dir, 'label1', 'new.jpg')
+    os.utime(os.path.join(image_dir, 'label1'), (0, 0))
+    with tf.test.mock.patch.object(
+        retrain, 'get_image_category',
+        wraps=retrain.get_image_category) as mock_get_image_category:
+      image_lists = retrain.create_image_lists(image_dir, 30, 30,
+                                               manifest_file)
+      mock_get_image_category.assert_called_once_with(
+          os.path.join(image_dir, 'label1', 'new.jpg'), 30, 30)
+    self.assertEqual(3, sum(image_lists.count('label1', category)
+                            for category in retrain.ImageLists.CATEGORIES))
+
+  def testCorruptImageManifestIsRebuilt(self):
+    image_dir = self.make_image_dir([3, 2])
+    manifest_file = os.path.join(tempfile.mkdtemp(dir=self.get_temp_dir()),
+                                 'image_manifest.json')
+    expected = retrain.create_image_lists(image_dir, 30, 30)
+    with open(manifest_file, 'w') as f:
+      f.write('{"image_dir": ')
+    self.assertEqual({}, retrain.load_image_manifest(manifest_file, image_dir,
+                                                     30, 30))
+    image_lists = retrain.create_image_lists(image_dir, 30, 30, manifest_file)
+    self.assertEqual(expected.to_dict(), image_lists.to_dict())
+    self.assertEqual(['label0', 'label1'], sorted(retrain.load_image_manifest(
+        manifest_file, image_dir, 30, 30)['dirs']))
+
+  @tf.test.mock.patch.object(retrain, 'FLAGS')
+  def testBatchedBottlenecksMatchSingleImages(self, flags_mock):
+    model_dir = tempfile.mkdtemp(dir=self.get_temp_dir())
+    model_info = self.write_tiny_model(model_dir)
+    flags_mock.model_dir = model_dir
+    image_dir = tempfile.mkdtemp(dir=self.get_temp_dir())
+    bottleneck_dir = tempfile.mkdtemp(dir=self.get_temp_dir())
+    pixels = np.random.RandomState(0).randint(256, size=(5, 6, 6, 3))
+    image_paths = []
+    with tf.Graph().as_default(), tf.Session() as sess:
+      for i in range(5):
+        image_paths.append(os.path.join(image_dir, 'image%d.jpg' % i))
+        with open(image_paths[-1], 'wb') as f:
+          f.write(sess.run(tf.image.encode_jpeg(pixels[i].astype(np.uint8))))
+
+    (graph, bottleneck_tensor, resized_input_tensor, jpeg_data_tensor,
+     decoded_image_tensor, _) = retrain.create_model_graph(model_info)
+    stores = {}
+    with tf.Session(graph=graph) as sess:
+      # A batch size of one takes the fused path from JPEG to bottleneck, and
+      # three leaves a partial batch at the end.
+      for batch_size in [1, 3]:
+        stores[batch_size] = self.make_store(bottleneck_dir,
+                                             'batch%d' % batch_size)
+        pending_items = [('key%d' % i, (image_path, [stores[batch_size]]))
+                         for i, image_path in enumerate(image_paths)]
+        summary = retrain.create_missing_bottlenecks(
+            sess, pending_items, jpeg_data_tensor, decoded_image_tensor,
+            resized_input_tensor, bottleneck_tensor, batch_size, 2, 4)
+        self.assertEqual(5, summary['images'])
+    for i in range(5):
+      self.assertAllClose(stores[1].get('key%d' % i),
+                          stores[3].get('key%d' % i))
+
+  def testEpochSamplingVisitsEveryImageOncePerEpoch(self):
+    image_lists = self.make_image_lists([5, 3, 8])
+    sampler = retrain.BottleneckSampler(image_lists, 'training', 'epoch',
+                                        seed=0)
+    # Batches of 6 straddle the ends of the 16 image epochs.
+    rows = np.concatenate([sampler.sample(6) for _ in range(8)])
+    epochs = rows.reshape(3, 16)
+    for epoch in epochs:
+      self.assertAllEqual(np.arange(16), np.sort(epoch))
+    self.assertFalse(np.array_equal(epochs[0], epochs[1]))
+
+
+if __name__ == '__main__':
+  tf.test.main()